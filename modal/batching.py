@@ -0,0 +1,493 @@
+"""
+Continuous batching scheduler for SabiYarn generation.
+
+Concurrent requests share one decode batch: new requests are admitted at step
+boundaries (after a prefill into a free KV cache slot) and finished sequences are
+retired immediately, so every forward pass serves all in-flight requests.
+Relies on the per-row `start_pos` / `cache_slots` support of GPTJXForCausalLM.
+Prompts can skip prefilling tokens whose K/V is already cached, either as a shared
+prompt-template prefix (PrefixKVCache) or as the history of a chat session
+(SessionKVCache). Long prompts can be prefilled in fixed-size chunks interleaved with
+the decode steps of running requests. Beam search requests run between batches, and
+the ones queued with the same settings are decoded together.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import Future
+from contextlib import AbstractContextManager
+from typing import Any, Callable, Deque, List, Optional
+
+import torch
+
+from prefix_cache import PrefixKVCache
+from sabiyarn_optimized import REPETITION_PENALTY_WINDOW, TokenSampler, apply_repetition_penalty
+from session_cache import SessionKVCache
+
+
+class _Sequence:
+    """State of one request inside the scheduler."""
+
+    __slots__ = (
+        "tokens", "prompt_len", "max_new_tokens", "do_sample", "temperature", "top_k",
+        "top_p", "repetition_penalty", "repetition_penalty_window", "eos_token_id", "on_token",
+        "session_id", "future", "slot", "num_prefilled", "num_cached",
+    )
+
+    def __init__(
+        self,
+        prompt_ids: List[int],
+        max_new_tokens: int,
+        do_sample: bool,
+        temperature: float,
+        top_k: Optional[int],
+        top_p: Optional[float],
+        repetition_penalty: float,
+        eos_token_id: Optional[int],
+        on_token: Optional[Callable[[int], None]] = None,
+        session_id: Optional[str] = None,
+        repetition_penalty_window: Optional[int] = REPETITION_PENALTY_WINDOW,
+    ):
+        self.tokens = list(prompt_ids)
+        self.prompt_len = len(self.tokens)
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.repetition_penalty_window = repetition_penalty_window
+        self.eos_token_id = eos_token_id
+        self.on_token = on_token
+        self.session_id = session_id
+        self.future: Future = Future()
+        self.slot: Optional[int] = None
+        # Prompt tokens already in the KV cache slot, and how many of them were copied
+        # from a session / prefix cache rather than prefilled (None before the lookup)
+        self.num_prefilled = 0
+        self.num_cached: Optional[int] = None
+
+    @property
+    def num_generated(self) -> int:
+        return len(self.tokens) - self.prompt_len
+
+    def append(self, token: int):
+        self.tokens.append(token)
+        if self.on_token is not None:
+            self.on_token(token)
+
+    def is_finished(self) -> bool:
+        if self.eos_token_id is not None and self.tokens[-1] == self.eos_token_id:
+            return True
+        return self.num_generated >= self.max_new_tokens
+
+
+def sample_next_tokens(logits: torch.Tensor, seqs: List[_Sequence]) -> List[int]:
+    """
+    Pick the next token of every sequence in one batched call, each with its own
+    repetition penalty / temperature / top-k / top-p / greedy settings, following the
+    same rules as GPTJXForCausalLM.generate. The repetition penalty covers each
+    sequence's `repetition_penalty_window` most recent tokens (all of them if None).
+
+    Args:
+        logits: Last-position logits of shape (len(seqs), vocab_size)
+        seqs: Sequences whose sampling parameters and histories are used, in row order
+    """
+    logits = logits.float()
+
+    penalties = [seq.repetition_penalty for seq in seqs]
+    if any(p != 1.0 for p in penalties):
+        recent = [
+            seq.tokens if seq.repetition_penalty_window is None else seq.tokens[-seq.repetition_penalty_window:]
+            for seq in seqs
+        ]
+        width = max(len(r) for r in recent)
+        # Left-pad shorter histories with their own first token; repeats are penalized once
+        window = torch.tensor([[r[0]] * (width - len(r)) + r for r in recent], device=logits.device)
+        penalty = torch.tensor(penalties, device=logits.device).unsqueeze(1)
+        logits = apply_repetition_penalty(logits, window, penalty)
+
+    sampler = TokenSampler(
+        len(seqs), logits.size(-1), logits.device,
+        do_sample=[seq.do_sample for seq in seqs],
+        temperature=[seq.temperature for seq in seqs],
+        top_k=[seq.top_k for seq in seqs],
+        top_p=[seq.top_p for seq in seqs],
+    )
+    return sampler(logits).tolist()
+
+
+class ContinuousBatchScheduler:
+    """
+    In-process scheduler that batches concurrent generation requests for one model.
+
+    A background thread owns the model while there is work: each iteration admits
+    pending requests into free KV cache slots, prefills the next chunk of every prompt
+    still being prefilled (the whole prompt unless `prefill_chunk_size` is set), runs a
+    single decode step for every active sequence with per-row positions, and retires
+    sequences that hit EOS or their `max_new_tokens`. Requests with different prompt
+    lengths and generation limits therefore share each forward pass, and a long prompt
+    delays running requests by at most one chunk per step.
+
+    Usage:
+        scheduler = ContinuousBatchScheduler(lambda: pool.lease("sabiyarn-translate"))
+        output_ids = scheduler.submit(prompt_ids, max_new_tokens=80).result()
+    """
+
+    def __init__(
+        self,
+        acquire_model: Callable[[], AbstractContextManager],
+        max_batch_size: int = 8,
+        max_seq_len: int = 1024,
+        prefix_cache: Optional[PrefixKVCache] = None,
+        session_cache: Optional[SessionKVCache] = None,
+        prefill_chunk_size: Optional[int] = None,
+    ):
+        """
+        Args:
+            acquire_model: Zero-argument callable returning a context manager that yields
+                the model (e.g. a ModelPool lease). It is held while the scheduler has work.
+            max_batch_size: Maximum number of sequences decoded together (KV cache slots)
+            max_seq_len: Maximum prompt + generated length of a sequence
+            prefix_cache: Optional prefix KV cache; prompts then only prefill the tokens
+                after their longest cached prefix. Must be dedicated to this model.
+            session_cache: Optional session KV store; requests submitted with a
+                `session_id` reuse the K/V of that session's previous turn and save theirs
+                when they finish. Must be dedicated to this model.
+            prefill_chunk_size: Optional number of prompt tokens prefilled per scheduler
+                step. Bounds prefill activation memory and the stall a long prompt causes
+                for the sequences already decoding; None prefills each prompt in one pass.
+        """
+        self._acquire_model = acquire_model
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len
+        self.prefix_cache = prefix_cache
+        self.session_cache = session_cache
+        self.prefill_chunk_size = prefill_chunk_size
+
+        self._pending: Deque[_Sequence] = deque()
+        self._exclusive: Deque[tuple] = deque()
+        self._beam: Deque[tuple] = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt_ids: List[int],
+        max_new_tokens: int = 80,
+        do_sample: bool = False,
+        temperature: float = 1.0,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        repetition_penalty: float = 1.0,
+        eos_token_id: Optional[int] = None,
+        on_token: Optional[Callable[[int], None]] = None,
+        session_id: Optional[str] = None,
+        repetition_penalty_window: Optional[int] = REPETITION_PENALTY_WINDOW,
+    ) -> Future:
+        """
+        Queue a generation request.
+        Prompts that do not fit `max_seq_len` together with `max_new_tokens` are
+        truncated from the left, like GPTJXForCausalLM.generate crops to block_size.
+        `on_token`, if given, is called on the scheduler thread with every new token id
+        (used for streaming); it should return quickly.
+        With a `session_id` (and a session cache), the prompt is expected to extend the
+        session's previous turn, and only the newly appended tokens are prefilled.
+        `repetition_penalty_window` is the number of most recent tokens (prompt included)
+        the repetition penalty covers; the default matches GPTJXForCausalLM.generate, and
+        None penalizes the whole prompt and every generated token, like the transformers
+        RepetitionPenaltyLogitsProcessor.
+
+        Returns:
+            Future resolving to the token ids (prompt followed by generated tokens)
+        """
+        max_new_tokens = max(1, min(max_new_tokens, self.max_seq_len - 1))
+        prompt_ids = list(prompt_ids)[-(self.max_seq_len - max_new_tokens):]
+        seq = _Sequence(
+            prompt_ids, max_new_tokens, do_sample, temperature, top_k, top_p,
+            repetition_penalty, eos_token_id, on_token, session_id, repetition_penalty_window,
+        )
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Scheduler has been shut down")
+            self._pending.append(seq)
+            self._cond.notify()
+        return seq.future
+
+    def run_exclusive(self, fn: Callable[[Any], Any]) -> Future:
+        """
+        Run `fn(model)` on the scheduler thread with the model to itself.
+        New admissions pause until the active batch drains, so `fn` can use the model's
+        KV cache freely (e.g. beam search through `model.generate`).
+        """
+        future: Future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Scheduler has been shut down")
+            self._exclusive.append((fn, future))
+            self._cond.notify()
+        return future
+
+    def submit_beam(self, prompt_ids: List[int], **generate_kwargs) -> Future:
+        """
+        Queue a beam search request (`generate_kwargs` as for `model.generate`, with
+        num_beams > 1). Beam search does not join the decode batch: like `run_exclusive`,
+        it waits for the batch to drain and holds admissions while it runs. All queued
+        beam requests with the same settings (up to max_batch_size) then run as one
+        left-padded `generate` call, so concurrent beam traffic pays one stall per group
+        instead of one per request.
+
+        Returns:
+            Future resolving to the token ids (prompt followed by generated tokens, up to
+            and including EOS), like `model.generate(...)[0]` for the prompt alone
+        """
+        key = tuple(sorted(generate_kwargs.items()))
+        future: Future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Scheduler has been shut down")
+            self._beam.append((key, list(prompt_ids), generate_kwargs, future))
+            self._cond.notify()
+        return future
+
+    def shutdown(self):
+        """Stop the scheduler thread once current work is finished."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._pending or self._exclusive or self._beam or self._stopped):
+                    self._cond.wait()
+                if self._stopped and not (self._pending or self._exclusive or self._beam):
+                    return
+            try:
+                with self._acquire_model() as model:
+                    self._serve(model)
+            except Exception as e:
+                # Failures outside a single request (acquiring the model, setting up its
+                # KV cache, storing a session) must not kill this thread and leave every
+                # future hanging: fail the queued work with the error and keep serving
+                self._fail_queued(e)
+
+    def _fail_queued(self, error: Exception):
+        """Resolve every pending request, exclusive job and beam request with `error`."""
+        with self._cond:
+            pending, self._pending = list(self._pending), deque()
+            exclusive, self._exclusive = list(self._exclusive), deque()
+            beam, self._beam = list(self._beam), deque()
+        for seq in pending:
+            seq.future.set_exception(error)
+        for _, future in exclusive:
+            future.set_exception(error)
+        for *_, future in beam:
+            future.set_exception(error)
+
+    @torch.no_grad()
+    def _serve(self, model):
+        """
+        Step the batch until there is no pending, active or exclusive work left.
+        An error outside a single sequence's prefill/decode fails every in-flight sequence
+        and is re-raised to `_run`.
+        """
+        model.setup_kv_cache(self.max_batch_size, self.max_seq_len)
+        device = next(model.parameters()).device
+        free_slots = list(range(self.max_batch_size))
+        prefilling: List[_Sequence] = []
+        active: List[_Sequence] = []
+        try:
+            while True:
+                exclusive = None
+                beam_group: List[tuple] = []
+                admitted: List[_Sequence] = []
+                with self._cond:
+                    if self._exclusive or self._beam:
+                        # Drain the batch before handing the model to an exclusive job
+                        # or a group of beam requests
+                        if not (active or prefilling):
+                            if self._exclusive:
+                                exclusive = self._exclusive.popleft()
+                            else:
+                                beam_group = self._pop_beam_group()
+                    else:
+                        while self._pending and free_slots and len(admitted) < len(free_slots):
+                            admitted.append(self._pending.popleft())
+                    if not (active or prefilling or admitted or exclusive or beam_group):
+                        return
+
+                if exclusive is not None:
+                    fn, future = exclusive
+                    try:
+                        future.set_result(fn(model))
+                    except Exception as e:
+                        future.set_exception(e)
+                    continue
+                if beam_group:
+                    self._run_beam_group(model, beam_group, device)
+                    continue
+
+                for seq in admitted:
+                    seq.slot = free_slots.pop()
+                    prefilling.append(seq)
+
+                still_prefilling = []
+                for seq in prefilling:
+                    try:
+                        done = self._prefill_chunk(model, seq, device)
+                    except Exception as e:
+                        self._fail(model, seq, free_slots, e)
+                        continue
+                    if done:
+                        active.append(seq)
+                    else:
+                        still_prefilling.append(seq)
+                prefilling = still_prefilling
+                active = self._retire(model, active, free_slots)
+
+                if active:
+                    try:
+                        self._decode_step(model, active, device)
+                    except Exception as e:
+                        for seq in active:
+                            self._fail(model, seq, free_slots, e)
+                        active = []
+                    active = self._retire(model, active, free_slots)
+        except Exception as e:
+            for seq in prefilling + active:
+                if not seq.future.done():
+                    self._fail(model, seq, free_slots, e)
+            raise
+
+    def _pop_beam_group(self) -> List[tuple]:
+        """Take the oldest beam request and the queued ones with the same settings (under _cond)."""
+        key = self._beam[0][0]
+        group, rest = [], deque()
+        for request in self._beam:
+            if request[0] == key and len(group) < self.max_batch_size:
+                group.append(request)
+            else:
+                rest.append(request)
+        self._beam = rest
+        return group
+
+    @staticmethod
+    def _run_beam_group(model, group: List[tuple], device: torch.device):
+        """Beam-search a group of requests as one left-padded batch and resolve them."""
+        futures = [future for *_, future in group]
+        try:
+            generate_kwargs = group[0][2]
+            prompts = [prompt_ids for _, prompt_ids, _, _ in group]
+            width = max(len(ids) for ids in prompts)
+            input_ids = torch.zeros(len(prompts), width, dtype=torch.long)
+            attention_mask = torch.zeros_like(input_ids)
+            for row, ids in enumerate(prompts):
+                input_ids[row, width - len(ids):] = torch.tensor(ids)
+                attention_mask[row, width - len(ids):] = 1
+            generated = model.generate(
+                input_ids.to(device), attention_mask=attention_mask.to(device), **generate_kwargs
+            )[:, width:].tolist()
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        eos_token_id = generate_kwargs.get("eos_token_id", 1)  # generate()'s default
+        for prompt_ids, new_ids, future in zip(prompts, generated, futures):
+            # Shorter hypotheses are padded with EOS; keep the first one
+            if eos_token_id in new_ids:
+                new_ids = new_ids[:new_ids.index(eos_token_id) + 1]
+            future.set_result(prompt_ids + new_ids)
+
+    @staticmethod
+    def _fail(model, seq: _Sequence, free_slots: List[int], error: Exception):
+        """Resolve a sequence with `error` and free its KV cache slot."""
+        model.release_kv(seq.slot)
+        free_slots.append(seq.slot)
+        seq.future.set_exception(error)
+
+    def _retire(self, model, active: List[_Sequence], free_slots: List[int]) -> List[_Sequence]:
+        """Resolve finished sequences, free their slots and return the ones still running."""
+        still_active = []
+        for seq in active:
+            if seq.is_finished():
+                if seq.session_id is not None and self.session_cache is not None:
+                    # The last token was sampled but never fed, so it has no K/V yet
+                    processed = len(seq.tokens) - 1
+                    kv = model.export_kv(seq.slot, 0, processed)
+                    self.session_cache.store(seq.session_id, seq.tokens[:processed], kv)
+                model.release_kv(seq.slot)
+                free_slots.append(seq.slot)
+                seq.future.set_result(seq.tokens)
+            else:
+                still_active.append(seq)
+        return still_active
+
+    def _reuse_cached_kv(self, model, seq: _Sequence):
+        """
+        Copy the longest cached prefix of the prompt (session history first, then shared
+        prompt-template prefix) into the sequence's cache slot, so prefill can skip it.
+        At least one prompt token is always left to prefill, to get next-token logits.
+        """
+        prompt_len = len(seq.tokens)
+        cached, kv = 0, None
+        if seq.session_id is not None and self.session_cache is not None:
+            cached, kv = self.session_cache.match(
+                seq.session_id, seq.tokens, max_length=prompt_len - 1
+            )
+        if not cached and self.prefix_cache is not None:
+            cached, kv = self.prefix_cache.match(seq.tokens, max_length=prompt_len - 1)
+        if cached:
+            model.import_kv(seq.slot, kv)
+        seq.num_prefilled = seq.num_cached = cached
+
+    def _prefill_chunk(self, model, seq: _Sequence, device: torch.device) -> bool:
+        """
+        Run the next chunk of the prompt into the sequence's cache slot. The first call
+        reuses cached K/V; after the last chunk, the K/V of the part of the prompt that
+        earlier prompts share is added to the prefix cache and the first token is picked.
+
+        Returns:
+            True once the whole prompt is prefilled
+        """
+        if seq.num_cached is None:
+            # Looked up right before prefilling, so prompts admitted together can hit
+            # what the ones before them just inserted
+            self._reuse_cached_kv(model, seq)
+
+        prompt_len = seq.prompt_len
+        end = prompt_len
+        if self.prefill_chunk_size:
+            end = min(prompt_len, seq.num_prefilled + self.prefill_chunk_size)
+        idx = torch.tensor([seq.tokens[seq.num_prefilled:end]], dtype=torch.long, device=device)
+        # The chunk continues after what is cached: positions and causal mask start there
+        logits = model.prefill(
+            idx, seq.num_prefilled, cache_slots=torch.tensor([seq.slot], device=device)
+        )
+        seq.num_prefilled = end
+        if end < prompt_len:
+            return False
+
+        if self.prefix_cache is not None:
+            # Only the part of the prompt an earlier prompt shares is exported and cached;
+            # a one-off prompt is just remembered in case it repeats
+            cached = seq.num_cached
+            shared = self.prefix_cache.observe(seq.tokens)
+            if shared > cached:
+                self.prefix_cache.insert(
+                    seq.tokens[:shared], model.export_kv(seq.slot, cached, shared), offset=cached
+                )
+        seq.append(sample_next_tokens(logits, [seq])[0])
+        return True
+
+    def _decode_step(self, model, active: List[_Sequence], device: torch.device):
+        """One forward pass for every active sequence, each at its own position."""
+        idx = torch.tensor([[seq.tokens[-1]] for seq in active], dtype=torch.long, device=device)
+        start_pos = torch.tensor([len(seq.tokens) - 1 for seq in active], device=device)
+        slots = torch.tensor([seq.slot for seq in active], device=device)
+        logits = model(idx, start_pos, cache_slots=slots, return_logits_only=True)
+        for seq, token in zip(active, sample_next_tokens(logits[:, -1], active)):
+            seq.append(token)
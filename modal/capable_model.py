@@ -5,12 +5,21 @@ Deploy to different workspaces: naijaai, pauljeffrey, model-host
 
 import modal
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from typing import List, Dict, Any, Optional
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import re
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+from batching import ContinuousBatchScheduler
+from model_pool import ModelPool
+from sabiyarn_optimized import GPTJXForCausalLM
+from session_cache import SessionKVCache
+from streaming import IncrementalDetokenizer, StreamCleaner, sse_event
+
 # Create Modal app
 app = modal.App("sabiyarn-capable")
 
@@ -25,6 +34,10 @@ image = (
         "uvicorn==0.24.0",
         "pydantic==2.5.0",
     )
+    .add_local_python_source(
+        "model_pool", "batching", "prefix_cache", "session_cache", "streaming",
+        "sabiyarn_optimized",
+    )
 )
 
 # Model repository mapping for capable models (to be added when available)
@@ -36,103 +49,213 @@ CAPABLE_MODEL_REPOS: Dict[str, str] = {
 
 END_OF_TOKEN_ID = 32
 
+DEFAULT_MODEL_ID = "sabiyarn-32k"
 
-@app.function(
+# Continuous batching limits. The KV cache is paged, so memory follows the tokens in
+# flight rather than MAX_BATCH_SIZE full 32k-token rows.
+MAX_BATCH_SIZE = 8
+MAX_SEQ_LEN = 32768
+# Long chat histories are prefilled this many tokens per scheduler step, bounding
+# activation memory and the stall they cause for conversations already decoding
+PREFILL_CHUNK_SIZE = 512
+
+
+def load_sabiyarn(repo_name: str, device: str) -> GPTJXForCausalLM:
+    """Load a checkpoint into the local GPTJXForCausalLM (needed for KV cache import/export)."""
+    model = GPTJXForCausalLM.from_pretrained(repo_name).to(device)
+    model.eval()
+    return model
+
+
+def clean_response(text: str) -> str:
+    """Collapse blank-line runs in a chat response."""
+    return re.sub(r"\n\n+", "\n", text)
+
+
+def build_gen_config(config: Optional[Dict[str, Any]], tokenizer) -> Dict[str, Any]:
+    """Translate the frontend generation config into generate() keyword arguments."""
+    cfg = config or {}
+    return {
+        "max_new_tokens": int(cfg.get("maxNewTokens", 256)),
+        "temperature": float(cfg.get("temperature", 0.7)),
+        "top_p": float(cfg.get("topP", 0.9)),
+        "top_k": max(1, int(cfg.get("topK", 50))),
+        "repetition_penalty": float(cfg.get("repetitionPenalty", 1.1)),
+        "do_sample": bool(cfg.get("doSample", True)),
+        "pad_token_id": tokenizer.eos_token_id,
+        "eos_token_id": END_OF_TOKEN_ID,
+    }
+
+
+def session_name_for(messages: List[Dict[str, str]]) -> str:
+    """Generate session name from first user message."""
+    session_name = "New Chat"
+    if messages and len(messages) > 0:
+        first_user_msg = next(
+            (msg["content"] for msg in messages if msg["role"] == "user"),
+            "New Chat"
+        )
+        session_name = first_user_msg[:30] + ("..." if len(first_user_msg) > 30 else "")
+    return session_name
+
+
+@app.cls(
     image=image,
     gpu="T4",
     timeout=600,
     scaledown_window=300,
 )
-def chat_completion(
-    model_id: str,
-    messages: List[Dict[str, str]],
-    session_id: str,
-    config: Optional[Dict[str, Any]] = None,
-) -> Dict[str, str]:
+@modal.concurrent(max_inputs=16)
+class CapableModels:
     """
-    Generate chat completion with conversation history.
-    This will be implemented when capable models are available.
+    Serves the capable chat models from a long-lived container.
+    Each model has a ContinuousBatchScheduler with a SessionKVCache, so a conversation's
+    K/V stays resident between turns and each turn only prefills the newly appended
+    messages instead of the whole history.
     """
-    # Check if model exists
-    if model_id not in CAPABLE_MODEL_REPOS:
-        raise ValueError(f"Model {model_id} not found")
-    
-    repo_name = CAPABLE_MODEL_REPOS[model_id]
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    
-    try:
-        # Load model
-        tokenizer = AutoTokenizer.from_pretrained(repo_name, trust_remote_code=True)
-        model = AutoModelForCausalLM.from_pretrained(
-            repo_name, trust_remote_code=True
-        ).to(device)
-        model.eval()
-        
-        # Format conversation
-        # conversation = ""
-        # for msg in messages:
-        #     role = msg["role"]
-        #     content = msg["content"]
-        #     if role == "user":
-        #         conversation += f"User: {content}\n"
-        #     elif role == "assistant":
-        #         conversation += f"Assistant: {content}\n"
-        
-        # conversation += "Assistant: "
-        
-        
-        
-        # Tokenize
-        input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt").to(device)
-        
-        cfg = config or {}
-        max_new_tokens = int(cfg.get("maxNewTokens", 256))
-        temperature = float(cfg.get("temperature", 0.7))
-        top_p = float(cfg.get("topP", 0.9))
-        top_k = max(1, int(cfg.get("topK", 50)))
-        repetition_penalty = float(cfg.get("repetitionPenalty", 1.1))
-        do_sample = bool(cfg.get("doSample", True))
-
-        # Generate
-        gen_config = {
-            "max_new_tokens": max_new_tokens,
-            "temperature": temperature,
-            "top_p": top_p,
-            "top_k": top_k,
-            "repetition_penalty": repetition_penalty,
-            "do_sample": do_sample,
-            "pad_token_id": tokenizer.eos_token_id,
-            "eos_token_id": END_OF_TOKEN_ID,
-        }
-        
-        with torch.no_grad():
-            output = model.generate(input_ids, **gen_config)
-        
-        # Decode only the newly generated tokens after the prompt
-        prompt_length = input_ids.shape[-1]
-        generated_tokens = output[0, prompt_length:]
-        response = tokenizer.decode(generated_tokens, skip_special_tokens=True).strip()
-        
-        # Clean up
-        response = re.sub(r"\n\n+", "\n", response)
-        response = response.strip()
-        
-        # Generate session name from first user message
-        session_name = "New Chat"
-        if messages and len(messages) > 0:
-            first_user_msg = next(
-                (msg["content"] for msg in messages if msg["role"] == "user"),
-                "New Chat"
+
+    @modal.enter()
+    def load(self):
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.pool = ModelPool(
+            CAPABLE_MODEL_REPOS,
+            tokenizer_repo=CAPABLE_MODEL_REPOS[DEFAULT_MODEL_ID],
+            device=device,
+            loader=load_sabiyarn,
+        )
+        self.schedulers: Dict[str, ContinuousBatchScheduler] = {}
+        self._schedulers_lock = threading.Lock()
+
+    def _scheduler(self, model_id: str) -> ContinuousBatchScheduler:
+        """Batch scheduler (with its session KV store) for `model_id`."""
+        with self._schedulers_lock:
+            if model_id not in self.schedulers:
+                self.schedulers[model_id] = ContinuousBatchScheduler(
+                    lambda: self.pool.lease(model_id),
+                    max_batch_size=MAX_BATCH_SIZE,
+                    max_seq_len=MAX_SEQ_LEN,
+                    session_cache=SessionKVCache(),
+                    prefill_chunk_size=PREFILL_CHUNK_SIZE,
+                )
+            return self.schedulers[model_id]
+
+    def _submit(
+        self,
+        model_id: str,
+        messages: List[Dict[str, str]],
+        session_id: str,
+        config: Optional[Dict[str, Any]],
+        on_token=None,
+    ) -> Tuple[int, Future]:
+        """
+        Tokenize the conversation and queue it on the model's scheduler.
+
+        Returns:
+            (prompt_length, future): the future resolves to prompt + generated token ids
+        """
+        if model_id not in CAPABLE_MODEL_REPOS:
+            raise ValueError(f"Model {model_id} not found")
+
+        tokenizer = self.pool.tokenizer
+        input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+        gen_config = build_gen_config(config, tokenizer)
+        future = self._scheduler(model_id).submit(
+            input_ids,
+            max_new_tokens=gen_config["max_new_tokens"],
+            do_sample=gen_config["do_sample"],
+            temperature=gen_config["temperature"],
+            top_k=gen_config["top_k"],
+            top_p=gen_config["top_p"],
+            repetition_penalty=gen_config["repetition_penalty"],
+            eos_token_id=gen_config["eos_token_id"],
+            on_token=on_token,
+            session_id=session_id,
+            # Chat was served by transformers' generate(), which penalizes repeats over the
+            # whole conversation; keep that instead of generate()'s recent-token window
+            repetition_penalty_window=None,
+        )
+        return len(input_ids), future
+
+    @modal.method()
+    def chat_completion(
+        self,
+        model_id: str,
+        messages: List[Dict[str, str]],
+        session_id: str,
+        config: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, str]:
+        """
+        Generate chat completion with conversation history.
+        Turns of the same `session_id` reuse the K/V cached for the previous turn.
+        """
+        try:
+            prompt_length, future = self._submit(model_id, messages, session_id, config)
+            output = future.result()
+
+            # Decode only the newly generated tokens after the prompt
+            response = self.pool.tokenizer.decode(
+                output[prompt_length:], skip_special_tokens=True
+            ).strip()
+
+            # Clean up
+            response = clean_response(response)
+            response = response.strip()
+
+            return {
+                "output": response,
+                "session_name": session_name_for(messages),
+            }
+
+        except ValueError:
+            raise
+        except Exception as e:
+            raise Exception(f"Error generating chat response: {str(e)}")
+
+    @modal.method()
+    def chat_completion_stream(
+        self,
+        model_id: str,
+        messages: List[Dict[str, str]],
+        session_id: str,
+        config: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        """
+        Streaming variant of chat_completion.
+        Yields cleaned response text as tokens are decoded; the concatenated chunks equal
+        the `output` returned by chat_completion.
+        """
+        try:
+            tokens: "queue.Queue[Optional[int]]" = queue.Queue()
+            _, future = self._submit(
+                model_id, messages, session_id, config, on_token=tokens.put
             )
-            session_name = first_user_msg[:30] + ("..." if len(first_user_msg) > 30 else "")
-        
-        return {
-            "output": response,
-            "session_name": session_name,
-        }
-        
-    except Exception as e:
-        raise Exception(f"Error generating chat response: {str(e)}")
+            future.add_done_callback(lambda _: tokens.put(None))
+
+            detokenizer = IncrementalDetokenizer(self.pool.tokenizer)
+            cleaner = StreamCleaner(clean_response)
+            while (token := tokens.get()) is not None:
+                chunk = cleaner.feed(detokenizer.push([token]))
+                if chunk:
+                    yield chunk
+            future.result()
+
+            chunk = cleaner.flush()
+            if chunk:
+                yield chunk
+
+        except ValueError:
+            raise
+        except Exception as e:
+            raise Exception(f"Error generating chat response: {str(e)}")
+
+    @modal.method()
+    def session_stats(self) -> Dict[str, dict]:
+        """Session KV cache usage per model in this container."""
+        with self._schedulers_lock:
+            return {
+                model_id: scheduler.session_cache.stats()
+                for model_id, scheduler in self.schedulers.items()
+            }
 
 
 # FastAPI app
@@ -155,7 +278,7 @@ async def predict(request: ChatRequest):
             )
         
         # Call Modal function asynchronously
-        result = await chat_completion.remote.aio(
+        result = await CapableModels().chat_completion.remote.aio(
             request.model,
             request.messages,
             request.session_id,
@@ -170,6 +293,36 @@ async def predict(request: ChatRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@web_app.post("/predict/stream")
+async def predict_stream(request: ChatRequest):
+    """
+    Streaming chat endpoint (Server-Sent Events).
+    Emits `data: {"token": "..."}` messages as the response is generated, then an
+    `event: done` message carrying the session name, or an `event: error` message.
+    """
+    if not CAPABLE_MODEL_REPOS:
+        raise HTTPException(
+            status_code=503,
+            detail="Capable models are not yet available. They will be released in the next 3 months."
+        )
+    if request.model not in CAPABLE_MODEL_REPOS:
+        raise HTTPException(status_code=404, detail=f"Model {request.model} not found")
+    
+    async def events():
+        try:
+            async for chunk in CapableModels().chat_completion_stream.remote_gen.aio(
+                request.model,
+                request.messages,
+                request.session_id,
+                request.config
+            ):
+                yield sse_event({"token": chunk})
+            yield sse_event({"session_name": session_name_for(request.messages)}, event="done")
+        except Exception as e:
+            yield sse_event({"detail": str(e)}, event="error")
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @web_app.get("/health")
 async def health():
     """Health check endpoint"""
@@ -0,0 +1,538 @@
+"""
+Per-container model pool for the SabiYarn Modal deployments.
+Models are loaded once and kept resident under a memory budget with LRU eviction,
+so requests no longer pay for `from_pretrained` on every call.
+"""
+
+import copy
+import gc
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import torch
+from torch import nn
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+# Default memory budget for resident models. Nine fp32 SabiYarn-125M variants need
+# roughly 4.5GB, which fits comfortably on a T4.
+DEFAULT_MEMORY_BUDGET_MB = int(os.environ.get("SABIYARN_POOL_MEMORY_MB", "6144"))
+
+# Shared-base delta settings (see SharedBaseModelPool)
+DEFAULT_SPARSE_DENSITY = float(os.environ.get("SABIYARN_DELTA_SPARSE_DENSITY", "0.05"))
+DEFAULT_MAX_RANK = int(os.environ.get("SABIYARN_DELTA_MAX_RANK", "128"))
+# Low-rank deltas are lossy, so they are off unless a positive tolerance is opted into
+# (check the resulting variants with parity.py / quantization.evaluate_quality first)
+DEFAULT_LOWRANK_TOLERANCE = float(os.environ.get("SABIYARN_DELTA_LOWRANK_TOL", "0"))
+# Live model instances a shared-base pool keeps before swapping variants into them
+DEFAULT_MAX_INSTANCES = int(os.environ.get("SABIYARN_POOL_MAX_INSTANCES", "2"))
+
+
+def model_nbytes(model: nn.Module) -> int:
+    """
+    Return the resident size of a model's parameters and buffers in bytes.
+    Tied weights (wte / lm_head) share storage and are only counted once. Packed int8
+    weights of quantized modules (see quantization.py) are not parameters; they are
+    counted from the state dict.
+    """
+    tensors = list(model.parameters()) + list(model.buffers())
+    for name, value in model.state_dict(keep_vars=True).items():
+        if "_packed_params" in name:
+            values = value if isinstance(value, tuple) else (value,)
+            tensors.extend(t for t in values if isinstance(t, torch.Tensor))
+    seen = set()
+    total = 0
+    for tensor in tensors:
+        ptr = tensor.data_ptr()
+        if ptr in seen:
+            continue
+        seen.add(ptr)
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def _default_loader(repo_name: str, device: str) -> nn.Module:
+    """Load a model from the HuggingFace Hub and move it to `device` in eval mode."""
+    model = AutoModelForCausalLM.from_pretrained(repo_name, trust_remote_code=True).to(device)
+    model.eval()
+    return model
+
+
+class ModelPool:
+    """
+    Long-lived pool of models, shared by every request handled by a container.
+
+    All SabiYarn variants use the `sabiyarn-125m` tokenizer, so a single tokenizer
+    instance is shared across the pool. Models are loaded lazily on first use and the
+    least recently used ones are evicted once the memory budget is exceeded.
+    Models that are currently leased (see `lease()`) are never evicted, and neither is
+    the most recently requested one, so the budget is a soft limit.
+    Checkpoints are loaded outside the pool lock: a cold model only blocks the requests
+    waiting for that same model, never leases of resident ones.
+    """
+
+    def __init__(
+        self,
+        repos: Dict[str, str],
+        tokenizer_repo: str,
+        device: str,
+        memory_budget_mb: int = DEFAULT_MEMORY_BUDGET_MB,
+        loader: Optional[Callable[[str, str], nn.Module]] = None,
+    ):
+        """
+        Args:
+            repos: Mapping of model id to HuggingFace repository name
+            tokenizer_repo: Repository of the tokenizer shared by every model
+            device: Device models are placed on ("cuda" or "cpu")
+            memory_budget_mb: Upper bound on resident model memory, in megabytes
+            loader: Optional callable (repo_name, device) -> model, mainly for tests
+        """
+        self.repos = dict(repos)
+        self.tokenizer_repo = tokenizer_repo
+        self.device = device
+        self.memory_budget_bytes = memory_budget_mb * 1024 ** 2
+        self._loader = loader or _default_loader
+
+        self._tokenizer = None
+        # model_id -> (model, size in bytes), ordered from least to most recently used
+        self._models: "OrderedDict[str, Tuple[nn.Module, int]]" = OrderedDict()
+        # model_id -> number of active leases
+        self._leases: Dict[str, int] = {}
+        # model_id -> future resolved once its in-progress load is done
+        self._loading: Dict[str, Future] = {}
+        self._lock = threading.RLock()
+
+        # Counters exposed through stats() for the health endpoint
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    @property
+    def tokenizer(self):
+        """Shared tokenizer, loaded on first access."""
+        if self._tokenizer is None:
+            with self._lock:
+                if self._tokenizer is None:
+                    self._tokenizer = AutoTokenizer.from_pretrained(
+                        self.tokenizer_repo, trust_remote_code=True
+                    )
+        return self._tokenizer
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(size for _, size in self._models.values())
+
+    def get(self, model_id: str) -> nn.Module:
+        """
+        Return the resident model for `model_id`, loading it if necessary.
+        Prefer `lease()` when the model is used outside the caller's own thread of control,
+        since an unleased model may be evicted (or, for shared-base pools, overwritten).
+
+        Raises:
+            KeyError: If `model_id` is not a known model
+        """
+        return self._acquire(model_id, lease=False)
+
+    def _acquire(self, model_id: str, lease: bool) -> nn.Module:
+        """
+        Return the model for `model_id` (counting a lease if asked), loading it if needed.
+        The first caller for a cold model loads it without holding the pool lock; later
+        callers for the same model wait for that load instead of starting another.
+        """
+        if model_id not in self.repos:
+            raise KeyError(f"Unknown model: {model_id}")
+
+        while True:
+            with self._lock:
+                if model_id in self._models:
+                    self._models.move_to_end(model_id)
+                    self.hits += 1
+                    if lease:
+                        self._leases[model_id] = self._leases.get(model_id, 0) + 1
+                    return self._models[model_id][0]
+                loading = self._loading.get(model_id)
+                if loading is None:
+                    self._loading[model_id] = Future()
+                    break
+            # Another thread is loading this model; a failed load fails its waiters too.
+            # Once it is done, look again (it may already have been evicted).
+            loading.result()
+
+        try:
+            loaded = self._load_model(model_id)
+            with self._lock:
+                model = self._admit_model(model_id, loaded)
+                self._models[model_id] = (model, model_nbytes(model))
+                self.loads += 1
+                if lease:
+                    self._leases[model_id] = self._leases.get(model_id, 0) + 1
+                self._evict_over_budget()
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(model_id).set_exception(e)
+            raise
+        with self._lock:
+            self._loading.pop(model_id).set_result(None)
+        return model
+
+    @contextmanager
+    def lease(self, model_id: str) -> Iterator[nn.Module]:
+        """
+        Context manager that pins `model_id` in the pool while it is in use.
+
+        Usage:
+            with pool.lease("sabiyarn-translate") as model:
+                model.generate(...)
+        """
+        model = self._acquire(model_id, lease=True)
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self._leases[model_id] -= 1
+                if self._leases[model_id] == 0:
+                    del self._leases[model_id]
+                self._evict_over_budget()
+
+    def preload(self, model_ids: Iterable[str]):
+        """Load the given models ahead of the first request (e.g. in a container enter hook)."""
+        self.tokenizer
+        for model_id in model_ids:
+            self.get(model_id)
+
+    def evict(self, model_id: str):
+        """Drop `model_id` from the pool if it is resident and not leased."""
+        with self._lock:
+            if model_id in self._leases:
+                return
+            if self._models.pop(model_id, None) is not None:
+                self.evictions += 1
+                self._release_memory()
+
+    def resident_models(self) -> List[str]:
+        """Resident model ids, from least to most recently used."""
+        with self._lock:
+            return list(self._models.keys())
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "resident": list(self._models.keys()),
+                "resident_mb": round(self.resident_bytes / 1024 ** 2, 1),
+                "budget_mb": round(self.memory_budget_bytes / 1024 ** 2, 1),
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+    def _load_model(self, model_id: str) -> Any:
+        """
+        Slow part of bringing `model_id` in (downloading and loading its checkpoint).
+        Called without the pool lock, by one thread at a time per model id; the result is
+        passed to `_admit_model`.
+        """
+        return self._loader(self.repos[model_id], self.device)
+
+    def _admit_model(self, model_id: str, loaded: Any) -> nn.Module:
+        """Turn the result of `_load_model` into the resident model. Called with the pool lock held."""
+        return loaded
+
+    def _eviction_candidate(self) -> Optional[str]:
+        """Least recently used model that is neither leased nor the most recent one."""
+        for model_id in list(self._models.keys())[:-1]:
+            if model_id not in self._leases:
+                return model_id
+        return None
+
+    def _evict_over_budget(self):
+        """Evict least recently used models until the pool fits the budget."""
+        evicted = False
+        while self.resident_bytes > self.memory_budget_bytes:
+            model_id = self._eviction_candidate()
+            if model_id is None:
+                break
+            del self._models[model_id]
+            self.evictions += 1
+            evicted = True
+        if evicted:
+            self._release_memory()
+
+    def _release_memory(self):
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+class TensorDelta:
+    """
+    Compact difference between a finetuned tensor and the shared base tensor.
+
+    Three encodings are used, whichever is smallest for the tensor at hand:
+        - "sparse":  flat indices and values of the changed entries (exact)
+        - "lowrank": factors U (m, r) and V (r, n) with delta ~= U @ V (lossy, only
+                     used with a positive `lowrank_tolerance`)
+        - "dense":   the finetuned tensor itself (exact)
+
+    The encoded tensors live in host memory (pinned when `compute` is asked to, for
+    asynchronous copies) and are moved to the model's device only while being applied.
+    """
+
+    __slots__ = ("kind", "tensors")
+
+    def __init__(self, kind: str, tensors: Tuple[torch.Tensor, ...]):
+        self.kind = kind
+        self.tensors = tensors
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.tensors)
+
+    def apply_(self, target: torch.Tensor, base: torch.Tensor):
+        """Overwrite `target` in place with base + delta."""
+        if self.kind == "dense":
+            target.copy_(self.tensors[0], non_blocking=True)
+            return
+        target.copy_(base)
+        tensors = [t.to(target.device, non_blocking=True) for t in self.tensors]
+        if self.kind == "sparse":
+            indices, values = tensors
+            target.view(-1).index_add_(0, indices, values)
+        else:
+            u, v = tensors
+            target.addmm_(u, v)
+
+    @classmethod
+    def compute(
+        cls,
+        base: torch.Tensor,
+        target: torch.Tensor,
+        sparse_density: float,
+        max_rank: int,
+        lowrank_tolerance: float,
+        pin_memory: bool = False,
+    ) -> Optional["TensorDelta"]:
+        """
+        Encode target - base, or return None if the tensors are identical.
+
+        Args:
+            base: Tensor of the shared base model
+            target: Same tensor in the finetuned variant
+            sparse_density: Maximum fraction of changed entries for the sparse encoding
+            max_rank: Maximum rank for the low-rank encoding (0 disables it)
+            lowrank_tolerance: Maximum relative Frobenius error of the low-rank delta
+                (0 keeps every delta exact)
+            pin_memory: Keep the encoded tensors in pinned host memory (CUDA base)
+        """
+        def host(tensor: torch.Tensor) -> torch.Tensor:
+            tensor = tensor.to("cpu").contiguous()
+            return tensor.pin_memory() if pin_memory else tensor
+
+        target = target.to(device=base.device, dtype=base.dtype)
+        diff = target - base
+        changed = diff != 0
+        nnz = int(changed.sum())
+        if nnz == 0:
+            return None
+
+        if nnz <= sparse_density * diff.numel():
+            indices = changed.view(-1).nonzero().squeeze(1)
+            return cls("sparse", (host(indices), host(diff.view(-1)[indices])))
+
+        if diff.dim() == 2 and max_rank > 0 and lowrank_tolerance > 0:
+            m, n = diff.shape
+            u, s, vh = torch.linalg.svd(diff.float(), full_matrices=False)
+            # Relative error of the rank-r truncation is sqrt(sum(s[r:]^2) / sum(s^2))
+            energy = s.pow(2)
+            tail = energy.flip(0).cumsum(0).flip(0) / energy.sum()
+            rank = next(
+                (r for r in range(1, min(max_rank, s.numel()) + 1)
+                 if r == s.numel() or math.sqrt(tail[r].item()) <= lowrank_tolerance),
+                None,
+            )
+            if rank is not None and rank * (m + n) < m * n:
+                u = (u[:, :rank] * s[:rank]).to(base.dtype)
+                return cls("lowrank", (host(u), host(vh[:rank].to(base.dtype))))
+
+        return cls("dense", (host(target),))
+
+
+class SharedBaseModelPool(ModelPool):
+    """
+    Model pool that stores one base checkpoint plus compact per-variant deltas.
+
+    Every SabiYarn-125M finetune shares the GPTJXForCausalLM architecture, so each
+    variant is kept as a `TensorDelta` per changed tensor against the base model
+    instead of a full copy. Deltas are kept in host memory. At most `max_instances`
+    model instances are materialized from base + delta on the device. Beyond that, or
+    when the budget is reached, the least recently used unleased instance is rebuilt in
+    place for the requested variant rather than freed and reloaded with
+    `from_pretrained`. Variant checkpoints are only downloaded once, to compute their
+    deltas. The base (template) model and all deltas count against the memory budget
+    together with the instances.
+    """
+
+    def __init__(
+        self,
+        repos: Dict[str, str],
+        tokenizer_repo: str,
+        device: str,
+        base_model_id: str,
+        memory_budget_mb: int = DEFAULT_MEMORY_BUDGET_MB,
+        loader: Optional[Callable[[str, str], nn.Module]] = None,
+        sparse_density: float = DEFAULT_SPARSE_DENSITY,
+        max_rank: int = DEFAULT_MAX_RANK,
+        lowrank_tolerance: float = DEFAULT_LOWRANK_TOLERANCE,
+        max_instances: int = DEFAULT_MAX_INSTANCES,
+    ):
+        """
+        Args:
+            base_model_id: Model id whose checkpoint is the shared base
+            sparse_density: See `TensorDelta.compute`
+            max_rank: See `TensorDelta.compute`
+            lowrank_tolerance: See `TensorDelta.compute`. The default 0 keeps variants
+                bit-exact (sparse or dense deltas only); a positive value trades accuracy
+                for memory and should be validated with parity.py / evaluate_quality.
+            max_instances: Live model instances before variants are swapped into existing
+                ones (exceeded only while every instance is leased)
+            Remaining arguments are the same as for `ModelPool`.
+        """
+        super().__init__(repos, tokenizer_repo, device, memory_budget_mb, loader)
+        self.base_model_id = base_model_id
+        self.sparse_density = sparse_density
+        self.max_rank = max_rank
+        self.lowrank_tolerance = lowrank_tolerance
+        self.max_instances = max_instances
+
+        self._template: Optional[nn.Module] = None
+        self._base_lock = threading.Lock()
+        self._base_state: Dict[str, torch.Tensor] = {}
+        self._deltas: Dict[str, Dict[str, TensorDelta]] = {}
+        # id(model) -> model id currently materialized in that instance
+        self._materialized: Dict[int, str] = {}
+        self.swaps = 0
+        self._base_bytes = 0
+        self._delta_bytes = 0
+
+    @staticmethod
+    def _named_tensors(model: nn.Module) -> Dict[str, torch.Tensor]:
+        """Parameters and buffers by name. Tied weights appear once (under their first name)."""
+        tensors = dict(model.named_parameters())
+        tensors.update(model.named_buffers())
+        return tensors
+
+    def _ensure_base(self):
+        """Load the base (template) model once. Called without the pool lock."""
+        with self._base_lock:
+            if self._template is None:
+                # The template is never handed out, so its tensors double as the base state
+                template = self._loader(self.repos[self.base_model_id], self.device)
+                with self._lock:
+                    self._base_state = {
+                        name: tensor.detach()
+                        for name, tensor in self._named_tensors(template).items()
+                    }
+                    self._deltas[self.base_model_id] = {}
+                    self._base_bytes = model_nbytes(template)
+                    self._template = template
+
+    def _delta_for(self, model_id: str) -> Dict[str, TensorDelta]:
+        """
+        Per-tensor deltas of `model_id` against the base, computed on first use.
+        The first use comes from `_load_model`, without the pool lock.
+        """
+        if model_id not in self._deltas:
+            variant = self._loader(self.repos[model_id], "cpu")
+            variant_state = self._named_tensors(variant)
+            deltas = {}
+            with torch.no_grad():
+                for name, base in self._base_state.items():
+                    delta = TensorDelta.compute(
+                        base, variant_state[name],
+                        self.sparse_density, self.max_rank, self.lowrank_tolerance,
+                        pin_memory=base.is_cuda,
+                    )
+                    if delta is not None:
+                        deltas[name] = delta
+            with self._lock:
+                self._deltas[model_id] = deltas
+                self._delta_bytes += sum(delta.nbytes for delta in deltas.values())
+            del variant, variant_state
+            gc.collect()
+        return self._deltas[model_id]
+
+    @torch.no_grad()
+    def _materialize(self, model: nn.Module, model_id: str):
+        """Rebuild `model` in place as `model_id`, touching only tensors either variant changed."""
+        previous = self._materialized.get(id(model))
+        new_deltas = self._delta_for(model_id)
+        names = set(new_deltas)
+        if previous is not None:
+            names |= set(self._deltas[previous])
+        tensors = self._named_tensors(model)
+        for name in names:
+            if name in new_deltas:
+                new_deltas[name].apply_(tensors[name].data, self._base_state[name])
+            else:
+                tensors[name].data.copy_(self._base_state[name])
+        self._materialized[id(model)] = model_id
+
+    def _load_model(self, model_id: str):
+        # Load the base and compute the delta without the pool lock: either may download a
+        # checkpoint, and neither should hold an instance
+        self._ensure_base()
+        self._delta_for(model_id)
+
+    def _admit_model(self, model_id: str, loaded: Any) -> nn.Module:
+        # Recycle the least recently used instance if another one would exceed the instance
+        # cap or the budget
+        instance_bytes = self._base_bytes
+        over_budget = self.resident_bytes + instance_bytes > self.memory_budget_bytes
+        if len(self._models) >= self.max_instances or over_budget:
+            victim_id = self._eviction_candidate_for_swap()
+            if victim_id is not None:
+                model, _ = self._models.pop(victim_id)
+                self._materialize(model, model_id)
+                self.swaps += 1
+                return model
+
+        model = copy.deepcopy(self._template)
+        self._materialized[id(model)] = self.base_model_id
+        self._materialize(model, model_id)
+        return model
+
+    @property
+    def resident_bytes(self) -> int:
+        """Live instances plus the base model and every delta."""
+        return super().resident_bytes + self._base_bytes + self._delta_bytes
+
+    def _eviction_candidate_for_swap(self) -> Optional[str]:
+        for model_id in self._models.keys():
+            if model_id not in self._leases:
+                return model_id
+        return None
+
+    def _evict_over_budget(self):
+        super()._evict_over_budget()
+        # Forget bookkeeping for instances that are no longer resident
+        live = {id(model) for model, _ in self._models.values()}
+        for key in [key for key in self._materialized if key not in live]:
+            del self._materialized[key]
+
+    def stats(self) -> Dict[str, object]:
+        stats = super().stats()
+        with self._lock:
+            stats.update({
+                "base_mb": round(self._base_bytes / 1024 ** 2, 1),
+                "delta_mb": {
+                    model_id: round(sum(d.nbytes for d in deltas.values()) / 1024 ** 2, 1)
+                    for model_id, deltas in self._deltas.items()
+                },
+                "instances": len(self._models),
+                "max_instances": self.max_instances,
+                "swaps": self.swaps,
+            })
+        return stats
@@ -0,0 +1,95 @@
+"""
+Numerical parity checks between the optimized SabiYarn model and the reference.
+
+sabiyarn_exact_match.py reproduces the original implementation (full forward, logits of
+the last position only). The helpers here run the same input through the optimized
+GPTJXForCausalLM along each of its inference paths (full forward with all or only the
+last logits, chunked prefill into the KV cache, incremental decode) and report how far
+its last-position logits are from the reference.
+
+Usage:
+    python parity.py --repo BeardedMonster/SabiYarn-125M --text "<prompt> Bawo ni <response>:"
+"""
+
+import argparse
+from typing import Dict
+
+import torch
+
+# Maximum absolute logit difference accepted as parity (float32 reassociation noise)
+DEFAULT_ATOL = 1e-3
+
+
+@torch.no_grad()
+def compare_logits(model, reference, input_ids: torch.Tensor, atol: float = DEFAULT_ATOL) -> Dict[str, object]:
+    """
+    Compare the optimized model's last-position logits with the reference model's.
+
+    Args:
+        model: sabiyarn_optimized.GPTJXForCausalLM
+        reference: sabiyarn_exact_match.GPTJXForCausalLM with the same weights (its
+            config.max_batch_size must be at least B)
+        input_ids: Token ids of shape (B, T), T >= 2
+        atol: Largest absolute difference still reported as a match
+
+    Returns:
+        Maximum absolute logit difference per path ("all_logits", "logits_to_keep",
+        "chunked_prefill", "decode"), plus "max_abs_diff" and "match"
+    """
+    model.eval()
+    reference.eval()
+    bsz, t = input_ids.size()
+    expected = reference(input_ids).logits[:, -1].float()
+
+    results = {}
+    results["all_logits"] = model(input_ids, use_cache=False, return_logits_only=True)[:, -1]
+    results["logits_to_keep"] = model(
+        input_ids, use_cache=False, return_logits_only=True, logits_to_keep=1
+    )[:, -1]
+
+    # Internal KV cache paths
+    if bsz > model.kv_max_batch_size:
+        model.setup_kv_cache(bsz, model.kv_cache_len)
+    model.clear_kv_cache()
+    results["chunked_prefill"] = model.prefill(input_ids, chunk_size=max(1, t // 3))
+    model.clear_kv_cache()
+    model.prefill(input_ids[:, :-1])
+    results["decode"] = model(
+        input_ids[:, -1:], t - 1, return_logits_only=True, logits_to_keep=1
+    )[:, -1]
+    model.clear_kv_cache()
+
+    report: Dict[str, object] = {
+        path: (logits.float() - expected).abs().max().item() for path, logits in results.items()
+    }
+    report["max_abs_diff"] = max(report.values())
+    report["match"] = report["max_abs_diff"] <= atol
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repo", default="BeardedMonster/SabiYarn-125M", help="Checkpoint to load into both models")
+    parser.add_argument("--text", default="<prompt> Bawo ni o se wa? <response>:", help="Prompt to compare on")
+    parser.add_argument("--atol", type=float, default=DEFAULT_ATOL)
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+
+    import sabiyarn_exact_match
+    import sabiyarn_optimized
+
+    tokenizer = AutoTokenizer.from_pretrained(args.repo)
+    model = sabiyarn_optimized.GPTJXForCausalLM.from_pretrained(args.repo)
+    reference = sabiyarn_exact_match.GPTJXForCausalLM.from_pretrained(args.repo)
+    input_ids = torch.tensor([tokenizer.encode(args.text)])
+
+    report = compare_logits(model, reference, input_ids, atol=args.atol)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    if not report["match"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
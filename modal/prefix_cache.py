@@ -0,0 +1,264 @@
+"""
+Prefix KV cache for SabiYarn prompt templates.
+
+Task prompts share fixed templates (e.g. `<prompt> {} <response>:` and language tags),
+so their leading tokens produce identical keys/values in every request. This cache
+stores per-layer K/V slices in a radix tree keyed on token ids, letting a new request
+copy its longest cached prefix into its KV cache slot and prefill only the suffix.
+Only prefixes that more than one prompt shares are cached: a prompt's token ids are
+first just remembered (without K/V), and K/V are exported and stored only for the part a
+later prompt repeats, so one-off prompts neither pay for a copy nor churn the budget.
+Entries are evicted least-recently-used first once the byte budget (or the budget of
+remembered tokens) is exceeded.
+"""
+
+import itertools
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+KV = List[Tuple[torch.Tensor, torch.Tensor]]
+
+# Default byte budget for cached K/V slices
+DEFAULT_PREFIX_CACHE_MB = 256
+
+# Token ids of prompt tails seen only once that are remembered (without K/V)
+DEFAULT_TRACKED_TOKENS = 65536
+
+
+class _RadixNode:
+    """
+    Radix tree node; `kv` holds the K/V of the tokens on the edge leading to it, or is None
+    for an edge seen in a single prompt so far (tracked only). Tracked nodes never have
+    cached descendants.
+    """
+
+    __slots__ = ("tokens", "kv", "children", "parent", "last_access")
+
+    def __init__(self, tokens: Tuple[int, ...], kv: Optional[KV], parent: Optional["_RadixNode"]):
+        self.tokens = tokens
+        self.kv = kv
+        self.children: Dict[int, "_RadixNode"] = {}
+        self.parent = parent
+        self.last_access = 0
+
+    @property
+    def nbytes(self) -> int:
+        if self.kv is None:
+            return 0
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in self.kv)
+
+
+def _slice_kv(kv: KV, start: int, end: Optional[int] = None) -> KV:
+    return [(k[:, start:end], v[:, start:end]) for k, v in kv]
+
+
+class PrefixKVCache:
+    """
+    Radix tree of token-id prefixes to per-layer K/V slices.
+
+    Usage (see ContinuousBatchScheduler):
+        length, kv = cache.match(prompt_ids)       # longest cached prefix
+        model.import_kv(slot, kv)                  # reuse it, prefill prompt_ids[length:]
+        shared = cache.observe(prompt_ids)         # prefix an earlier prompt also had
+        if shared > length:
+            cache.insert(prompt_ids[:shared], model.export_kv(slot, length, shared), offset=length)
+
+    K/V depend on the model weights, so a cache must only be used with a single model.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_PREFIX_CACHE_MB * 1024 ** 2,
+        max_tracked_tokens: int = DEFAULT_TRACKED_TOKENS,
+    ):
+        self.max_bytes = max_bytes
+        self.max_tracked_tokens = max_tracked_tokens
+        self.total_bytes = 0
+        self.tracked_tokens = 0
+        self._root = _RadixNode((), None, None)
+        self._clock = itertools.count(1)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+
+    def match(self, token_ids: Sequence[int], max_length: Optional[int] = None) -> Tuple[int, Optional[KV]]:
+        """
+        Find the longest cached prefix of `token_ids` (at most `max_length` tokens).
+
+        Returns:
+            (length, kv): number of matched tokens and their per-layer K/V, each of shape
+            (n_heads, length, head_dim); kv is None when nothing matched
+        """
+        limit = len(token_ids) if max_length is None else min(max_length, len(token_ids))
+        with self._lock:
+            node, matched, segments = self._root, 0, []
+            now = next(self._clock)
+            while matched < limit:
+                child = node.children.get(token_ids[matched])
+                if child is None or child.kv is None:
+                    break
+                common = 0
+                for a, b in zip(child.tokens, token_ids[matched:limit]):
+                    if a != b:
+                        break
+                    common += 1
+                child.last_access = now
+                segments.append(_slice_kv(child.kv, 0, common))
+                matched += common
+                if common < len(child.tokens):
+                    break
+                node = child
+
+            if matched == 0:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            self.hit_tokens += matched
+            kv = [
+                (torch.cat([seg[layer][0] for seg in segments], dim=1),
+                 torch.cat([seg[layer][1] for seg in segments], dim=1))
+                for layer in range(len(segments[0]))
+            ]
+            return matched, kv
+
+    def observe(self, token_ids: Sequence[int]) -> int:
+        """
+        Remember `token_ids` as seen and return how many of its leading tokens an earlier
+        prompt already had (cached or only remembered): the prefix worth caching.
+        """
+        token_ids = tuple(int(t) for t in token_ids)
+        with self._lock:
+            node, i = self._root, 0
+            now = next(self._clock)
+            while i < len(token_ids):
+                child = node.children.get(token_ids[i])
+                if child is None:
+                    break
+                common = 0
+                for a, b in zip(child.tokens, token_ids[i:]):
+                    if a != b:
+                        break
+                    common += 1
+                if common < len(child.tokens):
+                    child = self._split(child, common)
+                child.last_access = now
+                node, i = child, i + common
+            shared = i
+            if i < len(token_ids):
+                tail = _RadixNode(token_ids[i:], None, node)
+                tail.last_access = now
+                node.children[token_ids[i]] = tail
+                self.tracked_tokens += len(tail.tokens)
+            self._evict()
+            return shared
+
+    def insert(self, token_ids: Sequence[int], kv: KV, offset: int = 0):
+        """
+        Cache the K/V of `token_ids`.
+
+        Args:
+            token_ids: Full token sequence
+            kv: Per-layer K/V for token_ids[offset:], each of shape (n_heads, L, head_dim)
+            offset: Number of leading tokens `kv` does not cover; they must already be
+                cached (typically the length returned by `match`)
+        """
+        token_ids = tuple(int(t) for t in token_ids)
+        with self._lock:
+            node, i = self._root, 0
+            now = next(self._clock)
+            while i < len(token_ids):
+                child = node.children.get(token_ids[i])
+                if child is None:
+                    if i < offset:
+                        # The covered prefix was evicted meanwhile; nothing to attach to
+                        return
+                    leaf_kv = [(k.clone(), v.clone()) for k, v in _slice_kv(kv, i - offset)]
+                    leaf = _RadixNode(token_ids[i:], leaf_kv, node)
+                    leaf.last_access = now
+                    node.children[token_ids[i]] = leaf
+                    self.total_bytes += leaf.nbytes
+                    break
+                common = 0
+                for a, b in zip(child.tokens, token_ids[i:]):
+                    if a != b:
+                        break
+                    common += 1
+                if common < len(child.tokens):
+                    child = self._split(child, common)
+                if child.kv is None:
+                    if i < offset:
+                        return
+                    # A remembered prefix repeats: store its K/V now
+                    child.kv = [(k.clone(), v.clone()) for k, v in _slice_kv(kv, i - offset, i - offset + common)]
+                    self.tracked_tokens -= common
+                    self.total_bytes += child.nbytes
+                child.last_access = now
+                node, i = child, i + common
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._root = _RadixNode((), None, None)
+            self.total_bytes = 0
+            self.tracked_tokens = 0
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "cached_mb": round(self.total_bytes / 1024 ** 2, 1),
+            "budget_mb": round(self.max_bytes / 1024 ** 2, 1),
+            "tracked_tokens": self.tracked_tokens,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_tokens": self.hit_tokens,
+        }
+
+    @staticmethod
+    def _split(node: _RadixNode, at: int) -> _RadixNode:
+        """Split `node`'s edge after `at` tokens; returns the new upper node."""
+        # Clone both halves so evicting one of them actually frees its memory
+        upper_kv = None
+        if node.kv is not None:
+            upper_kv = [(k.clone(), v.clone()) for k, v in _slice_kv(node.kv, 0, at)]
+        upper = _RadixNode(node.tokens[:at], upper_kv, node.parent)
+        upper.last_access = node.last_access
+        node.parent.children[node.tokens[0]] = upper
+        node.tokens = node.tokens[at:]
+        if node.kv is not None:
+            node.kv = [(k.clone(), v.clone()) for k, v in _slice_kv(node.kv, at)]
+        node.parent = upper
+        upper.children[node.tokens[0]] = node
+        return upper
+
+    def _leaves(self) -> List[_RadixNode]:
+        leaves, stack = [], list(self._root.children.values())
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            else:
+                leaves.append(node)
+        return leaves
+
+    def _evict(self):
+        """Drop least recently used leaves until the cache fits its budgets."""
+        while self.total_bytes > self.max_bytes and self._drop_oldest(self._leaves()):
+            pass
+        while self.tracked_tokens > self.max_tracked_tokens and self._drop_oldest(
+            [leaf for leaf in self._leaves() if leaf.kv is None]
+        ):
+            pass
+
+    def _drop_oldest(self, leaves: List[_RadixNode]) -> bool:
+        """Remove the least recently used of `leaves`; False if there is none."""
+        if not leaves:
+            return False
+        leaf = min(leaves, key=lambda n: n.last_access)
+        del leaf.parent.children[leaf.tokens[0]]
+        self.total_bytes -= leaf.nbytes
+        if leaf.kv is None:
+            self.tracked_tokens -= len(leaf.tokens)
+        return True
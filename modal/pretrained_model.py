@@ -4,12 +4,22 @@ Deploy to different workspaces: naijaai, pauljeffrey, model-host
 """
 
 import modal
+import os
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
 import re
+import queue
+import threading
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from batching import ContinuousBatchScheduler
+from model_pool import ModelPool, SharedBaseModelPool
+from prefix_cache import PrefixKVCache
+from quantization import quantize_int8
+from sabiyarn_optimized import GPTJXForCausalLM
+from streaming import IncrementalDetokenizer, StreamCleaner, sse_event
 
 # Create Modal app
 app = modal.App("sabiyarn-fastapi-app")
@@ -25,6 +35,9 @@ image = (
         "uvicorn==0.24.0",
         "pydantic==2.5.0",
     )
+    .add_local_python_source(
+        "model_pool", "batching", "prefix_cache", "quantization", "streaming", "sabiyarn_optimized"
+    )
 )
 
 # Model repository mapping
@@ -41,31 +54,106 @@ MODEL_REPOS: Dict[str, str] = {
 }
 END_OF_TOKEN_ID= 32
 
-@app.function(
+DEFAULT_MODEL_ID = "sabiyarn-125m"
+
+# Continuous batching limits per model variant
+MAX_BATCH_SIZE = 16
+MAX_SEQ_LEN = 1024
+# Byte budget of each variant's prefix KV cache (shared prompt template tokens)
+PREFIX_CACHE_MB = 256
+# Texts scored per forward pass by the /classify endpoint
+CLASSIFY_BATCH_SIZE = 16
+# Prompts decoded together (left padded) by generate_batch for offline jobs
+OFFLINE_BATCH_SIZE = 64
+# CPU-only containers serve int8 dynamically quantized models (see quantization.py)
+QUANTIZE_ON_CPU = os.environ.get("SABIYARN_CPU_INT8", "1") == "1"
+
+# Artifacts removed from generated text
+OUTPUT_CLEANUP_PATTERN = re.compile(
+    r"\|(end_f_text|end_of_text|end_ofext|end_of_text_|end_of_te|end_o|end_of_tet|end_oftext)|:|`"
+)
+# Longest match of OUTPUT_CLEANUP_PATTERN ("|end_of_text_"), used when streaming
+OUTPUT_CLEANUP_MAX_LEN = 13
+
+
+def clean_output(text: str) -> str:
+    """Remove end-of-text artifacts, colons and backticks from generated text."""
+    return OUTPUT_CLEANUP_PATTERN.sub("", text)
+
+
+def load_sabiyarn(repo_name: str, device: str) -> GPTJXForCausalLM:
+    """Load a checkpoint into the local GPTJXForCausalLM (needed for per-row KV cache slots)."""
+    model = GPTJXForCausalLM.from_pretrained(repo_name).to(device)
+    model.eval()
+    return model
+
+
+def load_sabiyarn_int8(repo_name: str, device: str) -> GPTJXForCausalLM:
+    """load_sabiyarn followed by int8 dynamic quantization (CPU only)."""
+    return quantize_int8(load_sabiyarn(repo_name, device))
+
+
+@app.cls(
     image=image,
     gpu="T4",
     timeout=600,
     scaledown_window=300,
 )
-def generate_text(model_id: str, prompt: str, config: dict) -> str:
+@modal.concurrent(max_inputs=64)
+class PretrainedModels:
     """
-    Load model and generate text.
-    Models are loaded on-demand per request.
+    Serves every pretrained/finetuned SabiYarn variant from one container.
+    Models live in a per-container pool, so weights are loaded once rather than per request.
+    The pool keeps one SabiYarn-125M base checkpoint plus compact per-variant deltas, and
+    switches variants by rebuilding an idle resident model in place. On CPU-only boxes
+    (QUANTIZE_ON_CPU) every variant is loaded as an int8 dynamically quantized model instead.
+    Concurrent requests for the same variant share decode steps through a
+    ContinuousBatchScheduler.
     """
-    repo_name = MODEL_REPOS.get(model_id, MODEL_REPOS["sabiyarn-125m"])
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    
-    try:
-        # Load tokenizer and model
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_REPOS["sabiyarn-125m"], trust_remote_code=True)
-        model = AutoModelForCausalLM.from_pretrained(
-            repo_name, trust_remote_code=True
-        ).to(device)
-        model.eval()
-        
+
+    @modal.enter()
+    def load(self):
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if device == "cpu" and QUANTIZE_ON_CPU:
+            # Int8 weights cannot take the shared-base deltas, so every variant is loaded
+            # on its own (at about a third of its fp32 size)
+            self.pool = ModelPool(
+                MODEL_REPOS,
+                tokenizer_repo=MODEL_REPOS[DEFAULT_MODEL_ID],
+                device=device,
+                loader=load_sabiyarn_int8,
+            )
+        else:
+            self.pool = SharedBaseModelPool(
+                MODEL_REPOS,
+                tokenizer_repo=MODEL_REPOS[DEFAULT_MODEL_ID],
+                device=device,
+                base_model_id=DEFAULT_MODEL_ID,
+                loader=load_sabiyarn,
+            )
+        self.pool.preload([DEFAULT_MODEL_ID])
+        self.schedulers: Dict[str, ContinuousBatchScheduler] = {}
+        self._schedulers_lock = threading.Lock()
+
+    def _scheduler(self, model_id: str) -> ContinuousBatchScheduler:
+        """Batch scheduler for `model_id`; it leases the model from the pool while busy."""
+        with self._schedulers_lock:
+            if model_id not in self.schedulers:
+                self.schedulers[model_id] = ContinuousBatchScheduler(
+                    lambda: self.pool.lease(model_id),
+                    max_batch_size=MAX_BATCH_SIZE,
+                    max_seq_len=MAX_SEQ_LEN,
+                    prefix_cache=PrefixKVCache(PREFIX_CACHE_MB * 1024 ** 2),
+                )
+            return self.schedulers[model_id]
+
+    def _prepare(self, model_id: str, prompt: str, config: dict) -> Tuple[str, List[int], dict]:
+        """Resolve the model id, tokenize the prompt and build the generation config."""
+        if model_id not in MODEL_REPOS:
+            model_id = DEFAULT_MODEL_ID
+
         # Prepare generation config
         gen_config = {
-            "max_length": config.get("maxLength", 100),
             "max_new_tokens": config.get("maxNewTokens", 80),
             "num_beams": config.get("numBeams", 5),
             "do_sample": config.get("doSample", False),
@@ -77,29 +165,193 @@ def generate_text(model_id: str, prompt: str, config: dict) -> str:
             "early_stopping": True,
             "eos_token_id": END_OF_TOKEN_ID,
         }
-        
+
         # Tokenize input
-        input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"].to(device)
-        
-        # Generate
-        with torch.no_grad():
-            output = model.generate(input_ids, **gen_config)
-        
-        # Decode output
-        generated_text = tokenizer.decode(output[0], skip_special_tokens=True)
-        
-        # Clean up output
-        generated_text = re.sub(
-            r"\|(end_f_text|end_of_text|end_ofext|end_of_text_|end_of_te|end_o|end_of_tet|end_oftext)|:|`",
-            "",
-            generated_text
+        prompt_ids = self.pool.tokenizer(prompt)["input_ids"]
+        return model_id, prompt_ids, gen_config
+
+    def _run_beam_search(self, model_id: str, prompt_ids: List[int], gen_config: dict) -> List[int]:
+        """
+        Beam search runs between decode batches; concurrent beam requests with the same
+        settings are grouped into one call (see ContinuousBatchScheduler.submit_beam).
+        """
+        return self._scheduler(model_id).submit_beam(prompt_ids, **gen_config).result()
+
+    def _submit(self, model_id: str, prompt_ids: List[int], gen_config: dict, on_token=None):
+        """Queue a greedy/sampling request on the variant's batch scheduler."""
+        return self._scheduler(model_id).submit(
+            prompt_ids,
+            max_new_tokens=gen_config["max_new_tokens"],
+            do_sample=gen_config["do_sample"],
+            temperature=gen_config["temperature"],
+            top_k=gen_config["top_k"],
+            top_p=gen_config["top_p"],
+            repetition_penalty=gen_config["repetition_penalty"],
+            eos_token_id=END_OF_TOKEN_ID,
+            on_token=on_token,
         )
-        generated_text = generated_text.strip("\n")
-        
-        return generated_text
-        
-    except Exception as e:
-        raise Exception(f"Error generating text: {str(e)}")
+
+    @modal.method()
+    def generate_text(self, model_id: str, prompt: str, config: dict) -> str:
+        """
+        Generate text with a pooled model.
+        Unknown model ids fall back to the base SabiYarn-125M model.
+        """
+        try:
+            model_id, prompt_ids, gen_config = self._prepare(model_id, prompt, config)
+
+            # Generate
+            if gen_config["num_beams"] > 1:
+                output = self._run_beam_search(model_id, prompt_ids, gen_config)
+            else:
+                output = self._submit(model_id, prompt_ids, gen_config).result()
+
+            # Decode output
+            generated_text = self.pool.tokenizer.decode(output, skip_special_tokens=True)
+
+            # Clean up output
+            generated_text = clean_output(generated_text)
+            generated_text = generated_text.strip("\n")
+
+            return generated_text
+
+        except Exception as e:
+            raise Exception(f"Error generating text: {str(e)}")
+
+    @modal.method()
+    def generate_text_stream(self, model_id: str, prompt: str, config: dict) -> Iterator[str]:
+        """
+        Same as generate_text, but yields the cleaned text incrementally as tokens are
+        decoded. The concatenated chunks equal the generate_text output.
+        Beam search cannot stream, so beam requests yield their text in one chunk.
+        """
+        try:
+            model_id, prompt_ids, gen_config = self._prepare(model_id, prompt, config)
+            detokenizer = IncrementalDetokenizer(self.pool.tokenizer)
+            cleaner = StreamCleaner(
+                clean_output,
+                strip_chars="\n",
+                match_starts="|",
+                max_match_len=OUTPUT_CLEANUP_MAX_LEN,
+            )
+
+            # generate_text returns the prompt followed by the completion
+            chunk = cleaner.feed(detokenizer.push(prompt_ids))
+            if chunk:
+                yield chunk
+
+            if gen_config["num_beams"] > 1:
+                output = self._run_beam_search(model_id, prompt_ids, gen_config)
+                chunk = cleaner.feed(detokenizer.push(output[len(prompt_ids):]))
+                if chunk:
+                    yield chunk
+            else:
+                tokens: "queue.Queue[Optional[int]]" = queue.Queue()
+                future = self._submit(model_id, prompt_ids, gen_config, on_token=tokens.put)
+                future.add_done_callback(lambda _: tokens.put(None))
+                while (token := tokens.get()) is not None:
+                    chunk = cleaner.feed(detokenizer.push([token]))
+                    if chunk:
+                        yield chunk
+                future.result()
+
+            chunk = cleaner.flush()
+            if chunk:
+                yield chunk
+
+        except Exception as e:
+            raise Exception(f"Error generating text: {str(e)}")
+
+    @modal.method()
+    def generate_batch(self, model_id: str, prompts: List[str], config: dict) -> List[str]:
+        """
+        Generate for many prompts at once (offline jobs such as bulk translation).
+        Prompts are left padded into batches of OFFLINE_BATCH_SIZE and decoded with one
+        generate() call per batch, every row keeping its own positions. Beam requests are
+        queued together and beam-searched in left-padded groups of up to MAX_BATCH_SIZE
+        prompts (see ContinuousBatchScheduler.submit_beam).
+
+        Returns:
+            One cleaned output per prompt, in order, like generate_text
+        """
+        try:
+            outputs = []
+            for begin in range(0, len(prompts), OFFLINE_BATCH_SIZE):
+                batch = [
+                    self._prepare(model_id, prompt, config)
+                    for prompt in prompts[begin:begin + OFFLINE_BATCH_SIZE]
+                ]
+                variant, _, gen_config = batch[0]
+                prompt_ids = [ids for _, ids, _ in batch]
+                if gen_config["num_beams"] > 1:
+                    scheduler = self._scheduler(variant)
+                    futures = [scheduler.submit_beam(ids, **gen_config) for ids in prompt_ids]
+                    outputs.extend(future.result() for future in futures)
+                    continue
+
+                width = max(len(ids) for ids in prompt_ids)
+                input_ids = torch.zeros(len(prompt_ids), width, dtype=torch.long)
+                attention_mask = torch.zeros_like(input_ids)
+                for row, ids in enumerate(prompt_ids):
+                    input_ids[row, width - len(ids):] = torch.tensor(ids)
+                    attention_mask[row, width - len(ids):] = 1
+                input_ids = input_ids.to(self.pool.device)
+                attention_mask = attention_mask.to(self.pool.device)
+                generated = self._scheduler(variant).run_exclusive(
+                    lambda model: model.generate(
+                        input_ids, attention_mask=attention_mask, **gen_config
+                    )[:, width:].tolist()
+                ).result()
+                for ids, new_ids in zip(prompt_ids, generated):
+                    # Rows that finished early are padded with EOS; keep the first one
+                    if END_OF_TOKEN_ID in new_ids:
+                        new_ids = new_ids[:new_ids.index(END_OF_TOKEN_ID) + 1]
+                    outputs.append(ids + new_ids)
+
+            return [
+                clean_output(self.pool.tokenizer.decode(output, skip_special_tokens=True)).strip("\n")
+                for output in outputs
+            ]
+
+        except Exception as e:
+            raise Exception(f"Error generating text: {str(e)}")
+
+    @modal.method()
+    def classify(self, model_id: str, texts: List[str], labels: List[str]) -> List[dict]:
+        """
+        Pick the most likely of `labels` for every text in one scoring pass per batch,
+        instead of beam-searching a free-form answer (sentiment/topic/language detection).
+        Texts must already be wrapped in the task template; each label is scored as the
+        continuation the model would generate (include a leading space if it emits one).
+
+        Returns:
+            One {"label": best_label, "scores": {label: probability}} dict per text
+        """
+        try:
+            if model_id not in MODEL_REPOS:
+                model_id = DEFAULT_MODEL_ID
+            tokenizer = self.pool.tokenizer
+            input_ids = [tokenizer(text)["input_ids"] for text in texts]
+            label_ids = [tokenizer(label)["input_ids"] for label in labels]
+
+            # Scoring shares the model with the variant's decode loop, so it runs between batches
+            probs = self._scheduler(model_id).run_exclusive(
+                lambda model: model.score_labels(input_ids, label_ids, batch_size=CLASSIFY_BATCH_SIZE)
+            ).result()
+
+            results = []
+            for row in probs.tolist():
+                scores = dict(zip(labels, row))
+                results.append({"label": max(scores, key=scores.get), "scores": scores})
+            return results
+
+        except Exception as e:
+            raise Exception(f"Error classifying text: {str(e)}")
+
+    @modal.method()
+    def pool_stats(self) -> dict:
+        """Resident models and load/eviction counters for this container."""
+        return self.pool.stats()
 
 
 # FastAPI app
@@ -115,7 +367,7 @@ async def predict(request: PredictRequest):
     """API endpoint for model prediction"""
     try:
         # Call Modal function asynchronously
-        output = await generate_text.remote.aio(
+        output = await PretrainedModels().generate_text.remote.aio(
             request.model,
             request.prompt,
             request.config
@@ -124,6 +376,50 @@ async def predict(request: PredictRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+class ClassifyRequest(BaseModel):
+    model: str
+    texts: List[str]
+    labels: List[str]
+
+@web_app.post("/classify")
+async def classify(request: ClassifyRequest):
+    """
+    Label scoring endpoint for the classification finetunes.
+    Returns the most likely label and the label probabilities for each text.
+    """
+    if not request.texts or not request.labels:
+        raise HTTPException(status_code=400, detail="texts and labels must not be empty")
+    try:
+        results = await PretrainedModels().classify.remote.aio(
+            request.model,
+            request.texts,
+            request.labels
+        )
+        return {"results": results}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@web_app.post("/predict/stream")
+async def predict_stream(request: PredictRequest):
+    """
+    Streaming API endpoint (Server-Sent Events).
+    Emits `data: {"token": "..."}` messages as text is generated, then an `event: done`
+    message, or an `event: error` message if generation fails.
+    """
+    async def events():
+        try:
+            async for chunk in PretrainedModels().generate_text_stream.remote_gen.aio(
+                request.model,
+                request.prompt,
+                request.config
+            ):
+                yield sse_event({"token": chunk})
+            yield sse_event({}, event="done")
+        except Exception as e:
+            yield sse_event({"detail": str(e)}, event="error")
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @web_app.get("/health")
 async def health():
     """Health check endpoint"""
@@ -0,0 +1,165 @@
+"""
+Int8 dynamic quantization of SabiYarn for CPU serving.
+
+On CPU, decoding is dominated by the fp32 weight reads of the nn.Linear layers
+(attention c_attn/c_proj, MLP c_fc/c_proj and the vocab_size x n_embd lm_head).
+`quantize_int8` swaps them for dynamically quantized int8 Linear layers: weights are
+stored as per-output-channel int8, activations are quantized on the fly per batch, and
+the matmuls run in int8 (fbgemm/x86 kernels). The token and position embeddings become
+int8 lookup tables with per-row float scales.
+
+The checkpoint ties `transformer.wte` and `lm_head` to one fp32 matrix. Each of the two
+modules is quantized from that matrix separately (row-wise for the lookup, per output
+channel for the projection), after which the fp32 copy is dropped, so the tie costs two
+int8 tables instead of one fp32 table.
+
+Usage:
+    python quantization.py --repo BeardedMonster/SabiYarn-125M [--texts-file heldout.txt]
+prints perplexity and next-token agreement of fp32 vs int8 on a held-out multilingual
+set, decode tokens/s of both, and their resident sizes.
+"""
+
+import argparse
+import copy
+import time
+from typing import Dict, List, Sequence
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.ao.quantization import (
+    float_qparams_weight_only_qconfig,
+    per_channel_dynamic_qconfig,
+    quantize_dynamic,
+)
+
+# Quantization scheme per module type
+QUANTIZED_MODULES = {
+    nn.Linear: per_channel_dynamic_qconfig,
+    nn.Embedding: float_qparams_weight_only_qconfig,
+}
+
+# Small default held-out set (one sentence per language); pass --texts-file for a real one
+HELDOUT_TEXTS = [
+    "Ẹ kú àárọ̀, ṣé dáadáa lẹ jí? Mo fẹ́ lọ sí ọjà lónìí láti ra ẹ̀wà àti ìrẹsì.",
+    "Kedu ka ị mere taa? Anyị ga-aga ahịa echi ka anyị zụta ji na ose.",
+    "Ina kwana? Yau za mu je kasuwa tare da 'yan uwana domin sayen shinkafa.",
+    "How you dey? I wan go market go buy rice and beans for my mama.",
+    "The farmers in the village harvested their yams before the rains began.",
+]
+
+# Tokens generated when measuring decode speed
+DEFAULT_BENCHMARK_TOKENS = 64
+
+
+def quantize_int8(model: nn.Module, inplace: bool = True) -> nn.Module:
+    """
+    Convert a CPU GPTJXForCausalLM to int8 dynamic quantization for inference.
+
+    Args:
+        model: Model on the CPU (quantized kernels are CPU only)
+        inplace: Convert `model` itself rather than a copy; the fp32 weights are freed
+
+    Returns:
+        The quantized model in eval mode. It supports inference only: no training, no
+        crop_block_size, and no in-place weight updates such as pool deltas.
+    """
+    if any(p.device.type != "cpu" for p in model.parameters()):
+        raise ValueError("Int8 dynamic quantization needs the model on the CPU")
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+    return quantize_dynamic(model, QUANTIZED_MODULES, dtype=torch.qint8, inplace=True)
+
+
+@torch.no_grad()
+def evaluate_quality(
+    reference: nn.Module, quantized: nn.Module, sequences: Sequence[List[int]]
+) -> Dict[str, float]:
+    """
+    Compare the quantized model with its fp32 reference on held-out token sequences.
+
+    Returns:
+        "fp32_ppl" and "int8_ppl" (perplexity over all sequences), "ppl_change" (relative)
+        and "top1_agreement" (fraction of positions with the same argmax prediction)
+    """
+    nll = {"fp32": 0.0, "int8": 0.0}
+    tokens = agree = 0
+    for ids in sequences:
+        if len(ids) < 2:
+            continue
+        x = torch.tensor([ids])
+        targets = x[0, 1:]
+        predictions = {}
+        for name, model in (("fp32", reference), ("int8", quantized)):
+            logits = model(x[:, :-1], use_cache=False, return_logits_only=True)[0].float()
+            nll[name] += F.cross_entropy(logits, targets, reduction="sum").item()
+            predictions[name] = logits.argmax(dim=-1)
+        tokens += targets.numel()
+        agree += (predictions["fp32"] == predictions["int8"]).sum().item()
+
+    fp32_ppl = float(torch.tensor(nll["fp32"] / tokens).exp())
+    int8_ppl = float(torch.tensor(nll["int8"] / tokens).exp())
+    return {
+        "fp32_ppl": fp32_ppl,
+        "int8_ppl": int8_ppl,
+        "ppl_change": int8_ppl / fp32_ppl - 1.0,
+        "top1_agreement": agree / tokens,
+    }
+
+
+@torch.no_grad()
+def decode_tokens_per_second(
+    model: nn.Module, input_ids: torch.Tensor, max_new_tokens: int = DEFAULT_BENCHMARK_TOKENS
+) -> float:
+    """
+    Greedy decode throughput of `model`, excluding the prompt prefill: the time of a
+    one-token generate() is subtracted from that of a max_new_tokens one.
+    """
+    def timed(num_tokens: int) -> float:
+        start = time.perf_counter()
+        model.generate(input_ids, max_new_tokens=num_tokens, do_sample=False, eos_token_id=None)
+        return time.perf_counter() - start
+
+    timed(4)  # warm-up
+    return (max_new_tokens - 1) / (timed(max_new_tokens) - timed(1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repo", default="BeardedMonster/SabiYarn-125M", help="Checkpoint to quantize")
+    parser.add_argument("--texts-file", help="Held-out texts, one per line (default: HELDOUT_TEXTS)")
+    parser.add_argument("--max-new-tokens", type=int, default=DEFAULT_BENCHMARK_TOKENS)
+    parser.add_argument("--threads", type=int, help="torch.set_num_threads for the benchmark")
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+
+    from model_pool import model_nbytes
+    from sabiyarn_optimized import GPTJXForCausalLM
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    texts = HELDOUT_TEXTS
+    if args.texts_file:
+        with open(args.texts_file, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    tokenizer = AutoTokenizer.from_pretrained(args.repo)
+    reference = GPTJXForCausalLM.from_pretrained(args.repo).eval()
+    quantized = quantize_int8(reference, inplace=False)
+    sequences = [tokenizer.encode(text)[:reference.config.block_size] for text in texts]
+
+    report: Dict[str, object] = dict(evaluate_quality(reference, quantized, sequences))
+    prompt = torch.tensor([sequences[0]])
+    report["fp32_tokens_per_s"] = decode_tokens_per_second(reference, prompt, args.max_new_tokens)
+    report["int8_tokens_per_s"] = decode_tokens_per_second(quantized, prompt, args.max_new_tokens)
+    report["speedup"] = report["int8_tokens_per_s"] / report["fp32_tokens_per_s"]
+    report["fp32_mb"] = model_nbytes(reference) / 1024 ** 2
+    report["int8_mb"] = model_nbytes(quantized) / 1024 ** 2
+    for key, value in report.items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
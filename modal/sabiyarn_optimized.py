@@ -6,14 +6,306 @@ Matches original implementation exactly for consistent outputs.
 
 from transformers import PretrainedConfig, PreTrainedModel, AutoConfig, AutoModelForCausalLM
 from transformers.modeling_outputs import CausalLMOutputWithPast
-from typing import List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 from torch import nn
 import torch
 import torch.nn.functional as F
+import functools
+import heapq
+import itertools
 import math
+from collections import OrderedDict
 
 repo_name = "BeardedMonster/SabiYarn-125M"
 
+# Number of most recent tokens the repetition penalty applies to
+REPETITION_PENALTY_WINDOW = 50
+
+# generate() checks whether every sequence hit EOS only every this many steps; the check
+# is the only host sync in the decode loop
+EOS_CHECK_INTERVAL = 8
+
+# Byte budget for causal masks kept by CausalMaskCache (non-flash attention only)
+DEFAULT_MASK_CACHE_MB = 512
+
+# Without SDPA, attention over more keys than this is computed in tiles of this size
+ATTENTION_CHUNK_SIZE = 1024
+
+# Keys/values of an int8 KV cache are dequantized inside attention in tiles of this many
+# positions (see quantized_attention). Each tile is one fused attention call and the
+# partial results are merged exactly, so the tile size only trades the size of the
+# transient float copy (tile x n_heads x head_dim per row) against the number of calls:
+# prefixes up to one tile take a single call, longer ones one call per tile.
+KV_DEQUANT_TILE = 256
+
+# Nucleus (top-p) sampling without top-k first looks for the nucleus among this many most
+# likely tokens, and falls back to the whole vocabulary when they hold less than top_p
+TOP_P_CANDIDATES = 1024
+
+# Prompt lookup decoding matches the last up to this many tokens against the sequence
+PROMPT_LOOKUP_MAX_NGRAM = 3
+
+# Tokens drafted per step by self-speculative (early exit) and draft-model decoding
+NUM_ASSISTANT_TOKENS = 4
+
+
+def apply_repetition_penalty(
+    logits: torch.Tensor, window: torch.Tensor, penalty: Union[float, torch.Tensor]
+) -> torch.Tensor:
+    """
+    Penalize every token that occurs in `window`: positive logits are divided by `penalty`
+    and negative ones multiplied. Runs as one gather/scatter on the device; a token that
+    occurs several times is penalized once, since every copy writes the same value.
+    
+    Args:
+        logits: Logits of shape (B, vocab_size)
+        window: Recent token ids of shape (B, W)
+        penalty: Repetition penalty (> 1.0 discourages repeats), or one per row as a
+                tensor of shape (B, 1)
+    """
+    penalized = logits.gather(1, window)
+    penalized = torch.where(penalized > 0, penalized / penalty, penalized * penalty)
+    return logits.scatter(1, window, penalized)
+
+
+def prompt_lookup_draft(
+    tokens: Sequence[int], num_tokens: int, max_ngram_size: int = PROMPT_LOOKUP_MAX_NGRAM
+) -> List[int]:
+    """
+    Draft a continuation by copying from the sequence itself (prompt lookup decoding).
+    The last n tokens (longest n first) are searched for earlier in the sequence, and the
+    tokens that followed their first occurrence are proposed. Diacritization and
+    translation outputs largely repeat the prompt, so such drafts are often accepted.
+    
+    Args:
+        tokens: Sequence so far (prompt and generated tokens)
+        num_tokens: Maximum number of drafted tokens
+        max_ngram_size: Longest suffix matched
+    
+    Returns:
+        Up to num_tokens drafted token ids (empty when no n-gram matched)
+    """
+    length = len(tokens)
+    for n in range(min(max_ngram_size, length - 1), 0, -1):
+        suffix = list(tokens[length - n:])
+        # Occurrences must end before the suffix itself, so at least one token follows
+        for start in range(length - n):
+            if tokens[start] == suffix[0] and list(tokens[start:start + n]) == suffix:
+                return list(tokens[start + n:start + n + num_tokens])
+    return []
+
+
+def _per_row(value, batch_size: int) -> list:
+    """Expand a scalar, list or tensor decoding parameter to one Python value per row."""
+    if isinstance(value, torch.Tensor):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        if len(value) != batch_size:
+            raise ValueError(f"Expected {batch_size} per-row values, got {len(value)}")
+        return list(value)
+    return [value] * batch_size
+
+
+class TokenSampler:
+    """
+    Batched next-token selection with per-row greedy / temperature / top-k / top-p.
+    
+    Sampled rows are first reduced to a candidate set with one `topk` over the largest
+    top-k in the batch (TOP_P_CANDIDATES for rows with only top-p); the row's own top-k,
+    temperature and nucleus truncation are then applied to those few candidates instead of
+    sorting and masking the whole vocabulary. Nucleus probabilities are normalized over the
+    tokens top-k keeps, or over the full vocabulary for rows without top-k, as before. When
+    the candidates of a row without top-k hold no more than its top_p (a flat distribution
+    or a high top_p), the nucleus extends past them and the call is redone over the whole
+    sorted vocabulary, so the result is always standard nucleus sampling; only that check
+    syncs with the device, and only for batches with such rows.
+    Rows with neither filter sample from the full softmax, and greedy rows take the argmax.
+    Parameters are resolved once at construction, so calls do not otherwise sync with the device.
+    Rows with their own seed draw from their own generator, independent of the global RNG.
+    A sampler built for batch_size 1 (scalar parameters only) applies to any number of rows.
+    
+    Usage:
+        sampler = TokenSampler(bsz, vocab_size, device, temperature=0.7, top_k=[50, 0], top_p=0.9)
+        next_tokens = sampler(logits[:, -1])   # (B,)
+        probs = sampler.probs(logits[:, -1])   # (B, vocab_size), what __call__ samples from
+    """
+    
+    def __init__(
+        self,
+        batch_size: int,
+        vocab_size: int,
+        device: torch.device,
+        do_sample: Union[bool, List[bool], torch.Tensor] = True,
+        temperature: Union[float, List[float], torch.Tensor] = 1.0,
+        top_k: Union[Optional[int], List[Optional[int]], torch.Tensor] = None,
+        top_p: Union[Optional[float], List[Optional[float]], torch.Tensor] = None,
+        seed: Union[None, int, List[Optional[int]]] = None,
+    ):
+        """
+        Args:
+            batch_size: Number of rows
+            vocab_size: Size of the logits' last dimension
+            device: Device of the logits
+            do_sample: Sample (True) or take the argmax (False), per row or for all rows
+            temperature: Sampling temperature, per row or for all rows
+            top_k: Keep only the k most likely tokens (None or 0 disables), per row or for all
+            top_p: Keep the smallest set of tokens whose probability exceeds p (None or 1.0
+                  disables), per row or for all
+            seed: Seed of one generator for the whole batch, or a list with a seed (or None)
+                  for each row's own generator
+        """
+        do_sample = [bool(x) for x in _per_row(do_sample, batch_size)]
+        temperature = [float(x) for x in _per_row(temperature, batch_size)]
+        top_k = [min(int(k), vocab_size) if k else 0 for k in _per_row(top_k, batch_size)]
+        top_p = [float(p) if p is not None and p < 1.0 else 1.0 for p in _per_row(top_p, batch_size)]
+        
+        # Candidates each sampled row needs: its top-k, a fixed cap for top-p alone, or
+        # none (0) when it samples from the full distribution
+        needed = [
+            k if k else (min(vocab_size, TOP_P_CANDIDATES) if p < 1.0 else 0)
+            for k, p in zip(top_k, top_p)
+        ]
+        self.any_sample = any(do_sample)
+        self.all_sample = all(do_sample)
+        self.num_candidates = max((n for n, s in zip(needed, do_sample) if s), default=0)
+        self.any_unfiltered = any(s and n == 0 for n, s in zip(needed, do_sample))
+        self.any_top_p = any(s and p < 1.0 for p, s in zip(top_p, do_sample))
+        self.any_top_p_without_k = any(s and p < 1.0 and not k for k, p, s in zip(top_k, top_p, do_sample))
+        
+        self.do_sample = torch.tensor(do_sample, device=device)
+        self.temperature = torch.tensor(temperature, device=device).unsqueeze(1)
+        # Candidates kept per row: its top-k, or all of them for top-p alone
+        self.keep = torch.tensor([k or vocab_size for k in top_k], device=device).unsqueeze(1)
+        self.has_top_k = torch.tensor([k > 0 for k in top_k], device=device).unsqueeze(1)
+        self.top_p = torch.tensor(top_p, device=device).unsqueeze(1)
+        self.top_p_without_k = torch.tensor(
+            [s and p < 1.0 and not k for k, p, s in zip(top_k, top_p, do_sample)], device=device
+        )
+        self.unfiltered = torch.tensor([n == 0 for n in needed], device=device)
+        
+        self.generator: Optional[torch.Generator] = None
+        self.row_generators: List[Tuple[int, torch.Generator]] = []
+        if isinstance(seed, (list, tuple, torch.Tensor)):
+            for row, row_seed in enumerate(_per_row(seed, batch_size)):
+                if row_seed is not None:
+                    generator = torch.Generator(device=device)
+                    generator.manual_seed(int(row_seed))
+                    self.row_generators.append((row, generator))
+        elif seed is not None:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(int(seed))
+    
+    def _draw(self, probs: torch.Tensor) -> torch.Tensor:
+        """Sample one index per row of `probs` (B, N), seeded rows from their own generator."""
+        choice = torch.multinomial(probs, num_samples=1, generator=self.generator)
+        for row, generator in self.row_generators:
+            choice[row] = torch.multinomial(probs[row], num_samples=1, generator=generator)
+        return choice
+    
+    def _candidates(self, logits: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Candidate set of every row after temperature, top-k and top-p.
+        
+        Returns:
+            (values, indices) of shape (B, num_candidates): tempered logits (-inf for
+            filtered candidates) and their token ids
+        """
+        values, indices, covered = self._filter(logits, self.num_candidates)
+        if covered is not None and not bool(covered.all()):
+            # A top-p row's nucleus reaches past the candidates: use the whole vocabulary
+            values, indices, _ = self._filter(logits, logits.size(-1))
+        return values, indices
+    
+    def _filter(
+        self, logits: torch.Tensor, num_candidates: int
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Apply temperature, top-k and top-p to the `num_candidates` most likely tokens.
+        
+        Returns:
+            (values, indices, covered): as for `_candidates`, plus a (B,) mask telling
+            whether each row's nucleus ended within the candidates (None when no top-p row
+            without top-k could be cut short)
+        """
+        # Candidate set: topk is far cheaper than sorting the whole vocabulary
+        values, indices = logits.topk(num_candidates, dim=-1)  # sorted, (B, C)
+        values = values / self.temperature
+        rank = torch.arange(num_candidates, device=logits.device)
+        values = values.masked_fill(rank >= self.keep, float('-inf'))
+        
+        covered = None
+        if self.any_top_p:
+            # Nucleus over what top-k kept (or over the full vocabulary without top-k)
+            log_norm = torch.logsumexp(values, dim=-1, keepdim=True)
+            if self.any_top_p_without_k:
+                full_norm = torch.logsumexp(logits / self.temperature, dim=-1, keepdim=True)
+                log_norm = torch.where(self.has_top_k, log_norm, full_norm)
+            probs = torch.exp(values - log_norm)
+            # Drop a candidate once the ones before it already exceed top_p, which
+            # keeps the first token above the threshold
+            mass = torch.cumsum(probs, dim=-1)
+            mass_before = F.pad(mass[:, :-1], (1, 0))
+            values = values.masked_fill(mass_before > self.top_p, float('-inf'))
+            if self.any_top_p_without_k and num_candidates < logits.size(-1):
+                covered = ~self.top_p_without_k | (mass[:, -1:] > self.top_p).squeeze(1)
+        return values, indices, covered
+    
+    def probs(self, logits: torch.Tensor) -> torch.Tensor:
+        """
+        Distribution each row's token is drawn from, as used by speculative decoding.
+        
+        Args:
+            logits: Next-token logits of shape (B, vocab_size), before temperature
+        
+        Returns:
+            Probabilities of shape (B, vocab_size); greedy rows are one-hot at the argmax
+        """
+        logits = logits.float()
+        greedy = F.one_hot(logits.argmax(dim=-1), logits.size(-1)).to(logits.dtype)
+        if not self.any_sample:
+            return greedy
+        
+        probs = None
+        if self.num_candidates:
+            values, indices = self._candidates(logits)
+            probs = torch.zeros_like(logits).scatter_(1, indices, F.softmax(values, dim=-1))
+        if self.any_unfiltered:
+            full = F.softmax(logits / self.temperature, dim=-1)
+            probs = full if probs is None else torch.where(self.unfiltered.unsqueeze(1), full, probs)
+        
+        if not self.all_sample:
+            probs = torch.where(self.do_sample.unsqueeze(1), probs, greedy)
+        return probs
+    
+    def __call__(self, logits: torch.Tensor) -> torch.Tensor:
+        """
+        Pick one token per row.
+        
+        Args:
+            logits: Next-token logits of shape (B, vocab_size), before temperature
+        
+        Returns:
+            Token ids of shape (B,)
+        """
+        logits = logits.float()
+        greedy = logits.argmax(dim=-1)
+        if not self.any_sample:
+            return greedy
+        
+        tokens = None
+        if self.num_candidates:
+            values, indices = self._candidates(logits)
+            choice = self._draw(F.softmax(values, dim=-1))
+            tokens = indices.gather(1, choice).squeeze(1)
+        
+        if self.any_unfiltered:
+            full = self._draw(F.softmax(logits / self.temperature, dim=-1)).squeeze(1)
+            tokens = full if tokens is None else torch.where(self.unfiltered, full, tokens)
+        
+        if not self.all_sample:
+            tokens = torch.where(self.do_sample, tokens, greedy)
+        return tokens
+
 
 class GPTJXConfig(PretrainedConfig):
     """Configuration class for SabiYarn model."""
@@ -31,7 +323,8 @@ class GPTJXConfig(PretrainedConfig):
         max_batch_size: int = 1,
         use_kv_cache: bool = True,
         bias: bool = False,  # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
-        kv_cache_dtype: str = "float32",  # "float32" or "float16" for memory savings
+        kv_cache_dtype: str = "float32",  # "float32", or "float16"/"int8" for memory savings
+        kv_page_size: int = 16,  # positions per KV cache page (see PagedKVCache)
         **kwargs
     ):
         self.block_size = block_size
@@ -43,7 +336,8 @@ class GPTJXConfig(PretrainedConfig):
         self.bias = bias
         self.use_kv_cache = use_kv_cache
         self.max_batch_size = max_batch_size
-        self.kv_cache_dtype = kv_cache_dtype  # Memory optimization: use float16 for cache
+        self.kv_cache_dtype = kv_cache_dtype  # Memory optimization: use float16 or int8 for cache
+        self.kv_page_size = kv_page_size
         
         super().__init__(**kwargs)
 
@@ -60,10 +354,604 @@ class LayerNorm(nn.Module):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
 
+class PagedKVCache:
+    """
+    Paged key/value cache shared by all attention layers of a model.
+    
+    Keys/values are stored in fixed-size pages of `page_size` positions taken from a
+    shared pool. Every cache slot (one sequence) owns a block table listing its pages in
+    order; pages are allocated as the sequence grows and go back to the free list when
+    the slot is released or rewound. Memory therefore follows the tokens actually in
+    flight instead of max_slots x max_len, and the pool itself only grows (by doubling)
+    when the free list runs out, up to that worst case.
+    
+    Usage per forward pass: the model calls `prepare()` with the slot and start position
+    of every row, then each attention layer calls `update()` with its new keys/values
+    and gets back the cached keys/values of its rows.
+    
+    The pages are the storage of record. Attention reads from a contiguous per-layer view
+    of the rows of the current batch, which new keys/values are written through to. While
+    a batch keeps the same slots (every decode step of a generate() call or of a stable
+    continuous batch), a step therefore only copies its new positions instead of
+    re-gathering every row's prefix from the pages. Positions are copied from the pages
+    into the view only when the batch composition changes, a slot is rewound or imported
+    into, or a layer skipped earlier steps (early-exit drafting). The view is sized from
+    the batch's longest row (rounded up to a page), grows by a quarter when a row outgrows
+    it, is resized for each new batch composition and freed by `reset()`, so it costs one
+    contiguous copy of the tokens in flight rather than of max_slots x max_len.
+    
+    With an int8 storage dtype every cached position keeps one scale per head next to its
+    int8 keys/values (symmetric absmax quantization). Positions are quantized as they are
+    written, so appending or rewinding never requantizes older pages. `update()` then
+    returns the gathered int8 pages together with their scales and the attention layer
+    dequantizes them as part of the attention computation.
+    """
+    
+    def __init__(
+        self,
+        n_layer: int,
+        n_heads: int,
+        head_dim: int,
+        max_slots: int,
+        max_len: int,
+        page_size: int = 16,
+        device: Optional[torch.device] = None,
+        dtype: torch.dtype = torch.float32,
+        scale_dtype: torch.dtype = torch.float32,
+    ):
+        """
+        Args:
+            n_layer: Number of attention layers sharing the block tables
+            n_heads: Attention heads per layer
+            head_dim: Size of each head
+            max_slots: Number of cache slots (concurrent sequences)
+            max_len: Maximum number of positions per slot
+            page_size: Positions per page
+            device: Device of the page pool
+            dtype: Storage dtype of keys/values (torch.int8 for a quantized cache)
+            scale_dtype: Dtype of the int8 scales, and of the keys/values they dequantize
+                        to (the activation dtype); unused for float storage
+        """
+        self.n_layer = n_layer
+        self.n_heads = n_heads
+        self.head_dim = head_dim
+        self.max_slots = max_slots
+        self.max_len = max_len
+        self.page_size = page_size
+        self.device = device
+        self.dtype = dtype
+        self.scale_dtype = scale_dtype
+        self.quantized = dtype == torch.int8
+        self.max_blocks = max_slots * math.ceil(max_len / page_size)
+        
+        # Per-layer page pools of shape (num_blocks, page_size, nh, hs), grown lazily. Heads
+        # come after positions so gathered pages form (B, positions, nh, hs) without a copy.
+        self._k_pool: List[torch.Tensor] = []
+        self._v_pool: List[torch.Tensor] = []
+        # int8 storage only: per-layer scales of shape (num_blocks, page_size, nh, 1)
+        self._k_scale: List[torch.Tensor] = []
+        self._v_scale: List[torch.Tensor] = []
+        self.num_blocks = 0
+        self._free: List[int] = []
+        self._tables: Dict[int, List[int]] = {}
+        
+        # Set by prepare() for the current forward pass
+        self._read_table: Optional[torch.Tensor] = None  # (B, pages) block ids
+        self._write_block: Optional[torch.Tensor] = None  # (B, T) block id of each new token
+        self._write_offset: Optional[torch.Tensor] = None  # (B, T) offset inside its block
+        self._write_pos: Optional[torch.Tensor] = None  # (B, T) position of each new token
+        self._starts: List[int] = []
+        self._t = 0
+        self._kv_len = 0
+        self._fills: Dict[Tuple[int, ...], Tuple[torch.Tensor, ...]] = {}
+        
+        # Contiguous view of the current batch: per layer, one (B, capacity, nh, width)
+        # tensor per pool, plus per layer and row the number of leading positions that
+        # mirror the pages
+        self._view_slots: Optional[List[int]] = None
+        self._views: List[List[torch.Tensor]] = [[] for _ in range(n_layer)]
+        self._view_valid: List[List[int]] = []
+    
+    def _grow(self, min_blocks: int):
+        """Enlarge the pools to at least `min_blocks` pages (doubling, capped at max_blocks)."""
+        new_total = min(self.max_blocks, max(min_blocks, 2 * self.num_blocks, 16))
+        if new_total < min_blocks:
+            raise RuntimeError(f"KV cache is out of pages ({self.max_blocks} in use)")
+        extra = new_total - self.num_blocks
+        groups = [(self._k_pool, self.head_dim, self.dtype), (self._v_pool, self.head_dim, self.dtype)]
+        if self.quantized:
+            groups += [(self._k_scale, 1, self.scale_dtype), (self._v_scale, 1, self.scale_dtype)]
+        for pools, width, dtype in groups:
+            shape = (extra, self.page_size, self.n_heads, width)
+            if not pools:
+                pools.extend(
+                    torch.zeros(shape, device=self.device, dtype=dtype)
+                    for _ in range(self.n_layer)
+                )
+            else:
+                for i, pool in enumerate(pools):
+                    pools[i] = torch.cat([pool, pool.new_zeros(shape)])
+        self._free.extend(range(new_total - 1, self.num_blocks - 1, -1))
+        self.num_blocks = new_total
+    
+    def reserve(self, slot: int, start: int, end: int):
+        """
+        Make `slot` hold positions 0..end-1, about to be (re)written from `start` on.
+        Pages past `start` are recycled, so rewinding a sequence frees its memory.
+        """
+        if not 0 <= slot < self.max_slots:
+            raise ValueError(f"KV cache slot {slot} out of range (max_slots={self.max_slots})")
+        if end > self.max_len:
+            raise ValueError(f"Sequence of length {end} exceeds the KV cache length {self.max_len}")
+        table = self._tables.setdefault(slot, [])
+        keep = math.ceil(start / self.page_size)
+        if len(table) > keep:
+            self._free.extend(table[keep:])
+            del table[keep:]
+        needed = math.ceil(end / self.page_size) - len(table)
+        if needed > len(self._free):
+            self._grow(self.num_blocks - len(self._free) + needed)
+        for _ in range(needed):
+            table.append(self._free.pop())
+    
+    def release(self, slot: int):
+        """Return all pages of `slot` to the free list."""
+        self._free.extend(self._tables.pop(slot, []))
+        self._invalidate(slot, 0)
+    
+    def reset(self):
+        """Release every slot (the pools stay allocated for reuse, the views are freed)."""
+        for slot in list(self._tables):
+            self.release(slot)
+        self._view_slots = None
+        self._views = [[] for _ in range(self.n_layer)]
+    
+    def _invalidate(self, slot: int, start: int):
+        """Stop trusting the view of `slot` from position `start` on."""
+        if self._view_slots is not None and slot in self._view_slots:
+            row = self._view_slots.index(slot)
+            for valid in self._view_valid:
+                valid[row] = min(valid[row], start)
+    
+    def _layer_pools(self, layer_idx: int) -> List[torch.Tensor]:
+        """Pools of one layer: keys and values, then their scales for int8 storage."""
+        pools = [self._k_pool[layer_idx], self._v_pool[layer_idx]]
+        if self.quantized:
+            pools += [self._k_scale[layer_idx], self._v_scale[layer_idx]]
+        return pools
+    
+    def prepare(self, slots: List[int], starts: List[int], t: int):
+        """
+        Reserve pages for a forward pass feeding `t` tokens to each row.
+        Row b writes positions starts[b]..starts[b]+t-1 of slot slots[b] and reads
+        positions 0..max(starts)+t-1 (rows shorter than that are masked by the caller).
+        """
+        for slot, start in zip(slots, starts):
+            self.reserve(slot, start, start + t)
+        if slots != self._view_slots:
+            self._view_slots = list(slots)
+            self._view_valid = [[0] * len(slots) for _ in range(self.n_layer)]
+        else:
+            for valid in self._view_valid:
+                valid[:] = [min(n, start) for n, start in zip(valid, starts)]
+        self._starts = list(starts)
+        self._t = t
+        self._fills = {}
+        self._kv_len = max(starts) + t
+        pages = math.ceil(self._kv_len / self.page_size)
+        table = [self._tables[slot][:pages] for slot in slots]
+        table = [row + [0] * (pages - len(row)) for row in table]
+        self._read_table = torch.tensor(table, dtype=torch.long, device=self.device)
+        positions = (
+            torch.tensor(starts, dtype=torch.long, device=self.device).unsqueeze(1)
+            + torch.arange(t, device=self.device)
+        )
+        self._write_block = self._read_table.gather(1, positions // self.page_size)
+        self._write_offset = positions % self.page_size
+        self._write_pos = positions
+    
+    def _layer_view(self, layer_idx: int, B: int) -> List[torch.Tensor]:
+        """
+        The view of one layer, holding at least kv_len positions, with every row's
+        positions before its start copied from the pages.
+        """
+        views = self._views[layer_idx]
+        valid = self._view_valid[layer_idx]
+        capacity = views[0].size(1) if views else 0
+        needed = self.page_size * math.ceil(self._kv_len / self.page_size)
+        if any(valid):
+            # The batch continues: grow by a quarter (at least to kv_len) and keep the contents
+            if capacity < self._kv_len:
+                capacity = min(self.max_len, max(needed, self.page_size * math.ceil(1.25 * capacity / self.page_size)))
+                grown = []
+                for view in views:
+                    new_view = view.new_zeros((B, capacity) + view.shape[2:])
+                    new_view[:, :view.size(1)] = view
+                    grown.append(new_view)
+                self._views[layer_idx] = views = grown
+        elif not views or views[0].size(0) != B or not needed <= capacity <= 2 * needed:
+            # Nothing to keep (new batch or rewound rows): size the view for the current
+            # tokens, reusing the old one only if it is not more than twice too large
+            self._views[layer_idx] = views = [
+                pool.new_zeros((B, needed) + pool.shape[2:]) for pool in self._layer_pools(layer_idx)
+            ]
+        
+        # Copy positions valid..start-1 of every row that the view does not mirror yet
+        gaps = tuple(valid)
+        if any(n < start for n, start in zip(gaps, self._starts)):
+            if gaps not in self._fills:
+                ranges = [(b, n, start) for b, (n, start) in enumerate(zip(gaps, self._starts)) if n < start]
+                rows = torch.cat([torch.full((start - n,), b, dtype=torch.long) for b, n, start in ranges])
+                pos = torch.cat([torch.arange(n, start) for _, n, start in ranges])
+                rows, pos = rows.to(self.device), pos.to(self.device)
+                blocks = self._read_table[rows, pos // self.page_size]
+                self._fills[gaps] = (rows, pos, blocks, pos % self.page_size)
+            rows, pos, blocks, offsets = self._fills[gaps]
+            for view, pool in zip(views, self._layer_pools(layer_idx)):
+                view[rows, pos] = pool[blocks, offsets]
+        valid[:] = [start + self._t for start in self._starts]
+        return views
+    
+    def _quantize(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Quantize (..., hs) to int8 with one absmax scale per vector, of shape (..., 1)."""
+        x = x.float()
+        scale = x.abs().amax(dim=-1, keepdim=True).clamp_min(1e-8) / 127.0
+        q = torch.round(x / scale).clamp_(-127, 127).to(torch.int8)
+        return q, scale.to(self.scale_dtype)
+    
+    def update(
+        self, layer_idx: int, k: torch.Tensor, v: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """
+        Store new keys/values of shape (B, nh, T, hs) and return all cached ones of the
+        prepared rows, as views of the batch's contiguous cache.
+        
+        Returns:
+            (k, v, k_scale, v_scale). With float storage k/v have shape
+            (B, nh, max(starts) + T, hs) in the input dtype and the scales are None. With
+            int8 storage k/v are int8 and the scales have shape
+            (B, nh, max(starts) + T, 1); `k * k_scale` dequantizes to the input dtype.
+        """
+        B = k.size(0)
+        views = self._layer_view(layer_idx, B)
+        if self.quantized:
+            k, k_scale = self._quantize(k.transpose(1, 2))
+            v, v_scale = self._quantize(v.transpose(1, 2))
+            new = [k, v, k_scale, v_scale]
+        else:
+            new = [k.transpose(1, 2).to(self.dtype), v.transpose(1, 2).to(self.dtype)]
+        rows = torch.arange(B, device=self.device).unsqueeze(1)
+        for pool, view, values in zip(self._layer_pools(layer_idx), views, new):
+            pool[self._write_block, self._write_offset] = values
+            view[rows, self._write_pos] = values
+        
+        cached = [view[:, :self._kv_len].transpose(1, 2) for view in views]
+        if self.quantized:
+            return cached[0], cached[1], cached[2], cached[3]
+        return cached[0].to(k.dtype), cached[1].to(v.dtype), None, None
+    
+    def _locate(self, slot: int, start: int, end: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        positions = torch.arange(start, end, device=self.device)
+        table = torch.tensor(self._tables[slot], dtype=torch.long, device=self.device)
+        return table[positions // self.page_size], positions % self.page_size
+    
+    def read(self, slot: int, start: int, end: int) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Copy keys/values of positions start..end-1 of `slot`, per layer, each (nh, L, hs).
+        An int8 cache returns them dequantized to `scale_dtype`.
+        """
+        blocks, offsets = self._locate(slot, start, end)
+        kv = []
+        for layer, (k_pool, v_pool) in enumerate(zip(self._k_pool, self._v_pool)):
+            k, v = k_pool[blocks, offsets], v_pool[blocks, offsets]
+            if self.quantized:
+                k = k * self._k_scale[layer][blocks, offsets]
+                v = v * self._v_scale[layer][blocks, offsets]
+            kv.append((k.transpose(0, 1), v.transpose(0, 1)))
+        return kv
+    
+    def write(self, slot: int, start: int, kv: List[Tuple[torch.Tensor, torch.Tensor]]):
+        """Write per-layer keys/values of shape (nh, L, hs) into `slot` from position `start`."""
+        end = start + kv[0][0].size(1)
+        self.reserve(slot, start, end)
+        self._invalidate(slot, start)
+        blocks, offsets = self._locate(slot, start, end)
+        for layer, (k_pool, v_pool, (k, v)) in enumerate(zip(self._k_pool, self._v_pool, kv)):
+            if not self.quantized:
+                k_pool[blocks, offsets] = k.transpose(0, 1).to(k_pool.dtype)
+                v_pool[blocks, offsets] = v.transpose(0, 1).to(v_pool.dtype)
+                continue
+            k_pool[blocks, offsets], self._k_scale[layer][blocks, offsets] = self._quantize(k.transpose(0, 1))
+            v_pool[blocks, offsets], self._v_scale[layer][blocks, offsets] = self._quantize(v.transpose(0, 1))
+    
+    def stats(self) -> Dict[str, object]:
+        """Page usage of the pool and size of the batch view."""
+        position_bytes = self.head_dim * torch.empty((), dtype=self.dtype).element_size()
+        if self.quantized:
+            position_bytes += torch.empty((), dtype=self.scale_dtype).element_size()
+        page_bytes = 2 * self.n_layer * self.n_heads * self.page_size * position_bytes
+        view_bytes = sum(view.numel() * view.element_size() for views in self._views for view in views)
+        return {
+            "dtype": str(self.dtype).replace("torch.", ""),
+            "page_size": self.page_size,
+            "pages": self.num_blocks,
+            "pages_in_use": self.num_blocks - len(self._free),
+            "allocated_mb": round(self.num_blocks * page_bytes / 1024 ** 2, 1),
+            "view_mb": round(view_bytes / 1024 ** 2, 1),
+        }
+
+
+class CausalMaskCache:
+    """
+    Causal masks shared by all attention layers of a model.
+    
+    Masks are built at power-of-2 sizes (4096 .. 32768, capped at block_size) and sliced
+    by the caller, so a handful of entries cover every sequence length. Entries are keyed
+    by (size, device, dtype) and evicted least-recently-used first once their total size
+    exceeds `max_bytes`; a mask larger than the whole budget is built at the exact
+    sequence length and not kept. Only the manual (non-flash) attention path needs these.
+    Like PagedKVCache it is not locked, since a model runs one forward pass at a time.
+    """
+    
+    def __init__(self, max_size: int, max_bytes: int = DEFAULT_MASK_CACHE_MB * 1024 ** 2):
+        """
+        Args:
+            max_size: Largest mask size (the model's block_size)
+            max_bytes: Byte budget for cached masks
+        """
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._masks: "OrderedDict[tuple, torch.Tensor]" = OrderedDict()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def mask_size(self, seq_len: int) -> int:
+        """
+        Round up sequence length to nearest power-of-2 mask size.
+        This minimizes memory usage while ensuring mask is large enough.
+        
+        Args:
+            seq_len: Actual sequence length
+        
+        Returns:
+            Mask size (one of: 4096, 8192, 16384, 32768, or max_size)
+        """
+        # Power-of-2 sizes for efficient memory usage, filtered to sizes <= max_size
+        for size in (4096, 8192, 16384, 32768):
+            if size <= self.max_size and seq_len <= size:
+                return size
+        
+        # Fallback to max_size if sequence is larger
+        return self.max_size
+    
+    def get(self, seq_len: int, device: torch.device, dtype: torch.dtype = torch.bool) -> torch.Tensor:
+        """
+        Get or create a lower-triangular mask covering `seq_len` positions.
+        
+        Returns:
+            Causal mask of shape (1, 1, size, size) with size >= seq_len
+        """
+        size = self.mask_size(seq_len)
+        key = (size, device, dtype)
+        mask = self._masks.get(key)
+        if mask is not None:
+            self._masks.move_to_end(key)
+            self.hits += 1
+            return mask
+        self.misses += 1
+        
+        if size * size * torch.empty((), dtype=dtype).element_size() > self.max_bytes:
+            # Too large to keep: build one just big enough for this call
+            mask = torch.tril(torch.ones(seq_len, seq_len, device=device, dtype=dtype))
+            return mask.view(1, 1, seq_len, seq_len)
+        
+        mask = torch.tril(torch.ones(size, size, device=device, dtype=dtype)).view(1, 1, size, size)
+        self._masks[key] = mask
+        self.total_bytes += mask.numel() * mask.element_size()
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._masks.popitem(last=False)
+            self.total_bytes -= evicted.numel() * evicted.element_size()
+            self.evictions += 1
+        return mask
+    
+    def clear(self):
+        self._masks.clear()
+        self.total_bytes = 0
+    
+    def stats(self) -> Dict[str, object]:
+        return {
+            "masks": len(self._masks),
+            "cached_mb": round(self.total_bytes / 1024 ** 2, 1),
+            "budget_mb": round(self.max_bytes / 1024 ** 2, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def chunked_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    attn_mask: Optional[torch.Tensor] = None,
+    dropout_p: float = 0.0,
+    chunk_size: int = ATTENTION_CHUNK_SIZE,
+) -> torch.Tensor:
+    """
+    Attention in pure PyTorch that never materializes the full (T, S) score matrix.
+    Queries are processed in tiles of `chunk_size`, and for each tile the keys are
+    visited in chunks while a running max and softmax denominator are kept (online
+    softmax), so peak memory is O(chunk_size^2) per head instead of O(T * S).
+    
+    Without `attn_mask` the attention is causal with the queries at the last T of the S
+    positions (query i may attend to keys 0..S - T + i), which covers full sequences,
+    single-token decode and chunks fed after cached tokens. Key chunks entirely in the
+    future of a query tile are skipped.
+    
+    Args:
+        q: Queries of shape (B, nh, T, hs)
+        k: Keys of shape (B, nh, S, hs)
+        v: Values of shape (B, nh, S, hs)
+        attn_mask: Optional mask broadcastable to (B, nh, T, S), nonzero where a query may
+                  attend to a key; replaces the causal mask
+        dropout_p: Dropout on the attention probabilities (pass 0 in eval mode)
+        chunk_size: Tile size along both the query and the key dimension
+    
+    Returns:
+        Attention output of shape (B, nh, T, hs)
+    """
+    T, S = q.size(-2), k.size(-2)
+    offset = S - T  # position of query 0 among the keys
+    scale = 1.0 / math.sqrt(q.size(-1))
+    out = torch.empty_like(q)
+    
+    for q0 in range(0, T, chunk_size):
+        q1 = min(q0 + chunk_size, T)
+        q_tile = q[:, :, q0:q1] * scale
+        row_max = q_tile.new_full(q_tile.shape[:-1] + (1,), float('-inf'))
+        denom = q_tile.new_zeros(q_tile.shape[:-1] + (1,))
+        acc = torch.zeros_like(q_tile)
+        
+        # Causal: the last query of this tile sees keys up to offset + q1 - 1
+        key_end = S if attn_mask is not None else offset + q1
+        for k0 in range(0, key_end, chunk_size):
+            k1 = min(k0 + chunk_size, key_end)
+            scores = q_tile @ k[:, :, k0:k1].transpose(-2, -1)  # (B, nh, tq, tk)
+            if attn_mask is not None:
+                scores = scores.masked_fill(attn_mask[..., q0:q1, k0:k1] == 0, float('-inf'))
+            elif k1 - 1 > offset + q0:
+                # The chunk crosses the diagonal: hide keys after each query's position
+                q_pos = torch.arange(offset + q0, offset + q1, device=q.device).unsqueeze(1)
+                k_pos = torch.arange(k0, k1, device=q.device).unsqueeze(0)
+                scores = scores.masked_fill(k_pos > q_pos, float('-inf'))
+            
+            # Rescale what was accumulated so far to the new running max
+            new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            safe_max = new_max.masked_fill(torch.isinf(new_max), 0.0)  # rows with no key yet
+            probs = torch.exp(scores - safe_max)
+            correction = torch.exp(row_max - safe_max)
+            denom = denom * correction + probs.sum(dim=-1, keepdim=True)
+            if dropout_p > 0:
+                probs = F.dropout(probs, p=dropout_p)
+            acc = acc * correction + probs @ v[:, :, k0:k1]
+            row_max = new_max
+        
+        out[:, :, q0:q1] = acc / denom
+    return out
+
+
+def _attention_with_lse(
+    q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: Optional[torch.Tensor]
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Attention that also returns the log-sum-exp of each query's scores, so results over
+    disjoint key ranges can be merged. Uses the fused SDPA kernels that expose it (CPU
+    flash attention, CUDA memory-efficient attention) and eager math elsewhere.
+    
+    Args:
+        q: Queries of shape (B, nh, T, hs)
+        k: Keys of shape (B, nh, S, hs)
+        v: Values of shape (B, nh, S, hs)
+        mask: Optional boolean mask broadcastable to (B, nh, T, S), True where a query may
+              attend to a key
+    
+    Returns:
+        (output of shape (B, nh, T, hs), float32 log-sum-exp of shape (B, nh, T)); a
+        query that sees no key gets a log-sum-exp of -inf
+    """
+    T, S = q.size(-2), k.size(-2)
+    if q.device.type == "cpu" and hasattr(torch.ops.aten, "_scaled_dot_product_flash_attention_for_cpu"):
+        bias = None
+        if mask is not None:
+            bias = torch.zeros(mask.shape, device=q.device, dtype=q.dtype).masked_fill_(~mask, float('-inf'))
+        out, lse = torch.ops.aten._scaled_dot_product_flash_attention_for_cpu(q, k, v, attn_mask=bias)
+    elif q.is_cuda and hasattr(torch.ops.aten, "_scaled_dot_product_efficient_attention"):
+        bias = None
+        if mask is not None:
+            # The kernel needs the bias rows 16-element aligned, as SDPA itself pads them
+            padded = 16 * math.ceil(S / 16)
+            bias = q.new_zeros(q.shape[:-1] + (padded,))[..., :S].masked_fill_(~mask, float('-inf'))
+        out, lse = torch.ops.aten._scaled_dot_product_efficient_attention(q, k, v, bias, True)[:2]
+        lse = lse[..., :T]
+    else:
+        scores = (q @ k.transpose(-2, -1)).float() * (1.0 / math.sqrt(q.size(-1)))
+        if mask is not None:
+            scores = scores.masked_fill(~mask, float('-inf'))
+        lse = torch.logsumexp(scores, dim=-1)
+        out = torch.softmax(scores, dim=-1).nan_to_num(0.0).to(v.dtype) @ v
+    if mask is not None:
+        lse = lse.masked_fill(~mask.any(dim=-1), float('-inf'))
+    return out, lse
+
+
+def quantized_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    k_scale: torch.Tensor,
+    v_scale: torch.Tensor,
+    attn_mask: Optional[torch.Tensor] = None,
+    tile_size: int = KV_DEQUANT_TILE,
+) -> torch.Tensor:
+    """
+    Attention over int8 keys/values (as returned by an int8 PagedKVCache) that never
+    dequantizes the whole prefix. Keys are visited in tiles of `tile_size`: each tile is
+    dequantized into the activation dtype, run through a fused attention kernel that
+    also returns its log-sum-exp, and merged into the running result (the same rescaling
+    as the online softmax of chunked_attention). Inference only (no dropout).
+    
+    Without `attn_mask` the attention is causal with the queries at the last T of the S
+    positions, as in chunked_attention.
+    
+    Args:
+        q: Queries of shape (B, nh, T, hs)
+        k: int8 keys of shape (B, nh, S, hs)
+        v: int8 values of shape (B, nh, S, hs)
+        k_scale: Key scales of shape (B, nh, S, 1) in the activation dtype
+        v_scale: Value scales of shape (B, nh, S, 1) in the activation dtype
+        attn_mask: Optional mask broadcastable to (B, nh, T, S), nonzero where a query may
+                  attend to a key; replaces the causal mask
+        tile_size: Key positions dequantized at a time
+    
+    Returns:
+        Attention output of shape (B, nh, T, hs)
+    """
+    T, S = q.size(-2), k.size(-2)
+    offset = S - T  # position of query 0 among the keys
+    acc = torch.zeros(q.shape, device=q.device, dtype=torch.float32)
+    lse = torch.full(q.shape[:-1], float('-inf'), device=q.device)
+    for k0 in range(0, S, tile_size):
+        k1 = min(k0 + tile_size, S)
+        if attn_mask is not None:
+            mask = attn_mask[..., k0:k1].to(torch.bool)
+        elif k1 - 1 > offset:
+            # The tile reaches past the first query: hide keys after each query's position
+            q_pos = torch.arange(offset, S, device=q.device).unsqueeze(1)
+            k_pos = torch.arange(k0, k1, device=q.device).unsqueeze(0)
+            mask = (k_pos <= q_pos).view(1, 1, T, k1 - k0)
+        else:
+            mask = None
+        out, tile_lse = _attention_with_lse(
+            q, k[:, :, k0:k1] * k_scale[:, :, k0:k1], v[:, :, k0:k1] * v_scale[:, :, k0:k1], mask
+        )
+        
+        # Reweight the running result and this tile by their share of the combined softmax
+        new_lse = torch.logaddexp(lse, tile_lse)
+        safe_lse = new_lse.masked_fill(torch.isinf(new_lse), 0.0)  # queries with no key yet
+        old_weight = torch.exp(lse - safe_lse).unsqueeze(-1)
+        tile_weight = torch.exp(tile_lse - safe_lse).unsqueeze(-1)
+        acc = acc * old_weight + torch.where(tile_weight > 0, out.float() * tile_weight, 0.0)
+        lse = new_lse
+    return acc.to(q.dtype)
+
+
 class CausalSelfAttention(nn.Module):
     """
     Multi-head causal self-attention with optional KV caching.
-    Memory-optimized: KV cache uses lazy allocation and optional half precision.
+    Memory-optimized: KV cache uses lazy allocation and optional half precision or int8.
     """
     
     def __init__(self, config: GPTJXConfig):
@@ -86,142 +974,70 @@ class CausalSelfAttention(nn.Module):
         # flash attention make GPU go brrrrr but support is only in PyTorch >= 2.0
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
         
-        self.use_kv_cache = config.use_kv_cache
-        # Parse kv_cache_dtype string to torch dtype
-        if isinstance(config.kv_cache_dtype, str):
-            self.kv_cache_dtype = getattr(torch, config.kv_cache_dtype, torch.float32)
-        else:
-            self.kv_cache_dtype = config.kv_cache_dtype
-        
-        # Memory optimization: Lazy KV cache allocation
-        # Only allocate when actually needed during inference, not at initialization
-        # This prevents memory bloat during model loading
-        self._cache_k = None
-        self._cache_v = None
-        self._cache_initialized = False
-        self.max_batch_size = config.max_batch_size
-        
-        # Cache for dynamically created masks (power-of-2 sizes)
-        # Key: (mask_size, device), Value: mask tensor
-        self._mask_cache: dict = {}
-    
-    @staticmethod
-    def _get_mask_size(seq_len: int, max_size: int = 32768) -> int:
-        """
-        Round up sequence length to nearest power-of-2 mask size.
-        This minimizes memory usage while ensuring mask is large enough.
-        
-        Args:
-            seq_len: Actual sequence length
-            max_size: Maximum mask size (block_size)
-        
-        Returns:
-            Mask size (one of: 4096, 8192, 16384, 32768)
-        """
-        # Power-of-2 sizes for efficient memory usage
-        sizes = [4096, 8192, 16384, 32768]
-        # Filter to sizes <= max_size
-        sizes = [s for s in sizes if s <= max_size]
-        
-        for size in sizes:
-            if seq_len <= size:
-                return size
+        # Index of this layer in the model's PagedKVCache (set by GPTJXForCausalLM)
+        self.layer_idx = 0
         
-        # Fallback to max_size if sequence is larger
-        return max_size
+        # Causal masks for the manual attention path; GPTJXForCausalLM replaces this with
+        # one cache shared by all of its layers
+        self.mask_cache = CausalMaskCache(config.block_size)
     
     def _get_causal_mask(self, seq_len: int, device: torch.device, dtype: torch.dtype = torch.bool) -> torch.Tensor:
         """
-        Get or create a causal mask of appropriate size.
-        Uses power-of-2 sizing to minimize memory usage.
-        Masks are cached to avoid recreation.
-        
-        Args:
-            seq_len: Sequence length
-            device: Device to create mask on
-            dtype: Data type for mask (default: bool)
+        Get a causal mask of at least `seq_len` positions from the shared mask cache.
         
         Returns:
             Causal mask of shape (1, 1, mask_size, mask_size)
         """
-        # Determine appropriate mask size (power-of-2 rounded up)
-        mask_size = self._get_mask_size(seq_len, self.block_size)
-        
-        # Check cache
-        cache_key = (mask_size, device, dtype)
-        if cache_key not in self._mask_cache:
-            # Create mask on-the-fly
-            mask = torch.tril(torch.ones(mask_size, mask_size, device=device, dtype=dtype))
-            mask = mask.view(1, 1, mask_size, mask_size)
-            self._mask_cache[cache_key] = mask
-        
-        return self._mask_cache[cache_key]
+        return self.mask_cache.get(seq_len, device, dtype)
     
-    def _init_kv_cache(self, device: torch.device, dtype: torch.dtype):
+    @staticmethod
+    def _offset_causal_mask(t: int, kv_len: int, device: torch.device) -> torch.Tensor:
         """
-        Lazy initialization of KV cache.
-        Only allocates memory when actually needed during inference.
+        Causal mask for `t` new queries after `kv_len - t` cached keys: query i sits at
+        position kv_len - t + i and may attend to keys 0..kv_len - t + i.
+        
+        Returns:
+            Boolean mask of shape (1, 1, t, kv_len)
         """
-        if not self._cache_initialized and self.use_kv_cache:
-            # Use specified dtype (float16 for memory savings) for cache
-            # If kv_cache_dtype is float32, use the input dtype instead
-            if self.kv_cache_dtype == torch.float32:
-                cache_dtype = dtype
-            else:
-                cache_dtype = self.kv_cache_dtype
-            
-            self._cache_k = torch.zeros(
-                self.max_batch_size,
-                self.n_heads,
-                self.block_size,
-                self.head_dim,
-                device=device,
-                dtype=cache_dtype
-            )
-            self._cache_v = torch.zeros(
-                self.max_batch_size,
-                self.n_heads,
-                self.block_size,
-                self.head_dim,
-                device=device,
-                dtype=cache_dtype
-            )
-            self._cache_initialized = True
-    
-    def clear_cache(self):
-        """Clear the KV cache. Useful for resetting state between sequences."""
-        if self._cache_initialized:
-            self._cache_k.zero_()
-            self._cache_v.zero_()
-    
-    def free_cache(self):
-        """Free KV cache memory. Useful for memory cleanup."""
-        if self._cache_initialized:
-            del self._cache_k
-            del self._cache_v
-            self._cache_k = None
-            self._cache_v = None
-            self._cache_initialized = False
+        mask = torch.ones(t, kv_len, device=device, dtype=torch.bool).tril_(diagonal=kv_len - t)
+        return mask.view(1, 1, t, kv_len)
     
     def forward(
         self, 
         x: torch.Tensor, 
-        start_pos: int = 0, 
+        start_pos: Union[int, torch.Tensor] = 0, 
         *,
-        attn_mask: Optional[torch.Tensor] = None
-    ) -> torch.Tensor:
+        attn_mask: Optional[torch.Tensor] = None,
+        kv_cache: Optional["PagedKVCache"] = None,
+        layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        use_cache: Optional[bool] = None,
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, Optional[Tuple[torch.Tensor, torch.Tensor]]]]:
         """
         Forward pass through attention.
         
         Args:
             x: Input tensor of shape (B, T, C)
-            start_pos: Starting position for KV cache (for incremental decoding)
-            attn_mask: Optional custom attention mask of shape (B, 1, T, T) or (1, 1, T, T).
-                      If None, a causal mask will be created dynamically. 
+            start_pos: Starting position for KV cache (for incremental decoding).
+                      Either an int shared by all rows, or a LongTensor of shape (B,) giving
+                      each row its own position (continuous batching). In the per-row case
+                      attn_mask is required and covers every key returned by the cache.
+            attn_mask: Optional custom attention mask of shape (B, 1, T, S) or (1, 1, T, S),
+                      S being the number of keys. If None, the cheapest causal variant is
+                      used: is_causal for a full sequence, no mask for a single new token,
+                      and an offset causal mask for several tokens after cached ones.
                       Useful for multitask learning with custom masking patterns.
+            kv_cache: Optional paged KV cache, already prepared by the model for this
+                      forward pass (rows, positions). New keys/values are stored in it and
+                      attention runs over all cached positions of each row.
+            layer_past: Optional (k, v) of earlier tokens, each of shape (B, nh, L, hs), as
+                      returned in `past_key_values` (HuggingFace-style caching). The new
+                      tokens are then at positions L..L+T-1 and start_pos is ignored.
+            use_cache: None uses kv_cache. True/False selects HuggingFace-style
+                      caching instead (kv_cache is bypassed); with True the
+                      updated (k, v) is returned as well.
         
         Returns:
-            Output tensor of shape (B, T, C)
+            Output tensor of shape (B, T, C), or (output, present) when use_cache is True
         """
         B, T, C = x.size()  # batch size, sequence length, embedding dimensionality (n_embd)
         
@@ -231,30 +1047,30 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B, T, self.n_heads, self.head_dim).transpose(1, 2)  # (B, nh, T, hs)
         v = v.view(B, T, self.n_heads, self.head_dim).transpose(1, 2)  # (B, nh, T, hs)
         
-        # Handle KV cache for incremental decoding
-        if self.use_kv_cache and not self.training:
-            # Lazy initialization: allocate cache on first use
-            if not self._cache_initialized:
-                self._init_kv_cache(x.device, x.dtype)
-            
-            # Convert k, v to cache dtype if needed (for float16 cache)
-            k_for_cache = k.to(self._cache_k.dtype)
-            v_for_cache = v.to(self._cache_v.dtype)
-            
-            # Update cache with new keys and values
-            self._cache_k[:B, :, start_pos:start_pos + T] = k_for_cache
-            self._cache_v[:B, :, start_pos:start_pos + T] = v_for_cache
-            
-            # Use cached keys and values up to current position
-            # Convert back to input dtype for computation
-            k = self._cache_k[:B, :, :start_pos + T].to(x.dtype)
-            v = self._cache_v[:B, :, :start_pos + T].to(x.dtype)
-            
-            # Adjust query to only query from current position
-            q = q[:, :, -T:, :]  # Only query the new tokens
+        present = None
+        k_scale = v_scale = None
+        external_cache = use_cache is not None or layer_past is not None
+        if external_cache:
+            # HuggingFace-style cache: keys/values of earlier tokens are passed in and returned
+            if layer_past is not None:
+                start_pos = layer_past[0].size(-2)
+                k = torch.cat([layer_past[0], k], dim=-2)
+                v = torch.cat([layer_past[1], v], dim=-2)
+            else:
+                start_pos = 0
+            if use_cache:
+                present = (k, v)
+        elif kv_cache is not None:
+            # Paged KV cache for incremental decoding: store the new keys/values and attend
+            # over everything cached for these rows
+            k, v, k_scale, v_scale = kv_cache.update(self.layer_idx, k, v)
         
         # Causal self-attention
-        if self.flash:
+        if k_scale is not None:
+            # int8 KV cache: keys/values are dequantized tile by tile inside the attention
+            # (fused kernels per tile) instead of as a float copy of the whole prefix
+            y = quantized_attention(q, k, v, k_scale, v_scale, attn_mask=attn_mask)
+        elif self.flash:
             # Efficient attention using Flash Attention CUDA kernels
             if attn_mask is not None:
                 # Custom mask provided (e.g., for multitask learning)
@@ -268,7 +1084,6 @@ class CausalSelfAttention(nn.Module):
                 # Handle causal attention with KV cache correctly
                 # When start_pos > 0, q and k are misaligned (q is sliced, k contains all cached tokens)
                 # So we can't use is_causal=True - it assumes q[0] corresponds to k[0]
-                # Instead, create proper causal mask manually
                 if start_pos == 0:
                     # Full sequence: q and k are aligned, can use is_causal=True
                     y = torch.nn.functional.scaled_dot_product_attention(
@@ -277,23 +1092,18 @@ class CausalSelfAttention(nn.Module):
                         dropout_p=self.dropout if self.training else 0, 
                         is_causal=True
                     )
+                elif T == 1:
+                    # Single-token decode: the query is the newest position and may attend
+                    # to every cached key, so no mask is needed
+                    y = torch.nn.functional.scaled_dot_product_attention(
+                        q, k, v,
+                        dropout_p=self.dropout if self.training else 0
+                    )
                 else:
-                    # Incremental decoding: q is sliced but k contains all cached tokens
-                    # Create causal mask manually: q[i] can attend to k[0:start_pos+i+1]
-                    seq_len = k.size(-2)
-                    # Create causal mask: (T, seq_len) where mask[i, j] = True if q[i] can attend to k[j]
-                    # q[0] (at position start_pos) should attend to k[0:start_pos+1] - first start_pos+1 positions
-                    # q[1] (at position start_pos+1) should attend to k[0:start_pos+2] - first start_pos+2 positions
-                    # q[i] (at position start_pos+i) should attend to k[0:start_pos+i+1] - first start_pos+i+1 positions
-                    # This is a lower triangular mask but offset by start_pos
-                    # Create mask where row i has True for columns 0 to start_pos+i
-                    # Vectorized: create indices and use advanced indexing
-                    row_indices = torch.arange(T, device=q.device).unsqueeze(1)  # (T, 1)
-                    col_indices = torch.arange(seq_len, device=q.device).unsqueeze(0)  # (1, seq_len)
-                    # Mask is True where col <= start_pos + row
-                    causal_mask = (col_indices <= start_pos + row_indices)  # (T, seq_len)
-                    # Expand to (B, nh, T, seq_len) for batch and heads
-                    causal_mask = causal_mask.unsqueeze(0).unsqueeze(0).expand(B, self.n_heads, -1, -1)
+                    # Several new tokens after cached ones: q[i] attends to k[0:start_pos+i+1].
+                    # GPTJXForCausalLM builds this mask once per forward and passes it as
+                    # attn_mask; this only covers direct calls to the module
+                    causal_mask = self._offset_causal_mask(T, k.size(-2), q.device)
                     y = torch.nn.functional.scaled_dot_product_attention(
                         q, k, v,
                         attn_mask=causal_mask,
@@ -303,37 +1113,57 @@ class CausalSelfAttention(nn.Module):
             # Manual implementation of attention (fallback)
             # Use the full sequence length for attention computation
             seq_len = k.size(-2)
-            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(self.head_dim))
-            
-            # Apply causal mask (only if no custom mask provided)
-            if attn_mask is None:
-                # Create dynamic mask with power-of-2 sizing
-                if start_pos == 0:
-                    # Full sequence: use cached mask of appropriate size
-                    causal_mask = self._get_causal_mask(seq_len, att.device, dtype=torch.bool)
-                    # Slice to actual sequence length
-                    att = att.masked_fill(
-                        causal_mask[:, :, :T, :seq_len] == 0, 
-                        float('-inf')
-                    )
-                else:
-                    # Incremental decoding: create small mask on-the-fly
-                    causal_mask = torch.tril(torch.ones(T, seq_len, device=att.device, dtype=torch.bool))
-                    att = att.masked_fill(~causal_mask, float('-inf'))
+            if seq_len > ATTENTION_CHUNK_SIZE:
+                # Long sequences: tiled online softmax instead of a (T, seq_len) score matrix
+                y = chunked_attention(
+                    q, k, v, attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0
+                )
             else:
-                # Custom attention mask provided (for multitask learning, etc.)
-                # Apply custom mask directly
-                att = att.masked_fill(attn_mask == 0, float('-inf'))
-            
-            att = F.softmax(att, dim=-1)
-            att = self.attn_dropout(att)
-            y = att @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+                y = self._full_attention(q, k, v, start_pos, attn_mask)
         
         # Re-assemble all head outputs side by side
         y = y.transpose(1, 2).contiguous().view(B, T, C)
         # Output projection
         y = self.resid_dropout(self.c_proj(y))
+        if use_cache:
+            return y, present
         return y
+    
+    def _full_attention(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        start_pos: Union[int, torch.Tensor],
+        attn_mask: Optional[torch.Tensor],
+    ) -> torch.Tensor:
+        """Manual attention over the full (T, seq_len) score matrix, for short sequences."""
+        T, seq_len = q.size(-2), k.size(-2)
+        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(self.head_dim))
+        
+        # Apply causal mask (only if no custom mask provided)
+        if attn_mask is None:
+            # Create dynamic mask with power-of-2 sizing
+            if start_pos == 0:
+                # Full sequence: use cached mask of appropriate size
+                causal_mask = self._get_causal_mask(seq_len, att.device, dtype=torch.bool)
+                # Slice to actual sequence length
+                att = att.masked_fill(
+                    causal_mask[:, :, :T, :seq_len] == 0, 
+                    float('-inf')
+                )
+            elif T > 1:
+                # Incremental decoding of several tokens (a single new token sees every key)
+                causal_mask = self._offset_causal_mask(T, seq_len, att.device)
+                att = att.masked_fill(~causal_mask, float('-inf'))
+        else:
+            # Custom attention mask provided (for multitask learning, etc.)
+            # Apply custom mask directly
+            att = att.masked_fill(attn_mask == 0, float('-inf'))
+        
+        att = F.softmax(att, dim=-1)
+        att = self.attn_dropout(att)
+        return att @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
 
 
 class MLP(nn.Module):
@@ -368,22 +1198,37 @@ class BlockJ(nn.Module):
     def forward(
         self, 
         x: torch.Tensor, 
-        start_pos: int = 0, 
+        start_pos: Union[int, torch.Tensor] = 0, 
         *,
-        attn_mask: Optional[torch.Tensor] = None
-    ) -> torch.Tensor:
+        attn_mask: Optional[torch.Tensor] = None,
+        kv_cache: Optional["PagedKVCache"] = None,
+        layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        use_cache: Optional[bool] = None,
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, Optional[Tuple[torch.Tensor, torch.Tensor]]]]:
         """
         Forward pass through transformer block.
         
         Args:
             x: Input tensor
-            start_pos: Starting position for KV cache
+            start_pos: Starting position for KV cache (int, or per-row LongTensor)
             attn_mask: Optional custom attention mask (keyword-only argument)
+            kv_cache: Optional paged KV cache prepared for this forward pass
+            layer_past: Optional HuggingFace-style (k, v) of earlier tokens
+            use_cache: See CausalSelfAttention.forward; True also returns the present (k, v)
         """
         h = x
         x = self.ln_1(x)
-        x = h + self.attn(x, start_pos, attn_mask=attn_mask) + self.j(x)
+        attn_out = self.attn(
+            x, start_pos, attn_mask=attn_mask, kv_cache=kv_cache,
+            layer_past=layer_past, use_cache=use_cache,
+        )
+        present = None
+        if use_cache:
+            attn_out, present = attn_out
+        x = h + attn_out + self.j(x)
         x = x + self.mlp(self.ln_2(x))
+        if use_cache:
+            return x, present
         return x
 
 
@@ -433,6 +1278,18 @@ class GPTJXForCausalLM(PreTrainedModel):
             if pn.endswith('c_proj.weight'):
                 torch.nn.init.normal_(p, mean=0.0, std=0.02 / math.sqrt(2 * config.n_layer))
         
+        # Paged KV cache for incremental decoding, created on first use (see setup_kv_cache)
+        self._kv_cache: Optional[PagedKVCache] = None
+        self.kv_max_batch_size = config.max_batch_size
+        self.kv_cache_len = config.block_size
+        # Draft acceptance counts of the last speculative generate() call
+        self._speculative_stats: Dict[str, object] = {}
+        # Causal masks (non-flash attention) are shared by all layers under one byte budget
+        self.mask_cache = CausalMaskCache(config.block_size)
+        for i, block in enumerate(self.transformer.h):
+            block.attn.layer_idx = i
+            block.attn.mask_cache = self.mask_cache
+        
         # Report number of parameters
         print("number of parameters: %.2fM" % (self.get_num_params() / 1e6,))
     
@@ -465,74 +1322,184 @@ class GPTJXForCausalLM(PreTrainedModel):
         """Fixed: set transformer.wte instead of self.wte"""
         self.transformer.wte = new_embeddings
     
+    def _get_kv_cache(self, dtype: torch.dtype) -> PagedKVCache:
+        """Return the paged KV cache, creating it lazily (no memory until tokens arrive)."""
+        if self._kv_cache is None:
+            kv_dtype = self.config.kv_cache_dtype
+            if isinstance(kv_dtype, str):
+                kv_dtype = getattr(torch, kv_dtype, torch.float32)
+            # A float32 setting means "same as the activations"
+            cache_dtype = dtype if kv_dtype == torch.float32 else kv_dtype
+            self._kv_cache = PagedKVCache(
+                n_layer=self.config.n_layer,
+                n_heads=self.config.n_heads,
+                head_dim=self.config.n_embd // self.config.n_heads,
+                max_slots=self.kv_max_batch_size,
+                max_len=self.kv_cache_len,
+                page_size=self.config.kv_page_size,
+                device=self.transformer.ln_f.weight.device,
+                dtype=cache_dtype,
+                scale_dtype=dtype,
+            )
+        return self._kv_cache
+    
     def clear_kv_cache(self):
-        """Clear KV cache in all attention layers. Useful for resetting state."""
-        for block in self.transformer.h:
-            block.attn.clear_cache()
+        """Release every KV cache slot. Useful for resetting state."""
+        if self._kv_cache is not None:
+            self._kv_cache.reset()
     
     def free_kv_cache(self):
         """
-        Free KV cache memory in all attention layers.
+        Free KV cache memory.
         Useful for memory cleanup when switching between training and inference.
         """
-        for block in self.transformer.h:
-            block.attn.free_cache()
+        self._kv_cache = None
     
-    def forward(
-        self,
-        idx: torch.Tensor,
-        start_pos: int = 0,
-        targets: Optional[torch.Tensor] = None,
-        *,
-        attn_mask: Optional[torch.Tensor] = None,
-        output_hidden_states: Optional[bool] = None,
-        return_logits_only: bool = False,
-        **kwargs
-    ) -> CausalLMOutputWithPast:
-        """
+    def release_kv(self, slot: int):
+        """Return the KV cache pages of `slot` to the free list once its sequence is done."""
+        if self._kv_cache is not None:
+            self._kv_cache.release(slot)
+    
+    def kv_cache_stats(self) -> Dict[str, object]:
+        """Page usage of the KV cache (empty before the first cached forward)."""
+        return self._kv_cache.stats() if self._kv_cache is not None else {}
+    
+    def mask_cache_stats(self) -> Dict[str, object]:
+        """Size and hit/miss counters of the shared causal mask cache."""
+        return self.mask_cache.stats()
+    
+    def speculative_stats(self) -> Dict[str, object]:
+        """
+        Draft statistics of the last speculative generate() call (empty before one):
+        per-row drafted and accepted token counts, per-row acceptance rates, and the
+        number of verification passes of this model.
+        """
+        return self._speculative_stats
+    
+    def export_kv(self, slot: int, start: int, end: int) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Copy the cached keys/values of positions start..end-1 of KV cache slot `slot`.
+        
+        Returns:
+            One (k, v) pair per layer, each of shape (n_heads, end - start, head_dim)
+        """
+        return self._kv_cache.read(slot, start, end)
+    
+    def import_kv(self, slot: int, kv: List[Tuple[torch.Tensor, torch.Tensor]], start: int = 0):
+        """
+        Write per-layer keys/values (as returned by `export_kv`) into KV cache slot `slot`
+        starting at position `start`, so a later forward can continue from there.
+        """
+        self._get_kv_cache(self.transformer.ln_f.weight.dtype).write(slot, start, kv)
+    
+    def setup_kv_cache(self, max_batch_size: int, max_seq_len: Optional[int] = None):
+        """
+        Bound the KV cache to `max_batch_size` slots of up to `max_seq_len` tokens each
+        (default: block_size). Pages are only allocated for tokens actually cached, so
+        these are limits rather than a preallocation.
+        """
+        max_seq_len = max_seq_len or self.config.block_size
+        assert max_seq_len <= self.config.block_size
+        if (max_batch_size, max_seq_len) != (self.kv_max_batch_size, self.kv_cache_len):
+            self.free_kv_cache()
+            self.kv_max_batch_size = max_batch_size
+            self.kv_cache_len = max_seq_len
+    
+    @staticmethod
+    def _rowwise_causal_mask(start_pos: torch.Tensor, t: int) -> torch.Tensor:
+        """
+        Causal mask for rows that continue their sequences at different positions.
+        Query i of row b may attend to cached keys 0..start_pos[b]+i.
+        
+        Returns:
+            Boolean mask of shape (B, 1, t, max(start_pos) + t)
+        """
+        kv_len = int(start_pos.max()) + t
+        q_pos = start_pos.unsqueeze(1) + torch.arange(t, device=start_pos.device)  # (B, t)
+        k_pos = torch.arange(kv_len, device=start_pos.device)
+        return (k_pos.view(1, 1, -1) <= q_pos.unsqueeze(-1)).unsqueeze(1)
+    
+    @staticmethod
+    def _padding_causal_mask(attention_mask: torch.Tensor, start_pos: int, t: int) -> torch.Tensor:
+        """
+        Causal mask that also hides padded keys, for `t` new tokens after `start_pos` cached ones.
+        Each query may always attend to itself, so rows of padding tokens stay finite.
+        
+        Args:
+            attention_mask: Padding mask of shape (B, start_pos + t), 1 for real tokens
+        
+        Returns:
+            Boolean mask of shape (B, 1, t, start_pos + t)
+        """
+        kv_len = start_pos + t
+        q_pos = torch.arange(start_pos, kv_len, device=attention_mask.device).unsqueeze(1)  # (t, 1)
+        k_pos = torch.arange(kv_len, device=attention_mask.device).unsqueeze(0)  # (1, kv_len)
+        visible = (k_pos <= q_pos) & attention_mask[:, None, :kv_len].bool()  # (B, t, kv_len)
+        return (visible | (k_pos == q_pos)).unsqueeze(1)
+    
+    def forward(
+        self,
+        idx: torch.Tensor,
+        start_pos: Union[int, torch.Tensor] = 0,
+        targets: Optional[torch.Tensor] = None,
+        *,
+        attn_mask: Optional[torch.Tensor] = None,
+        cache_slots: Optional[torch.Tensor] = None,
+        past_key_values: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None,
+        use_cache: Optional[bool] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+        output_hidden_states: Optional[bool] = None,
+        return_logits_only: bool = False,
+        logits_to_keep: Union[int, torch.Tensor] = 0,
+        **kwargs
+    ) -> CausalLMOutputWithPast:
+        """
         Forward pass through the model.
         Matches original implementation exactly for consistent outputs.
         
         Args:
             idx: Input token indices of shape (B, T)
-            start_pos: Starting position for KV cache (for incremental decoding)
+            start_pos: Starting position for KV cache (for incremental decoding).
+                      A LongTensor of shape (B,) gives every row its own position, so
+                      sequences of different lengths can share one forward pass
+                      (continuous batching). Position embeddings then follow start_pos.
             targets: Target token indices for loss computation of shape (B, T)
             attn_mask: Optional custom attention mask (keyword-only argument).
                       If None, causal masks will be created dynamically.
                       Useful for multitask learning with custom masking patterns.
+            cache_slots: Optional LongTensor of shape (B,) selecting the KV cache slot of
+                      each batch row (keyword-only argument). Defaults to slots 0..B-1.
+            past_key_values: Optional HuggingFace-style cache, one (k, v) pair per layer of
+                      shape (B, nh, L, hs), from a previous call with use_cache=True. idx then
+                      holds only the tokens after those L positions.
+            use_cache: None (default) uses the internal KV cache driven by start_pos.
+                      True/False switches to HuggingFace-style caching through
+                      past_key_values, as used by transformers' generate(); with True the
+                      updated cache is returned in `past_key_values`.
+            attention_mask: Optional HuggingFace-style padding mask of shape (B, L + T),
+                      1 for real tokens and 0 for padding. Combined with the causal mask, and
+                      unless position_ids are given, each row's positions count only its
+                      real tokens (so left padding does not shift them).
+            position_ids: Optional positions of shape (B, T) overriding the ones implied by
+                      start_pos / past_key_values. Only changes position embeddings; the
+                      caller supplies a matching attn_mask.
             output_hidden_states: Whether to return hidden states
             return_logits_only: If True, return only logits tensor instead of CausalLMOutputWithPast
+            logits_to_keep: Positions lm_head is applied to when no targets are given
+                      (keyword-only argument). 0 keeps all of them, n > 0 keeps the last n,
+                      and a 1D LongTensor keeps those sequence indices. Generation only needs
+                      the last position, which skips a (B, T, vocab_size) projection.
         
         Returns:
             CausalLMOutputWithPast or logits tensor
         """
-        device = idx.device
-        b, t = idx.size()
-        
-        assert t <= self.config.block_size, (
-            f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
+        x, presents = self._forward_hidden(
+            idx, start_pos, attn_mask=attn_mask, cache_slots=cache_slots,
+            past_key_values=past_key_values, use_cache=use_cache,
+            attention_mask=attention_mask, position_ids=position_ids,
         )
         
-        # CRITICAL: Position embeddings always start from 0 for the current input
-        # This matches the original implementation exactly
-        # The KV cache handles remembering past positions, not position embeddings
-        pos = torch.arange(0, t, dtype=torch.long, device=device)  # shape (t)
-        
-        # Forward the GPT model itself
-        tok_emb = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos)  # position embeddings of shape (t, n_embd)
-        x = self.transformer.drop(tok_emb + pos_emb)
-        
-        # Note: attn_mask is passed through to blocks
-        # If None, each attention layer will create its own causal mask dynamically
-        # If provided, it will be used as-is (for custom masking patterns)
-        
-        # Pass through transformer blocks
-        for block in self.transformer.h:
-            x = block(x, start_pos, attn_mask=attn_mask)
-        
-        x = self.transformer.ln_f(x)
-        
         # Compute logits and loss
         if targets is not None:
             # Training: calculate loss
@@ -543,9 +1510,11 @@ class GPTJXForCausalLM(PreTrainedModel):
                 ignore_index=-100
             )
         else:
-            # Inference: compute logits for all positions (matches original)
-            # During generation, we'll take the last position's logits
-            logits = self.lm_head(x)
+            # Inference: compute logits for the requested positions (all by default)
+            if isinstance(logits_to_keep, int):
+                logits = self.lm_head(x[:, -logits_to_keep:] if logits_to_keep > 0 else x)
+            else:
+                logits = self.lm_head(x[:, logits_to_keep])
             loss = None
         
         if return_logits_only:
@@ -554,17 +1523,170 @@ class GPTJXForCausalLM(PreTrainedModel):
         return CausalLMOutputWithPast(
             loss=loss,
             logits=logits,
+            past_key_values=tuple(presents) if use_cache else None,
             hidden_states=x if output_hidden_states else None,
         )
     
-    def prepare_inputs_for_generation(self, input_ids, attention_mask=None, **kwargs):
-        # Default model inputs - matches original implementation
-        model_inputs = {"idx": input_ids}
-        # Add attention mask if provided
-        if attention_mask is not None:
-            model_inputs["attn_mask"] = attention_mask
+    def _forward_hidden(
+        self,
+        idx: torch.Tensor,
+        start_pos: Union[int, torch.Tensor] = 0,
+        *,
+        attn_mask: Optional[torch.Tensor] = None,
+        cache_slots: Optional[torch.Tensor] = None,
+        past_key_values: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None,
+        use_cache: Optional[bool] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+        num_layers: Optional[int] = None,
+    ) -> Tuple[torch.Tensor, Optional[List[Tuple[torch.Tensor, torch.Tensor]]]]:
+        """
+        Embeddings and transformer blocks of `forward` (same arguments), without lm_head.
+        `num_layers` exits early after the first num_layers blocks (ln_f is still applied),
+        which self-speculative decoding uses as its draft model.
+        
+        Returns:
+            (hidden, presents): final hidden states of shape (B, T, n_embd) after ln_f, and
+            the per-layer (k, v) when use_cache is True (else None)
+        """
+        device = idx.device
+        b, t = idx.size()
+        
+        assert t <= self.config.block_size, (
+            f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
+        )
+        
+        if past_key_values is not None:
+            # HuggingFace-style cache: the new tokens continue after the cached ones
+            start_pos = past_key_values[0][0].size(-2)
+        elif use_cache is not None:
+            start_pos = 0
+        
+        if isinstance(start_pos, torch.Tensor):
+            # Per-row positions (continuous batching): each row continues its own sequence,
+            # so positions and the causal mask are offset by that row's start_pos
+            pos = start_pos.unsqueeze(1) + torch.arange(0, t, dtype=torch.long, device=device)  # (b, t)
+            if attn_mask is None:
+                attn_mask = self._rowwise_causal_mask(start_pos, t)
+        else:
+            # Tokens fed after cached positions continue numbering from start_pos; a full
+            # forward (start_pos=0) matches the original implementation exactly
+            pos = torch.arange(start_pos, start_pos + t, dtype=torch.long, device=device)  # shape (t)
+            if attention_mask is not None and not bool(attention_mask.all()):
+                # Padded rows: positions count only each row's real tokens, so a left-padded
+                # prompt gets the same position embeddings as the unpadded one
+                if position_ids is None:
+                    pos = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)[:, start_pos:start_pos + t]
+                if attn_mask is None:
+                    attn_mask = self._padding_causal_mask(attention_mask, start_pos, t)
+            elif attn_mask is None and start_pos > 0 and t > 1:
+                # Several tokens after cached ones: build the offset causal mask once and
+                # share it across layers. Full forwards use is_causal and single-token
+                # decode needs no mask, so neither materializes one.
+                attn_mask = CausalSelfAttention._offset_causal_mask(t, start_pos + t, device)
+        
+        if position_ids is not None:
+            pos = position_ids
+        
+        # Internal paged KV cache: reserve pages for the positions fed in this pass
+        kv_cache = None
+        if self.config.use_kv_cache and not self.training and use_cache is None and past_key_values is None:
+            # ln_f stays in floating point in int8-quantized models (see quantization.py),
+            # unlike the embeddings, so it gives the activation dtype and device
+            kv_cache = self._get_kv_cache(self.transformer.ln_f.weight.dtype)
+            slots = cache_slots.tolist() if cache_slots is not None else list(range(b))
+            starts = start_pos.tolist() if isinstance(start_pos, torch.Tensor) else [start_pos] * b
+            kv_cache.prepare(slots, starts, t)
+        
+        # Forward the GPT model itself
+        # (int8 embedding lookups of quantized models need contiguous indices)
+        tok_emb = self.transformer.wte(idx.contiguous())  # token embeddings of shape (b, t, n_embd)
+        pos_emb = self.transformer.wpe(pos.contiguous())  # position embeddings of shape (t, n_embd) or (b, t, n_embd)
+        x = self.transformer.drop(tok_emb + pos_emb)
+        
+        # Note: attn_mask is passed through to blocks and shared by all of them
+        # If None, the layers need no explicit mask (full causal forward or single-token decode)
+        # If provided, it will be used as-is (for custom masking patterns)
+        
+        # Pass through transformer blocks
+        presents = [] if use_cache else None
+        for i, block in enumerate(self.transformer.h[:num_layers]):
+            layer_past = past_key_values[i] if past_key_values is not None else None
+            x = block(
+                x, start_pos, attn_mask=attn_mask, kv_cache=kv_cache,
+                layer_past=layer_past, use_cache=use_cache,
+            )
+            if use_cache:
+                x, present = x
+                presents.append(present)
+        
+        x = self.transformer.ln_f(x)
+        return x, presents
+    
+    @torch.no_grad()
+    def prefill(
+        self,
+        idx: torch.Tensor,
+        start_pos: Union[int, torch.Tensor] = 0,
+        *,
+        cache_slots: Optional[torch.Tensor] = None,
+        chunk_size: Optional[int] = None,
+    ) -> torch.Tensor:
+        """
+        Feed a prompt into the internal KV cache and return the next-token logits.
+        The prompt is processed in chunks of `chunk_size` tokens, each attending to the
+        cached ones, and lm_head only runs on the final position, so peak activation
+        memory follows the chunk size rather than the prompt length.
+        
+        Args:
+            idx: Token indices of shape (B, T) continuing after start_pos cached positions
+            start_pos: Number of positions already cached, an int or a LongTensor of shape
+                      (B,) (see forward)
+            cache_slots: Optional KV cache slot of each row (see forward)
+            chunk_size: Tokens per forward pass (None feeds the whole prompt at once)
+        
+        Returns:
+            Logits of the last position, shape (B, vocab_size)
+        """
+        t = idx.size(1)
+        chunk_size = chunk_size or t
+        for begin in range(0, t, chunk_size):
+            hidden, _ = self._forward_hidden(
+                idx[:, begin:begin + chunk_size], start_pos + begin, cache_slots=cache_slots
+            )
+        return self.lm_head(hidden[:, -1])
+    
+    def prepare_inputs_for_generation(
+        self, input_ids, past_key_values=None, attention_mask=None, use_cache=None, **kwargs
+    ):
+        """
+        Prepare inputs for transformers' generate().
+        Once a cache exists only the tokens it does not cover are fed, so every decoding
+        step is a single-token forward instead of a full re-run of the sequence.
+        """
+        if past_key_values is not None:
+            input_ids = input_ids[:, past_key_values[0][0].size(-2):]
+        model_inputs = {
+            "idx": input_ids,
+            "past_key_values": past_key_values,
+            "use_cache": use_cache if use_cache is not None else True,
+            "attention_mask": attention_mask,
+        }
+        # Newer transformers versions ask for the last position only
+        if kwargs.get("logits_to_keep") is not None:
+            model_inputs["logits_to_keep"] = kwargs["logits_to_keep"]
         return model_inputs
     
+    @staticmethod
+    def _reorder_cache(
+        past_key_values: Tuple[Tuple[torch.Tensor, torch.Tensor], ...], beam_idx: torch.Tensor
+    ) -> Tuple[Tuple[torch.Tensor, torch.Tensor], ...]:
+        """Select the cache rows of the surviving beams (used by transformers' beam search)."""
+        return tuple(
+            tuple(state.index_select(0, beam_idx.to(state.device)) for state in layer_past)
+            for layer_past in past_key_values
+        )
+    
     def crop_block_size(self, block_size: int):
         """Crop the model's block size to a smaller value."""
         assert block_size <= self.config.block_size
@@ -574,62 +1696,223 @@ class GPTJXForCausalLM(PreTrainedModel):
         # Update block_size in all attention layers
         for block in self.transformer.h:
             block.attn.block_size = block_size
-            # Clear mask cache (masks will be recreated with new size when needed)
-            block.attn._mask_cache.clear()
-            # Free and reinitialize cache if it was already allocated
-            if block.attn._cache_initialized:
-                block.attn.free_cache()
+        # Clear mask cache (masks will be recreated with new size when needed)
+        self.mask_cache.max_size = block_size
+        self.mask_cache.clear()
+        # Recreate the KV cache with the new length limit when it is next needed
+        self.kv_cache_len = min(self.kv_cache_len, block_size)
+        self.free_kv_cache()
+    
+    @torch.no_grad()
+    def score_labels(
+        self,
+        input_ids: List[List[int]],
+        label_ids: List[List[int]],
+        batch_size: int = 16,
+        normalize: bool = True,
+    ) -> torch.Tensor:
+        """
+        Score a fixed set of label continuations for many texts (classification finetunes).
+        
+        Each batch of texts is prefilled once (right-padded). All labels of a text are then
+        scored together in one forward over the prefill's past_key_values: the labels sit
+        side by side in a single row, the attention mask lets each label token see the text
+        and the earlier tokens of its own label only, and position ids continue from the
+        end of the text. Single-token labels need no second forward.
+        
+        Args:
+            input_ids: Token ids of each (already formatted) text
+            label_ids: Token ids of each candidate label continuation
+            batch_size: Number of texts scored together
+            normalize: If True, return probabilities over the label set; otherwise the
+                      log-likelihood of each label
+        
+        Returns:
+            Tensor of shape (num_texts, num_labels)
+        """
+        self.eval()
+        device = self.transformer.ln_f.weight.device
+        if not label_ids or any(len(label) == 0 for label in label_ids):
+            raise ValueError("Every label needs at least one token")
+        if any(len(text) == 0 for text in input_ids):
+            raise ValueError("Every text needs at least one token")
+        num_labels = len(label_ids)
+        label_len = max(len(label) for label in label_ids)
+        max_text_len = self.config.block_size - label_len
+        
+        # Labels laid out side by side: segment j of a row holds label j (right-padded)
+        labels = torch.zeros(num_labels, label_len, dtype=torch.long, device=device)
+        label_mask = torch.zeros(num_labels, label_len, dtype=torch.bool, device=device)
+        for j, label in enumerate(label_ids):
+            labels[j, :len(label)] = torch.tensor(label, device=device)
+            label_mask[j, :len(label)] = True
+        segment = torch.arange(num_labels * label_len, device=device) // label_len
+        offset = torch.arange(num_labels * label_len, device=device) % label_len
+        # Label token q may see label token k if both belong to the same label and k <= q
+        label_attn = (segment.unsqueeze(1) == segment.unsqueeze(0)) & (
+            offset.unsqueeze(0) <= offset.unsqueeze(1)
+        )
+        
+        scores = []
+        for i in range(0, len(input_ids), batch_size):
+            texts = [text[-max_text_len:] for text in input_ids[i:i + batch_size]]
+            bsz = len(texts)
+            lengths = torch.tensor([len(text) for text in texts], device=device)
+            idx = torch.zeros(bsz, int(lengths.max()), dtype=torch.long, device=device)
+            for b, text in enumerate(texts):
+                idx[b, :len(text)] = torch.tensor(text, device=device)
+            
+            # Prefill; right padding does not affect the real tokens under the causal mask.
+            # lm_head only runs on each text's last real token
+            hidden, presents = self._forward_hidden(idx, use_cache=True)
+            last_logits = self.lm_head(hidden[torch.arange(bsz, device=device), lengths - 1]).float()
+            log_likelihood = F.log_softmax(last_logits, dim=-1)[:, labels[:, 0]]  # (B, J)
+            
+            if label_len > 1:
+                prefix_len = idx.size(1)
+                prefix_visible = torch.arange(prefix_len, device=device) < lengths.unsqueeze(1)  # (B, L)
+                attn_mask = torch.cat([
+                    prefix_visible.unsqueeze(1).expand(-1, label_attn.size(0), -1),
+                    label_attn.unsqueeze(0).expand(bsz, -1, -1),
+                ], dim=-1).unsqueeze(1)  # (B, 1, J*Tl, L + J*Tl)
+                logits = self(
+                    labels.view(1, -1).expand(bsz, -1),
+                    past_key_values=tuple(presents),
+                    use_cache=False,
+                    position_ids=lengths.unsqueeze(1) + offset,
+                    attn_mask=attn_mask,
+                    return_logits_only=True,
+                ).float().view(bsz, num_labels, label_len, -1)
+                # Token t >= 1 of a label is predicted at position t - 1 of its segment
+                targets = labels[:, 1:].unsqueeze(0).unsqueeze(-1).expand(bsz, -1, -1, 1)
+                token_logits = logits[:, :, :-1].gather(-1, targets).squeeze(-1)
+                token_log_probs = token_logits - torch.logsumexp(logits[:, :, :-1], dim=-1)
+                log_likelihood = log_likelihood + (token_log_probs * label_mask[:, 1:]).sum(-1)
+            scores.append(log_likelihood)
+        
+        scores = torch.cat(scores)
+        return scores.softmax(dim=-1) if normalize else scores
     
     @torch.no_grad()
     def generate(
         self,
         input_ids: torch.Tensor,
-        max_new_tokens: int = 50,
-        do_sample: bool = True,
-        temperature: float = 0.8,
+        max_new_tokens: Union[int, List[int]] = 50,
+        do_sample: Union[bool, List[bool]] = True,
+        temperature: Union[float, List[float]] = 0.8,
         num_beams: int = 1,
-        repetition_penalty: float = 1.0,
-        top_k: Optional[int] = None,
-        top_p: Optional[float] = None,
+        repetition_penalty: Union[float, List[float]] = 1.0,
+        top_k: Union[Optional[int], List[Optional[int]]] = None,
+        top_p: Union[Optional[float], List[Optional[float]]] = None,
         length_penalty: float = 1.0,
         early_stopping: bool = False,
-        eos_token_id: Optional[int] = 1,
+        eos_token_id: Union[Optional[int], List[Optional[int]]] = 1,
         *,
         attn_mask: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        streamer=None,
+        presence_penalty: Union[float, List[float]] = 0.0,
+        frequency_penalty: Union[float, List[float]] = 0.0,
+        eos_check_interval: int = EOS_CHECK_INTERVAL,
+        seed: Union[None, int, List[Optional[int]]] = None,
+        prompt_lookup_num_tokens: Optional[int] = None,
+        prompt_lookup_max_ngram: int = PROMPT_LOOKUP_MAX_NGRAM,
+        assistant_early_exit: Optional[int] = None,
+        assistant_model: Optional["GPTJXForCausalLM"] = None,
+        num_assistant_tokens: int = NUM_ASSISTANT_TOKENS,
     ) -> torch.Tensor:
         """
         Custom generation method that matches original implementation exactly.
         Uses internal KV cache for efficient incremental decoding.
         
+        Without beam search, every decoding parameter except num_beams, length_penalty and
+        early_stopping may also be a list (or 1D tensor) with one value per row, so requests
+        with different settings (greedy and sampled alike) decode in one batch.
+        
         Args:
             input_ids: Input token indices of shape (batch_size, seq_len)
-            max_new_tokens: Maximum number of new tokens to generate
+            max_new_tokens: Maximum number of new tokens to generate (rows that reach their
+                      own limit are padded like finished rows)
             do_sample: Whether to use sampling (True) or greedy decoding (False)
             temperature: Sampling temperature (higher = more random)
             num_beams: Number of beams for beam search (1 = no beam search)
-            repetition_penalty: Penalty for repeating tokens (>1.0 reduces repetition)
+            repetition_penalty: Penalty for repeating tokens (>1.0 reduces repetition), applied
+                      to the last REPETITION_PENALTY_WINDOW tokens (prompt included)
             top_k: Top-k sampling: keep only top k logits
-            top_p: Nucleus sampling: keep tokens with cumulative probability <= top_p
+            top_p: Nucleus sampling: keep tokens with cumulative probability <= top_p (without
+                      top_k, the nucleus is looked for among the TOP_P_CANDIDATES most
+                      likely tokens first; see TokenSampler)
             length_penalty: Length penalty for beam search (>1.0 encourages longer sequences)
             early_stopping: Whether to stop beam search when all beams find EOS
-            eos_token_id: End-of-sequence token ID (None to disable)
+            eos_token_id: End-of-sequence token ID (None to disable). Finished rows are padded
+                      with their EOS id (0 without one)
             attn_mask: Optional attention mask for input sequence (keyword-only argument).
                       If None, causal masks will be created dynamically.
+            attention_mask: Optional padding mask of shape (batch_size, seq_len), 1 for real
+                      tokens and 0 for padding (keyword-only argument), so prompts of
+                      different lengths can be batched (left or right padded). Every row
+                      keeps its own positions and KV cache length. Beam search only takes
+                      left padding. Not supported together with attn_mask.
+            streamer: Optional object with `put(token_ids)` and `end()` methods, following the
+                      transformers streamer protocol (keyword-only argument). It receives the
+                      prompt first, then each new token as soon as it is decoded.
+                      Not supported with beam search.
+            presence_penalty: Subtracted once from the logit (before temperature) of every token
+                      generated so far (keyword-only argument). Not used by beam search.
+            frequency_penalty: Subtracted from a token's logit once per time it was generated
+                      (keyword-only argument). Not used by beam search.
+            eos_check_interval: Check for all sequences having finished every this many steps
+                      (keyword-only argument). The check syncs with the device; steps run past
+                      the last EOS are trimmed, so the output does not depend on it. With a
+                      streamer it is checked every step.
+            seed: Optional seed for sampling (keyword-only argument): one int for the whole
+                      batch, or one per row so each row's samples are reproducible on their own
+            prompt_lookup_num_tokens: Draft up to this many tokens per step by copying from
+                      the sequence (keyword-only argument, see prompt_lookup_draft) and verify
+                      them in one forward pass (see _generate_speculative). Greedy output is
+                      unchanged and sampling keeps its distribution. Presence/frequency
+                      penalties, per-row parameters, padding masks and streamers with batch
+                      size > 1 are not supported.
+            prompt_lookup_max_ngram: Longest n-gram matched when drafting (keyword-only argument)
+            assistant_early_exit: Self-speculative decoding (keyword-only argument): the first
+                      this many layers, followed by ln_f and lm_head, draft
+                      num_assistant_tokens tokens that the full model then verifies in one
+                      forward pass. Same guarantees and restrictions as prompt lookup decoding.
+            assistant_model: Draft-model speculative decoding (keyword-only argument): a
+                      smaller GPTJXForCausalLM with the same vocabulary drafts
+                      num_assistant_tokens tokens autoregressively in its own KV cache, and
+                      this model verifies them in one forward pass. Same guarantees and
+                      restrictions as prompt lookup decoding; acceptance rates are reported
+                      by speculative_stats().
+            num_assistant_tokens: Tokens drafted per step with assistant_early_exit or
+                      assistant_model (keyword-only argument)
         
         Returns:
-            Generated token indices of shape (batch_size, seq_len + generated_tokens)
+            Generated token indices of shape (batch_size, seq_len + generated_tokens). With
+            an attention_mask, input_ids are returned as given (padding included) and every
+            row's new tokens start at column seq_len.
         """
         self.eval()  # Ensure model is in eval mode
         
+        if streamer is not None and num_beams > 1:
+            raise ValueError("`streamer` cannot be used with beam search (num_beams > 1)")
+        
         bsz, seq_len = input_ids.size()
         device = input_ids.device
         
-        # Initialize generation state
-        generated_sequences = input_ids.clone()
-        finished = torch.zeros(bsz, dtype=torch.bool, device=device)
+        # Padded batch: rows are decoded with per-row positions (see below)
+        padded = attention_mask is not None and not bool(attention_mask.all())
+        if padded and attn_mask is not None:
+            raise ValueError("`attention_mask` padding is not supported together with `attn_mask`")
         
         # For beam search, we need to track multiple candidate sequences
         if num_beams > 1:
+            per_row = (
+                max_new_tokens, do_sample, temperature, repetition_penalty, top_k, top_p,
+                eos_token_id, presence_penalty, frequency_penalty, seed,
+            )
+            if any(isinstance(value, (list, tuple, torch.Tensor)) for value in per_row):
+                raise ValueError("Per-row decoding parameters are not supported with beam search")
             return self._generate_beam_search(
                 input_ids=input_ids,
                 attn_mask=attn_mask,
@@ -642,107 +1925,636 @@ class GPTJXForCausalLM(PreTrainedModel):
                 length_penalty=length_penalty,
                 early_stopping=early_stopping,
                 eos_token_id=eos_token_id,
+                attention_mask=attention_mask if padded else None,
+            )
+        
+        # Speculative decoding: drafts copied from the sequence (prompt lookup), proposed by
+        # the model's own lower layers (early exit) or by a smaller model, verified by this one
+        if prompt_lookup_num_tokens or assistant_early_exit or assistant_model is not None:
+            per_row = (
+                max_new_tokens, do_sample, temperature, repetition_penalty, top_k, top_p,
+                eos_token_id, presence_penalty, frequency_penalty, seed,
+            )
+            if any(isinstance(value, (list, tuple, torch.Tensor)) for value in per_row):
+                raise ValueError("Per-row decoding parameters are not supported with speculative decoding")
+            if presence_penalty or frequency_penalty or padded or attn_mask is not None:
+                raise ValueError(
+                    "Speculative decoding does not support presence/frequency penalties, "
+                    "`attention_mask` padding or `attn_mask`"
+                )
+            if bool(prompt_lookup_num_tokens) + bool(assistant_early_exit) + (assistant_model is not None) > 1:
+                raise ValueError(
+                    "Use only one of `prompt_lookup_num_tokens`, `assistant_early_exit` and `assistant_model`"
+                )
+            if streamer is not None and bsz > 1:
+                raise ValueError("`streamer` with speculative decoding needs batch size 1")
+            
+            if prompt_lookup_num_tokens:
+                def propose(rows, sequences, limits, sampler, repetition_penalty):
+                    drafts = [
+                        prompt_lookup_draft(sequences[b], min(prompt_lookup_num_tokens, limit), prompt_lookup_max_ngram)
+                        for b, limit in zip(rows, limits)
+                    ]
+                    return drafts, None
+            elif assistant_model is not None:
+                if assistant_model.config.vocab_size != self.config.vocab_size:
+                    raise ValueError(
+                        f"`assistant_model` has vocab_size {assistant_model.config.vocab_size}, "
+                        f"expected {self.config.vocab_size}"
+                    )
+                assistant_model.eval()
+                if bsz > assistant_model.kv_max_batch_size:
+                    assistant_model.setup_kv_cache(bsz, assistant_model.kv_cache_len)
+                assistant_model.clear_kv_cache()
+                # Tokens whose keys/values each row has in the assistant's cache
+                assistant_cached: List[List[int]] = [[] for _ in range(bsz)]
+                propose = functools.partial(
+                    assistant_model._assistant_draft, num_assistant_tokens, assistant_cached
+                )
+            else:
+                if not 0 < assistant_early_exit < self.config.n_layer:
+                    raise ValueError(
+                        f"`assistant_early_exit` must be between 1 and {self.config.n_layer - 1}, "
+                        f"got {assistant_early_exit}"
+                    )
+                propose = functools.partial(self._early_exit_draft, assistant_early_exit, num_assistant_tokens)
+            
+            # Uniform parameters: a one-row sampler applies to every row and drafted position
+            sampler = TokenSampler(
+                1, self.config.vocab_size, device,
+                do_sample=do_sample, temperature=temperature, top_k=top_k, top_p=top_p, seed=seed,
+            )
+            return self._generate_speculative(
+                input_ids,
+                max_new_tokens=max_new_tokens,
+                eos_token_id=eos_token_id,
+                repetition_penalty=repetition_penalty,
+                sampler=sampler,
+                propose=propose,
+                streamer=streamer,
             )
         
         # Standard autoregressive generation (greedy or sampling)
+        # Per-row limits and EOS ids (-1 never matches); finished rows are padded with
+        # their EOS id, or 0 without one
+        max_new = [int(n) for n in _per_row(max_new_tokens, bsz)]
+        eos_ids = [int(e) if e is not None else -1 for e in _per_row(eos_token_id, bsz)]
+        max_new_limits = torch.tensor(max_new, device=device)
+        eos_tokens = torch.tensor(eos_ids, dtype=input_ids.dtype, device=device)
+        pad_tokens = eos_tokens.clamp(min=0)
+        
+        # Tokens are written into a preallocated buffer instead of re-concatenating the
+        # sequence every step
+        tokens = pad_tokens.unsqueeze(1).repeat(1, seq_len + max(max_new, default=0))
+        tokens[:, :seq_len] = input_ids
         current_pos = seq_len
+        # Per-row lengths (up to and including EOS) and finished flags, kept on the device
+        lengths = torch.full((bsz,), seq_len, dtype=torch.long, device=device)
+        finished = max_new_limits <= 0
+        
+        # With padding, every row's real tokens are packed to the front of its buffer row,
+        # so row b's sequence occupies cache positions 0.. of its own slot and grows from
+        # prompt_lengths[b]. current_pos then tracks the longest row; row b is `shortfall[b]`
+        # tokens behind it and writes at current_pos - shortfall[b]. Rows shorter than the
+        # longest one leave stale entries past their end in the cache, which the per-row
+        # causal mask hides until they are overwritten.
+        shortfall = None
+        if padded:
+            prompt_lengths = attention_mask.long().sum(1)
+            if int(prompt_lengths.min()) < 1:
+                raise ValueError("Every row of `attention_mask` needs at least one real token")
+            order = torch.argsort((attention_mask == 0).to(torch.uint8), dim=1, stable=True)
+            tokens[:, :seq_len] = input_ids.gather(1, order)
+            current_pos = int(prompt_lengths.max())
+            shortfall = current_pos - prompt_lengths
+            lengths = prompt_lengths.clone()
+            # Window start of every row (row_start[b] is cache position 0 of row b)
+            row_start = torch.zeros_like(prompt_lengths)
+            rows = torch.arange(bsz, device=device)
+        
+        # The KV cache needs a slot per row
+        if bsz > self.kv_max_batch_size:
+            self.setup_kv_cache(bsz, self.kv_cache_len)
+        if streamer is not None:
+            eos_check_interval = 1
+        
+        # Longest sequence the KV cache (and position embeddings) can hold; once the
+        # sequence outgrows it, the model only sees the last max_len - 1 tokens
+        max_len = min(self.config.block_size, self.kv_cache_len)
+        window_start = 0
         
         # Clear KV cache at the start of generation
         self.clear_kv_cache()
         
-        for step in range(max_new_tokens):
-            # Crop sequence if it exceeds block_size
-            if current_pos >= self.config.block_size:
-                # Keep only the last block_size tokens
-                generated_sequences = generated_sequences[:, -self.config.block_size:]
-                current_pos = self.config.block_size
-                # Clear cache and recompute from scratch
-                self.clear_kv_cache()
+        if streamer is not None:
+            streamer.put(input_ids.cpu())
+        
+        sampler = TokenSampler(
+            bsz, self.config.vocab_size, device,
+            do_sample=do_sample, temperature=temperature, top_k=top_k, top_p=top_p, seed=seed,
+        )
+        
+        # Per-row penalties as (B, 1) tensors, only when some row uses them
+        rep_penalties = [float(p) for p in _per_row(repetition_penalty, bsz)]
+        rep_penalty = None
+        if any(p != 1.0 for p in rep_penalties):
+            rep_penalty = torch.tensor(rep_penalties, device=device).unsqueeze(1)
+        presence = [float(p) for p in _per_row(presence_penalty, bsz)]
+        frequency = [float(p) for p in _per_row(frequency_penalty, bsz)]
+        
+        # Per-sequence counts of generated tokens, updated incrementally each step
+        token_counts = None
+        if any(presence) or any(frequency):
+            token_counts = torch.zeros(bsz, self.config.vocab_size, device=device)
+            presence = torch.tensor(presence, device=device).unsqueeze(1)
+            frequency = torch.tensor(frequency, device=device).unsqueeze(1)
+        
+        needs_prefill = True
+        for step in range(max(max_new, default=0)):
+            # Slide the window if the next token would not fit
+            if current_pos - window_start >= max_len:
+                # Keep only the last max_len - 1 tokens; their positions change, so the
+                # cache is recomputed from scratch
+                window_start = current_pos - (max_len - 1)
+                needs_prefill = True
             
-            # Get the current input (last token or sequence)
-            if step == 0:
-                # First step: use full input sequence
-                current_input = generated_sequences
-                start_pos = 0
+            if shortfall is not None:
+                # Padded batch: each row continues at its own position
+                row_pos = current_pos - shortfall
+                if needs_prefill:
+                    # Every row's window, packed to the left; rows shorter than the longest
+                    # window are followed by stale tokens the causal mask keeps them from seeing
+                    row_start = (window_start - shortfall).clamp(min=0)
+                    cols = row_start.unsqueeze(1) + torch.arange(current_pos - window_start, device=device)
+                    current_input = tokens.gather(1, cols.clamp(max=tokens.size(1) - 1))
+                    hidden, _ = self._forward_hidden(current_input, 0)
+                    next_token_logits = self.lm_head(hidden[rows, row_pos - row_start - 1])
+                    needs_prefill = False
+                else:
+                    next_token_logits = self(
+                        tokens.gather(1, (row_pos - 1).unsqueeze(1)),
+                        start_pos=row_pos - 1 - row_start,
+                        return_logits_only=True,
+                    )[:, -1, :]
+                recent = torch.arange(min(REPETITION_PENALTY_WINDOW, current_pos - window_start), 0, -1, device=device)
+                recent_cols = torch.maximum(row_pos.unsqueeze(1) - recent, row_start.unsqueeze(1))
+                recent_tokens = tokens.gather(1, recent_cols)
             else:
-                # Subsequent steps: only use the last token (incremental decoding)
-                current_input = generated_sequences[:, -1:]
-                start_pos = current_pos - 1
+                # Get the current input (last token or sequence)
+                if needs_prefill:
+                    # Use the full window
+                    current_input = tokens[:, window_start:current_pos]
+                    start_pos = 0
+                    needs_prefill = False
+                else:
+                    # Subsequent steps: only use the last token (incremental decoding)
+                    current_input = tokens[:, current_pos - 1:current_pos]
+                    start_pos = current_pos - 1 - window_start
+                
+                # Forward pass - matches original implementation exactly; only the last
+                # position's logits are computed
+                logits = self(
+                    current_input,
+                    start_pos=start_pos,
+                    attn_mask=attn_mask,
+                    return_logits_only=True,
+                    logits_to_keep=1,
+                )
+                
+                # Shape is (B, 1, vocab_size)
+                next_token_logits = logits[:, -1, :]  # (B, vocab_size)
+                recent_tokens = tokens[:, max(window_start, current_pos - REPETITION_PENALTY_WINDOW):current_pos]
             
-            # Forward pass - matches original implementation exactly
-            logits = self(
-                current_input,
-                start_pos=start_pos,
-                attn_mask=attn_mask,
-                return_logits_only=True
-            )
+            # Penalties apply to the logits before temperature
+            # Apply repetition penalty over each sequence's recent tokens (no host sync)
+            if rep_penalty is not None:
+                next_token_logits = apply_repetition_penalty(next_token_logits, recent_tokens, rep_penalty)
             
-            # Get logits for the last position
-            # Shape is (B, T, vocab_size), take last position
-            next_token_logits = logits[:, -1, :] / temperature  # (B, vocab_size)
+            # Apply presence / frequency penalties from the running counts of generated tokens
+            if token_counts is not None:
+                next_token_logits = next_token_logits - (
+                    frequency * token_counts + presence * (token_counts > 0)
+                )
             
-            # Apply repetition penalty (works for batched generation)
-            if repetition_penalty != 1.0:
-                # Get recently generated tokens from each sequence in the batch
-                for batch_idx in range(bsz):
-                    if not finished[batch_idx]:  # Only apply to unfinished sequences
-                        # Get last 50 tokens from this sequence
-                        recent_tokens = generated_sequences[batch_idx, -50:].tolist()
-                        recent_token_set = set(recent_tokens)
-                        
-                        # Apply penalty to each recently seen token
-                        for token_id in recent_token_set:
-                            if next_token_logits[batch_idx, token_id] > 0:
-                                next_token_logits[batch_idx, token_id] /= repetition_penalty
-                            else:
-                                next_token_logits[batch_idx, token_id] *= repetition_penalty
+            # Temperature, top-k / top-p filtering and sampling (or argmax)
+            next_token = sampler(next_token_logits).unsqueeze(1)
             
-            # Apply top-k filtering
-            if top_k is not None and top_k > 0:
-                top_k = min(top_k, next_token_logits.size(-1))
-                indices_to_remove = next_token_logits < torch.topk(next_token_logits, top_k)[0][..., -1, None]
-                next_token_logits[indices_to_remove] = float('-inf')
+            # Handle finished sequences (force their padding token)
+            next_token = torch.where(finished.unsqueeze(1), pad_tokens.unsqueeze(1), next_token)
             
-            # Apply top-p (nucleus) filtering
-            if top_p is not None and top_p < 1.0:
-                sorted_logits, sorted_indices = torch.sort(next_token_logits, descending=True)
-                cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-                
-                # Remove tokens with cumulative probability above the threshold
-                sorted_indices_to_remove = cumulative_probs > top_p
-                # Shift the indices to the right to keep also the first token above the threshold
-                sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-                sorted_indices_to_remove[..., 0] = 0
-                
-                # Create a mask for indices to remove
-                indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
-                next_token_logits[indices_to_remove] = float('-inf')
+            # Write into the buffer; rows that were still running grow by one token, and
+            # finish on their EOS or their own max_new_tokens
+            if shortfall is not None:
+                tokens.scatter_(1, row_pos.unsqueeze(1), next_token)
+            else:
+                tokens[:, current_pos] = next_token.squeeze(1)
+            lengths += ~finished
+            finished |= (next_token.squeeze(1) == eos_tokens) | (max_new_limits <= step + 1)
+            if token_counts is not None:
+                token_counts.scatter_add_(1, next_token, torch.ones_like(next_token, dtype=token_counts.dtype))
+            current_pos += 1
             
-            # Sample or take argmax
-            if do_sample:
-                probs = F.softmax(next_token_logits, dim=-1)
-                next_token = torch.multinomial(probs, num_samples=1)
+            if streamer is not None:
+                streamer.put(next_token.cpu())
+            
+            # Early stopping if all sequences are finished (polled to avoid a sync per step)
+            if (step + 1) % eos_check_interval == 0 and finished.all():
+                break
+        
+        if streamer is not None:
+            streamer.end()
+        
+        if shortfall is not None:
+            # Back to the caller's layout: the prompt as given, then each row's new tokens
+            generated = int((lengths - prompt_lengths).max())
+            cols = prompt_lengths.unsqueeze(1) + torch.arange(generated, device=device)
+            return torch.cat([input_ids, tokens.gather(1, cols)], dim=1)
+        
+        # Drop the steps run after the last sequence finished
+        return tokens[:, :int(lengths.max())]
+    
+    @staticmethod
+    def _repetition_windows(sequences: List[List[int]], extra: List[List[int]], device: torch.device) -> torch.Tensor:
+        """
+        Repetition penalty windows at consecutive positions of speculative decoding.
+        Position i of row r sees the last REPETITION_PENALTY_WINDOW tokens of
+        sequences[r] + extra[r][:i]; short sequences are left-padded with their first token,
+        which is in the window anyway.
+        
+        Args:
+            sequences: Token ids of each row
+            extra: Drafted tokens following each row's sequence, all of the same length n
+        
+        Returns:
+            Token ids of shape (R, n + 1, REPETITION_PENALTY_WINDOW)
+        """
+        window = REPETITION_PENALTY_WINDOW
+        context = [
+            [seq[0]] * max(0, window - len(seq)) + seq[-window:] + list(tokens)
+            for seq, tokens in zip(sequences, extra)
+        ]
+        return torch.tensor(context, device=device).unfold(1, window, 1)
+    
+    @torch.no_grad()
+    def _early_exit_draft(
+        self,
+        num_layers: int,
+        num_tokens: int,
+        rows: List[int],
+        sequences: List[List[int]],
+        limits: List[int],
+        sampler: TokenSampler,
+        repetition_penalty: float,
+    ) -> Tuple[List[List[int]], Optional[torch.Tensor]]:
+        """
+        Draft tokens with the first `num_layers` blocks, ln_f and lm_head (self-speculation).
+        Each step feeds the newest token of every row through the lower layers only. Their
+        keys/values go into the same KV cache pages the full model uses; verification
+        rewrites the same positions, so the draft needs no cache of its own.
+        
+        Args:
+            num_layers: Blocks of the draft model
+            num_tokens: Tokens drafted per row (at most max(limits))
+            rows: KV cache slot of each row
+            sequences: Token ids of every batch row (the last one is not cached yet)
+            limits: Largest useful draft length of each row
+            sampler: Token selection shared with the verifying model
+            repetition_penalty: Applied to the draft logits like to the full model's
+        
+        Returns:
+            (drafts, probs): num_tokens drafted tokens per row and the draft distributions
+            they were sampled from, shape (R, num_tokens, vocab_size) (None when greedy)
+        """
+        num_tokens = min(num_tokens, max(limits))
+        seqs = [sequences[b] for b in rows]
+        device = self.transformer.ln_f.weight.device
+        slots = torch.tensor(rows, device=device)
+        positions = torch.tensor([len(seq) - 1 for seq in seqs], device=device)
+        tokens = torch.tensor([[seq[-1]] for seq in seqs], device=device)
+        
+        drafted: List[torch.Tensor] = []
+        probs: List[torch.Tensor] = []
+        for i in range(num_tokens):
+            hidden, _ = self._forward_hidden(tokens, positions + i, cache_slots=slots, num_layers=num_layers)
+            logits = self.lm_head(hidden[:, -1])
+            if repetition_penalty != 1.0:
+                extra = torch.stack(drafted, dim=1).tolist() if drafted else [[] for _ in rows]
+                windows = self._repetition_windows(seqs, extra, device)[:, -1]
+                logits = apply_repetition_penalty(logits, windows, repetition_penalty)
+            if sampler.any_sample:
+                q = sampler.probs(logits)
+                tokens = sampler._draw(q)
+                probs.append(q)
+            else:
+                tokens = logits.argmax(dim=-1, keepdim=True)
+            drafted.append(tokens.squeeze(1))
+        
+        if not drafted:
+            return [[] for _ in rows], None
+        drafts = torch.stack(drafted, dim=1).tolist()
+        return drafts, torch.stack(probs, dim=1) if probs else None
+    
+    @torch.no_grad()
+    def _assistant_draft(
+        self,
+        num_tokens: int,
+        cached: List[List[int]],
+        rows: List[int],
+        sequences: List[List[int]],
+        limits: List[int],
+        sampler: TokenSampler,
+        repetition_penalty: float,
+    ) -> Tuple[List[List[int]], Optional[torch.Tensor]]:
+        """
+        Draft tokens with this model on behalf of a larger one (draft-model speculation).
+        Called on the assistant; its KV cache slot b follows batch row b of the target.
+        Every call first feeds the tokens the cache does not hold yet (the prompt on the
+        first call; afterwards the target's verified token plus drafted tokens that
+        were accepted but never fed), then drafts one token per single-token forward.
+        Rows that would outgrow this model's context get no draft and decode normally.
+        
+        Args:
+            num_tokens: Tokens drafted per row (at most max(limits))
+            cached: Per batch row, the tokens whose keys/values this model has cached;
+                updated in place
+            rows: KV cache slot (batch row) of each running row
+            sequences: Token ids of every batch row
+            limits: Largest useful draft length of each row
+            sampler: Token selection shared with the verifying model
+            repetition_penalty: Applied to the draft logits like to the target's
+        
+        Returns:
+            (drafts, probs): drafted tokens per row and the distributions they were sampled
+            from, shape (R, num_tokens, vocab_size) (None when greedy)
+        """
+        num_tokens = min(num_tokens, max(limits))
+        max_len = min(self.config.block_size, self.kv_cache_len)
+        eligible = [r for r, b in enumerate(rows) if len(sequences[b]) + num_tokens <= max_len]
+        if num_tokens == 0 or not eligible:
+            return [[] for _ in rows], None
+        device = self.transformer.ln_f.weight.device
+        slots = [rows[r] for r in eligible]
+        seqs = [sequences[b] for b in slots]
+        
+        # Reuse the longest prefix still matching the sequence; rejected drafts are refed
+        valid = []
+        for b, seq in zip(slots, seqs):
+            n = 0
+            for a, t in zip(cached[b], seq):
+                if a != t:
+                    break
+                n += 1
+            valid.append(min(n, len(seq) - 1))
+        # Catch up with one forward; every row feeds the same number of tokens, ending
+        # with its last one (already cached tokens are recomputed to identical values)
+        width = max(len(seq) - n for seq, n in zip(seqs, valid))
+        starts = [max(0, len(seq) - width) for seq in seqs]
+        feed = [
+            seq[start:start + width] + [seq[-1]] * (start + width - len(seq))
+            for seq, start in zip(seqs, starts)
+        ]
+        slot_ids = torch.tensor(slots, device=device)
+        hidden, _ = self._forward_hidden(
+            torch.tensor(feed, device=device), torch.tensor(starts, device=device), cache_slots=slot_ids
+        )
+        last = torch.tensor([len(seq) - 1 - start for seq, start in zip(seqs, starts)], device=device)
+        logits = self.lm_head(hidden[torch.arange(len(slots), device=device), last])
+        positions = torch.tensor([len(seq) for seq in seqs], device=device)
+        
+        drafted: List[torch.Tensor] = []
+        probs: List[torch.Tensor] = []
+        for i in range(num_tokens):
+            if i:
+                logits = self(
+                    tokens, positions + i - 1, cache_slots=slot_ids, return_logits_only=True
+                )[:, -1]
+            if repetition_penalty != 1.0:
+                extra = torch.stack(drafted, dim=1).tolist() if drafted else [[] for _ in slots]
+                windows = self._repetition_windows(seqs, extra, device)[:, -1]
+                logits = apply_repetition_penalty(logits, windows, repetition_penalty)
+            if sampler.any_sample:
+                q = sampler.probs(logits)
+                tokens = sampler._draw(q)
+                probs.append(q)
             else:
-                next_token = torch.argmax(next_token_logits, dim=-1, keepdim=True)
+                tokens = logits.argmax(dim=-1, keepdim=True)
+            drafted.append(tokens.squeeze(1))
+        
+        drafts = torch.stack(drafted, dim=1).tolist()
+        for b, seq, draft in zip(slots, seqs, drafts):
+            # The last drafted token was never fed
+            cached[b] = seq + draft[:-1]
+        
+        # Back to all running rows; ineligible ones get an empty draft
+        all_drafts: List[List[int]] = [[] for _ in rows]
+        for r, draft in zip(eligible, drafts):
+            all_drafts[r] = draft
+        all_probs = None
+        if probs:
+            all_probs = torch.zeros(len(rows), num_tokens, self.config.vocab_size, device=device)
+            all_probs[torch.tensor(eligible, device=device)] = torch.stack(probs, dim=1)
+        return all_drafts, all_probs
+    
+    @torch.no_grad()
+    def _generate_speculative(
+        self,
+        input_ids: torch.Tensor,
+        max_new_tokens: int,
+        eos_token_id: Optional[int],
+        repetition_penalty: float,
+        sampler: TokenSampler,
+        propose: Callable[..., Tuple[List[List[int]], Optional[torch.Tensor]]],
+        streamer=None,
+    ) -> torch.Tensor:
+        """
+        Draft-and-verify (speculative) decoding.
+        
+        Every step, `propose` drafts a continuation for each running row. One forward pass
+        over the row's last token followed by its draft scores every drafted position.
+        Greedy rows keep the drafted tokens that equal the argmax, then the model's own
+        choice after them, so the output is the greedy one. Sampled rows use speculative
+        sampling: drafted token d, proposed with probability q(d), is accepted with
+        probability min(1, p(d) / q(d)) under the model's distribution p; the first
+        rejected position is resampled from max(p - q, 0), renormalized, and a fully
+        accepted draft adds a token sampled from p. Tokens are thus distributed exactly as
+        in plain sampling. An accepted draft of n tokens advances the row by n + 1 tokens
+        in a single pass of the full model.
+        
+        Rows continue at their own positions (per-row start_pos); keys/values of rejected
+        positions stay in the KV cache past the row's end and are overwritten by the next
+        step.
+        
+        Args:
+            input_ids: Prompts of shape (batch_size, seq_len)
+            max_new_tokens: Maximum number of new tokens per row (capped so the sequence
+                fits the KV cache)
+            eos_token_id: Rows stop after this token (None to disable)
+            repetition_penalty: Applied at every drafted position to the
+                REPETITION_PENALTY_WINDOW tokens before it
+            sampler: Token selection, built for one row (uniform parameters)
+            propose: Called as propose(rows, sequences, limits, sampler, repetition_penalty)
+                with the running rows, every row's token ids and the longest useful draft of
+                each running row. Returns the drafts and, for sampled drafts, their
+                distributions of shape (R, G, vocab_size) (None means each drafted token had
+                probability 1)
+            streamer: Optional streamer (batch size 1); receives the accepted tokens of
+                each step at once
+        
+        Returns:
+            Token indices of shape (batch_size, seq_len + generated_tokens); rows that
+            finished early are padded with eos_token_id (0 without one)
+        """
+        bsz, seq_len = input_ids.size()
+        device = input_ids.device
+        max_len = min(self.config.block_size, self.kv_cache_len)
+        max_new_tokens = min(max_new_tokens, max_len - seq_len)
+        
+        if bsz > self.kv_max_batch_size:
+            self.setup_kv_cache(bsz, self.kv_cache_len)
+        self.clear_kv_cache()
+        if streamer is not None:
+            streamer.put(input_ids.cpu())
+        
+        # The cache holds every token but each row's last one, which the next step feeds
+        if seq_len > 1:
+            self.prefill(input_ids[:, :-1])
+        sequences = input_ids.tolist()
+        generated = [0] * bsz
+        running = list(range(bsz)) if max_new_tokens > 0 else []
+        num_drafted = [0] * bsz
+        num_accepted = [0] * bsz
+        verify_passes = 0
+        
+        while running:
+            # The verified token is always added, so drafts fill the rest of the budget.
+            # Shorter drafts are padded to the longest, which must fit every row's cache.
+            room = min(max_len - len(sequences[b]) for b in running)
+            limits = [min(max_new_tokens - generated[b] - 1, room) for b in running]
+            drafts, draft_probs = propose(running, sequences, limits, sampler, repetition_penalty)
+            drafts = [draft[:limit] for draft, limit in zip(drafts, limits)]
+            width = 1 + max(len(draft) for draft in drafts)
+            rows = [
+                [sequences[b][-1]] + draft + [sequences[b][-1]] * (width - 1 - len(draft))
+                for b, draft in zip(running, drafts)
+            ]
+            inputs = torch.tensor(rows, dtype=input_ids.dtype, device=device)
+            starts = torch.tensor([len(sequences[b]) - 1 for b in running], device=device)
+            logits = self(
+                inputs, starts, cache_slots=torch.tensor(running, device=device), return_logits_only=True
+            )  # (R, width, vocab_size)
+            verify_passes += 1
             
-            # Handle finished sequences (force EOS token)
-            if eos_token_id is not None:
-                next_token = torch.where(
-                    finished.unsqueeze(1),
-                    torch.tensor(eos_token_id, device=device).expand_as(next_token),
-                    next_token
-                )
-                finished |= (next_token.squeeze(1) == eos_token_id)
+            if repetition_penalty != 1.0:
+                windows = self._repetition_windows([sequences[b] for b in running], [row[1:] for row in rows], device)
+                logits = apply_repetition_penalty(
+                    logits.view(-1, logits.size(-1)), windows.reshape(-1, windows.size(-1)), repetition_penalty
+                ).view(logits.shape)
             
-            # Append to sequence
-            generated_sequences = torch.cat([generated_sequences, next_token], dim=1)
-            current_pos += 1
+            draft_lens = [len(draft) for draft in drafts]
+            if sampler.any_sample:
+                accepted, next_tokens = self._speculative_accept(
+                    logits, inputs[:, 1:], draft_lens, draft_probs, sampler
+                )
+            else:
+                choices = logits.argmax(dim=-1).tolist()
+                accepted = []
+                for draft, choice in zip(drafts, choices):
+                    n = 0
+                    while n < len(draft) and draft[n] == choice[n]:
+                        n += 1
+                    accepted.append(n)
+                next_tokens = [choice[n] for n, choice in zip(accepted, choices)]
             
-            # Early stopping if all sequences are finished
-            if eos_token_id is not None and finished.all():
-                break
+            still_running = []
+            for b, draft, n, token in zip(running, drafts, accepted, next_tokens):
+                num_drafted[b] += len(draft)
+                num_accepted[b] += n
+                new_tokens = draft[:n] + [token]
+                if eos_token_id is not None and eos_token_id in new_tokens:
+                    new_tokens = new_tokens[:new_tokens.index(eos_token_id) + 1]
+                sequences[b].extend(new_tokens)
+                generated[b] += len(new_tokens)
+                if streamer is not None:
+                    streamer.put(torch.tensor([new_tokens]))
+                if new_tokens[-1] != eos_token_id and generated[b] < max_new_tokens:
+                    still_running.append(b)
+            running = still_running
+        
+        if streamer is not None:
+            streamer.end()
+        
+        self._speculative_stats = {
+            "drafted": num_drafted,
+            "accepted": num_accepted,
+            "acceptance_rate": [a / d if d else 0.0 for a, d in zip(num_accepted, num_drafted)],
+            "verify_passes": verify_passes,
+        }
+        
+        pad_id = eos_token_id if eos_token_id is not None else 0
+        output = torch.full((bsz, max(len(seq) for seq in sequences)), pad_id, dtype=input_ids.dtype)
+        for b, seq in enumerate(sequences):
+            output[b, :len(seq)] = torch.tensor(seq)
+        return output.to(device)
+    
+    @staticmethod
+    def _speculative_accept(
+        logits: torch.Tensor,
+        drafts: torch.Tensor,
+        draft_lens: List[int],
+        draft_probs: Optional[torch.Tensor],
+        sampler: TokenSampler,
+    ) -> Tuple[List[int], List[int]]:
+        """
+        Speculative sampling acceptance for a batch of drafts (see _generate_speculative).
+        
+        Args:
+            logits: Model logits of shape (R, G + 1, vocab_size) at the last token and the
+                G drafted positions
+            drafts: Drafted tokens of shape (R, G), padded past each row's draft length
+            draft_lens: Draft length of each row
+            draft_probs: Distributions the drafts were sampled from, shape (R, G', vocab_size)
+                with G' >= max(draft_lens), or None for deterministic drafts
+            sampler: Turns logits into the model's distribution p and draws tokens
         
-        return generated_sequences
+        Returns:
+            (accepted, next_tokens): number of accepted drafted tokens of each row and the
+            token sampled after them
+        """
+        R, width, vocab_size = logits.shape
+        num_drafted = width - 1
+        device = logits.device
+        p = sampler.probs(logits.view(-1, vocab_size)).view(R, width, vocab_size)
+        lens = torch.tensor(draft_lens, device=device)
+        rows = torch.arange(R, device=device)
+        
+        if num_drafted:
+            p_draft = p[:, :-1].gather(2, drafts.unsqueeze(2)).squeeze(2)  # (R, G)
+            if draft_probs is not None:
+                q_draft = draft_probs[:, :num_drafted].gather(2, drafts.unsqueeze(2)).squeeze(2)
+            else:
+                q_draft = torch.ones_like(p_draft)
+            # Accept with probability min(1, p / q); padding positions are never accepted
+            u = torch.rand(R, num_drafted, device=device, generator=sampler.generator)
+            ok = (u * q_draft < p_draft) & (torch.arange(num_drafted, device=device) < lens.unsqueeze(1))
+            accepted = ok.long().cumprod(dim=1).sum(dim=1)
+        else:
+            accepted = torch.zeros(R, dtype=torch.long, device=device)
+        
+        # After a rejection sample from max(p - q, 0); after a full draft, from p
+        dist = p[rows, accepted]
+        rejected = accepted < lens
+        if num_drafted:
+            position = accepted.clamp(max=num_drafted - 1)
+            if draft_probs is not None:
+                q = draft_probs[rows, position]
+            else:
+                q = F.one_hot(drafts[rows, position], vocab_size).to(dist.dtype)
+            residual = (dist - q).clamp(min=0)
+            # p == q (up to rounding) leaves no residual mass; p itself is then exact
+            usable = rejected & (residual.sum(dim=-1) > 0)
+            dist = torch.where(usable.unsqueeze(1), residual, dist)
+        next_tokens = sampler._draw(dist).squeeze(1)
+        return accepted.tolist(), next_tokens.tolist()
     
     def _generate_beam_search(
         self,
@@ -757,89 +2569,164 @@ class GPTJXForCausalLM(PreTrainedModel):
         length_penalty: float,
         early_stopping: bool,
         eos_token_id: Optional[int],
+        attention_mask: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         """
-        Beam search generation implementation.
+        Batched beam search over a flattened (batch_size * num_beams) layout.
+        
+        Every beam of every batch item advances with one single-token forward per step,
+        reusing a KV cache (past_key_values) that is reordered to follow the surviving beams.
+        Each beam proposes its top 2 * num_beams tokens (probabilities are a softmax over
+        those candidates) and a beam's score adds log(prob) / length_penalty ** step.
+        Per batch item, the best num_beams unfinished candidates continue, and candidates
+        ending in EOS move to a heap of the num_beams best finished hypotheses.
+        Scores never increase, so an item is done as soon as no live beam can beat its
+        worst finished hypothesis; `early_stopping` therefore changes nothing.
+        `attn_mask` and `top_p` are not used by beam search.
         
-        This is a simplified beam search. For production use, consider using
-        HuggingFace's built-in beam search which is more optimized.
+        Prompts of different lengths are batched left padded with an `attention_mask`: every
+        beam carries its item's mask, extended by one real position per step, so positions
+        and attention skip the padding and the repetition penalty never sees it.
+        
+        Returns:
+            Best hypothesis per batch item, shape (batch_size, seq_len + generated_tokens).
+            Shorter hypotheses are padded with eos_token_id. With an attention_mask, the
+            prompt columns are returned as given (padding included).
         """
         bsz, seq_len = input_ids.size()
         device = input_ids.device
+        max_new_tokens = min(max_new_tokens, self.config.block_size - seq_len)
         
-        # Initialize beams: (batch_size * num_beams, seq_len)
-        # For simplicity, we'll do beam search per batch item
-        if bsz > 1:
-            # For batched beam search, we'd need to handle this more carefully
-            # This is a simplified version that processes one batch at a time
-            results = []
-            for i in range(bsz):
-                single_input = input_ids[i:i+1]
-                single_result = self._generate_beam_search(
-                    single_input, attn_mask, max_new_tokens, num_beams,
-                    temperature, top_k, top_p, repetition_penalty,
-                    length_penalty, early_stopping, eos_token_id
-                )
-                results.append(single_result)
-            return torch.cat(results, dim=0)
+        # Left padding: the first real column of every row (0 without padding)
+        first_real = None
+        if attention_mask is not None:
+            first_real = (attention_mask == 0).long().sum(1)
+            columns = torch.arange(seq_len, device=device)
+            if not bool((attention_mask.bool() == (columns >= first_real.unsqueeze(1))).all()):
+                raise ValueError("Beam search only supports left padding in `attention_mask`")
+            if int(first_real.max()) >= seq_len:
+                raise ValueError("Every row of `attention_mask` needs at least one real token")
+        
+        # Prefill each prompt once, then copy its cache to all of its beams
+        outputs = self(
+            input_ids, past_key_values=None, use_cache=True, attention_mask=attention_mask, logits_to_keep=1
+        )
+        beam_origin = torch.arange(bsz, device=device).repeat_interleave(num_beams)
+        past_key_values = self._reorder_cache(outputs.past_key_values, beam_origin)
+        logits = outputs.logits[:, -1, :].index_select(0, beam_origin)  # (B*K, vocab_size)
+        sequences = input_ids.index_select(0, beam_origin)  # (B*K, T)
+        if attention_mask is not None:
+            attention_mask = attention_mask.index_select(0, beam_origin)
+            first_real = first_real.index_select(0, beam_origin)
+        
+        # Only the first beam of each item is live until the first expansion
+        beam_scores = torch.full((bsz, num_beams), float('-inf'), device=device)
+        beam_scores[:, 0] = 0.0
+        beam_scores = beam_scores.view(-1)
+        
+        num_candidates = min(num_beams * 2, logits.size(-1))
+        if top_k is not None:
+            num_candidates = min(num_candidates, top_k)
+        num_ranked = min(num_beams * 2, num_beams * num_candidates)
+        batch_offsets = torch.arange(bsz, device=device).unsqueeze(1) * num_beams  # (B, 1)
         
-        # Single batch item beam search
-        # Initialize beam hypotheses
-        beams = [(input_ids.clone(), 0.0)]  # (sequence, score)
+        # Min-heaps of (score, tiebreak, tokens) holding each item's best finished hypotheses
+        finished: List[List[Tuple[float, int, torch.Tensor]]] = [[] for _ in range(bsz)]
+        tiebreak = itertools.count()
+        done = [False] * bsz
         
         for step in range(max_new_tokens):
-            candidates = []
+            next_token_logits = logits / temperature
             
-            for seq, score in beams:
-                # Check if sequence is finished
-                if eos_token_id is not None and seq[0, -1].item() == eos_token_id:
-                    candidates.append((seq, score))
+            # Apply repetition penalty to each beam's recent tokens
+            if repetition_penalty != 1.0:
+                recent_tokens = sequences[:, -REPETITION_PENALTY_WINDOW:]
+                if first_real is not None:
+                    # Columns before a row's first real token repeat that token instead
+                    recent = torch.arange(recent_tokens.size(1), 0, -1, device=device)
+                    recent_cols = torch.maximum(sequences.size(1) - recent, first_real.unsqueeze(1))
+                    recent_tokens = sequences.gather(1, recent_cols)
+                next_token_logits = apply_repetition_penalty(
+                    next_token_logits, recent_tokens, repetition_penalty
+                )
+            
+            # Candidate scores for every (beam, token) pair of each batch item
+            top_logits, top_tokens = torch.topk(next_token_logits, num_candidates)  # (B*K, C)
+            step_scores = F.log_softmax(top_logits.float(), dim=-1) / (length_penalty ** (step + 1))
+            candidate_scores = (beam_scores.unsqueeze(1) + step_scores).view(bsz, -1)  # (B, K*C)
+            
+            # Best 2K candidates per item; each beam proposes EOS at most once, so at
+            # least K of them continue unless there are fewer candidates than beams
+            ranked_scores, ranked_pos = torch.topk(candidate_scores, num_ranked, dim=1)
+            ranked_beams = ranked_pos // num_candidates
+            ranked_tokens = top_tokens.view(bsz, -1).gather(1, ranked_pos)
+            if eos_token_id is not None:
+                ranked_eos = ranked_tokens == eos_token_id
+            else:
+                ranked_eos = torch.zeros_like(ranked_tokens, dtype=torch.bool)
+            
+            # EOS candidates ranked within the top K become finished hypotheses
+            new_finished = ranked_eos[:, :num_beams] & torch.isfinite(ranked_scores[:, :num_beams])
+            for b, rank in new_finished.nonzero().tolist():
+                if done[b]:
                     continue
-                
-                # Forward pass - always pass full sequence, no KV cache for beam search
-                # This matches the original implementation
-                logits = self(seq, start_pos=0, return_logits_only=True)
-                # Logits shape is (B, T, vocab_size), take last position
-                next_token_logits = logits[:, -1, :] / temperature  # (B, vocab_size)
-                
-                # Apply repetition penalty
-                if repetition_penalty != 1.0:
-                    generated_tokens = seq[0].tolist()
-                    recent_tokens = set(generated_tokens[-50:])
-                    for token_id in recent_tokens:
-                        if next_token_logits[0, token_id] > 0:
-                            next_token_logits[0, token_id] /= repetition_penalty
-                        else:
-                            next_token_logits[0, token_id] *= repetition_penalty
-                
-                # Get top-k candidates
-                top_k_candidates = min(num_beams * 2, next_token_logits.size(-1))
-                if top_k is not None:
-                    top_k_candidates = min(top_k_candidates, top_k)
-                
-                top_logits, top_indices = torch.topk(next_token_logits, top_k_candidates)
-                top_probs = F.softmax(top_logits, dim=-1)
-                
-                # Create candidate sequences
-                for i in range(top_k_candidates):
-                    token_id = top_indices[0, i].item()
-                    token_prob = top_probs[0, i].item()
-                    new_seq = torch.cat([seq, torch.tensor([[token_id]], device=device)], dim=1)
-                    # Apply length penalty
-                    new_score = score + math.log(token_prob) / (length_penalty ** (step + 1))
-                    candidates.append((new_seq, new_score))
+                score = float(ranked_scores[b, rank])
+                heap = finished[b]
+                if len(heap) < num_beams or score > heap[0][0]:
+                    row = b * num_beams + int(ranked_beams[b, rank])
+                    tokens = torch.cat([sequences[row], ranked_tokens[b, rank:rank + 1]])
+                    entry = (score, next(tiebreak), tokens)
+                    if len(heap) < num_beams:
+                        heapq.heappush(heap, entry)
+                    else:
+                        heapq.heapreplace(heap, entry)
             
-            # Select top num_beams candidates
-            candidates.sort(key=lambda x: x[1], reverse=True)
-            beams = candidates[:num_beams]
+            # The first K non-EOS candidates (in score order) become the next beams
+            rank = torch.arange(num_ranked, device=device)
+            order = (ranked_eos.long() * num_ranked + rank).argsort(dim=1)[:, :num_beams]
+            next_scores = ranked_scores.gather(1, order)
+            next_scores = next_scores.masked_fill(ranked_eos.gather(1, order), float('-inf'))
+            next_tokens = ranked_tokens.gather(1, order).view(-1, 1)
+            beam_idx = (batch_offsets + ranked_beams.gather(1, order)).view(-1)
             
-            # Early stopping check
-            if early_stopping and eos_token_id is not None:
-                if all(beam[0][0, -1].item() == eos_token_id for beam in beams):
-                    break
+            sequences = torch.cat([sequences.index_select(0, beam_idx), next_tokens], dim=1)
+            beam_scores = next_scores.view(-1)
+            
+            # An item is done once its heap is full and no live beam can still beat it
+            best_live = next_scores[:, 0].tolist()
+            for b in range(bsz):
+                heap = finished[b]
+                if not done[b] and len(heap) == num_beams and best_live[b] <= heap[0][0]:
+                    done[b] = True
+            if all(done) or step == max_new_tokens - 1:
+                break
+            
+            # One forward for all beams of all items
+            past_key_values = self._reorder_cache(past_key_values, beam_idx)
+            if attention_mask is not None:
+                # Beams never leave their item, so the masks only grow by the new token
+                attention_mask = F.pad(attention_mask, (0, 1), value=1)
+            outputs = self(
+                next_tokens, past_key_values=past_key_values, use_cache=True, attention_mask=attention_mask
+            )
+            past_key_values = outputs.past_key_values
+            logits = outputs.logits[:, -1, :]
+        
+        # Best hypothesis per item among its finished ones and (if not done) its live beams
+        best_live = beam_scores.view(bsz, num_beams)[:, 0].tolist()
+        results = []
+        for b in range(bsz):
+            candidates = [(score, tokens) for score, _, tokens in finished[b]]
+            if not done[b]:
+                candidates.append((best_live[b], sequences[b * num_beams]))
+            results.append(max(candidates, key=lambda c: c[0])[1])
         
-        # Return the best sequence
-        return beams[0][0]
+        max_len = max(tokens.size(0) for tokens in results)
+        pad_id = eos_token_id if eos_token_id is not None else 0
+        output = torch.full((bsz, max_len), pad_id, dtype=input_ids.dtype, device=device)
+        for b, tokens in enumerate(results):
+            output[b, :tokens.size(0)] = tokens
+        return output
 
 
 # Register model with HuggingFace
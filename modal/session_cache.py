@@ -0,0 +1,159 @@
+"""
+Per-session KV cache store for multi-turn SabiYarn chat.
+
+Every chat turn re-sends the whole conversation, so without reuse each turn prefills
+the full history again. This store keeps, per `session_id`, the token ids the model has
+already processed together with their per-layer keys/values. The next turn reuses the
+longest common token prefix (the history is re-tokenized each turn, so the stored ids
+are validated rather than trusted) and only prefills what was appended.
+Idle sessions expire after a TTL, and least recently used sessions are dropped once the
+byte budget is exceeded.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+KV = List[Tuple[torch.Tensor, torch.Tensor]]
+
+# Byte budget for cached session K/V and idle time after which a session is dropped
+DEFAULT_SESSION_CACHE_MB = int(os.environ.get("SABIYARN_SESSION_CACHE_MB", "2048"))
+DEFAULT_SESSION_TTL_SECONDS = float(os.environ.get("SABIYARN_SESSION_TTL_S", "1800"))
+
+
+class _Session:
+    """Token ids processed for one session and their per-layer K/V."""
+
+    __slots__ = ("tokens", "kv", "nbytes", "last_used")
+
+    def __init__(self, tokens: Tuple[int, ...], kv: KV):
+        self.tokens = tokens
+        self.kv = kv
+        self.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+        self.last_used = time.monotonic()
+
+
+class SessionKVCache:
+    """
+    Session id -> (token ids, K/V) store with TTL and LRU byte-budget eviction.
+
+    Usage (see ContinuousBatchScheduler):
+        length, kv = cache.match(session_id, prompt_ids)   # reusable history
+        model.import_kv(slot, kv)                          # prefill prompt_ids[length:]
+        ...                                                # generate
+        cache.store(session_id, processed_ids, model.export_kv(slot, 0, len(processed_ids)))
+
+    K/V depend on the model weights, so a cache must only be used with a single model.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_SESSION_CACHE_MB * 1024 ** 2,
+        ttl_seconds: float = DEFAULT_SESSION_TTL_SECONDS,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.total_bytes = 0
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.evictions = 0
+
+    def match(
+        self, session_id: str, token_ids: Sequence[int], max_length: Optional[int] = None
+    ) -> Tuple[int, Optional[KV]]:
+        """
+        Find how much of `token_ids` the session's cached K/V covers.
+        Only the common prefix with the stored token ids is reused, so an edited or
+        re-rendered history degrades to a partial (or no) hit instead of wrong K/V.
+
+        Args:
+            session_id: Conversation id
+            token_ids: Full prompt of the current turn
+            max_length: Upper bound on the reused length (e.g. len(token_ids) - 1 so at
+                least one token is prefilled to produce logits)
+
+        Returns:
+            (length, kv): number of reusable tokens and their per-layer K/V, each of shape
+            (n_heads, length, head_dim); kv is None when nothing can be reused
+        """
+        limit = len(token_ids) if max_length is None else min(max_length, len(token_ids))
+        with self._lock:
+            self._evict_expired()
+            session = self._sessions.get(session_id)
+            common = 0
+            if session is not None:
+                for a, b in zip(session.tokens[:limit], token_ids):
+                    if a != b:
+                        break
+                    common += 1
+                session.last_used = time.monotonic()
+                self._sessions.move_to_end(session_id)
+
+            if common == 0:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            self.reused_tokens += common
+            return common, [(k[:, :common], v[:, :common]) for k, v in session.kv]
+
+    def store(self, session_id: str, token_ids: Sequence[int], kv: KV):
+        """
+        Replace the session's entry with K/V covering `token_ids`.
+
+        Args:
+            session_id: Conversation id
+            token_ids: Tokens the model has processed (prompt plus fed generated tokens)
+            kv: Per-layer K/V for token_ids, each of shape (n_heads, len(token_ids), head_dim)
+        """
+        session = _Session(tuple(int(t) for t in token_ids), kv)
+        with self._lock:
+            self._pop(session_id)
+            if session.nbytes > self.max_bytes:
+                return
+            self._sessions[session_id] = session
+            self.total_bytes += session.nbytes
+            self._evict_expired()
+            while self.total_bytes > self.max_bytes:
+                self._pop(next(iter(self._sessions)))
+                self.evictions += 1
+
+    def drop(self, session_id: str):
+        """Forget a session (e.g. when the conversation is deleted)."""
+        with self._lock:
+            self._pop(session_id)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            self._evict_expired()
+            return {
+                "sessions": len(self._sessions),
+                "cached_mb": round(self.total_bytes / 1024 ** 2, 1),
+                "budget_mb": round(self.max_bytes / 1024 ** 2, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "reused_tokens": self.reused_tokens,
+                "evictions": self.evictions,
+            }
+
+    def _pop(self, session_id: str):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self.total_bytes -= session.nbytes
+
+    def _evict_expired(self):
+        """Drop sessions idle for longer than the TTL (oldest first)."""
+        deadline = time.monotonic() - self.ttl_seconds
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.last_used > deadline:
+                break
+            self._pop(session_id)
+            self.evictions += 1
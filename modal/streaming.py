@@ -0,0 +1,104 @@
+"""
+Token streaming helpers for the SabiYarn Modal deployments.
+Turns token ids produced during decoding into cleaned text deltas and SSE events.
+"""
+
+import json
+from typing import Callable, Iterable, Optional
+
+
+class IncrementalDetokenizer:
+    """
+    Incremental detokenization of a growing token sequence.
+
+    Only a short window of ids is re-decoded per step, and text ending in an incomplete
+    UTF-8 character (decoded as U+FFFD) is held back until the following token completes
+    it, so concatenated deltas equal `tokenizer.decode(all_ids)`.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.ids: list = []
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    def _decode(self, ids: list) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    def push(self, token_ids: Iterable[int]) -> str:
+        """Append token ids and return the newly decoded text (possibly empty)."""
+        self.ids.extend(int(t) for t in token_ids)
+        prefix_text = self._decode(self.ids[self._prefix_offset:self._read_offset])
+        new_text = self._decode(self.ids[self._prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self._prefix_offset = self._read_offset
+            self._read_offset = len(self.ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+
+class StreamCleaner:
+    """
+    Applies an output cleanup function plus `strip()` to text that arrives in pieces.
+
+    `cleanup` must be a sequence of local rewrites (e.g. a `re.sub`). Text that a later
+    piece could still change is held back: trailing runs of `strip_chars`, and anything
+    from the last character in `match_starts` when it is closer to the end than
+    `max_match_len` (a multi-character match may still be completing). The concatenated
+    output therefore equals `cleanup(full_text).strip(strip_chars)`.
+    """
+
+    def __init__(
+        self,
+        cleanup: Callable[[str], str],
+        strip_chars: Optional[str] = None,
+        match_starts: str = "",
+        max_match_len: int = 0,
+    ):
+        self.cleanup = cleanup
+        self.strip_chars = strip_chars
+        self.match_starts = match_starts
+        self.max_match_len = max_match_len
+        self._raw = ""
+        self._cleaned = ""
+        self._started = False
+
+    def _stable_raw_len(self) -> int:
+        cut = len(self._raw.rstrip(self.strip_chars))
+        for ch in self.match_starts:
+            i = self._raw.rfind(ch, 0, cut)
+            if i != -1 and len(self._raw) - i < self.max_match_len:
+                cut = i
+        return cut
+
+    def _emit(self, final: bool) -> str:
+        if not self._started:
+            self._cleaned = self._cleaned.lstrip(self.strip_chars)
+            if not self._cleaned:
+                return ""
+            self._started = True
+        text = self._cleaned.rstrip(self.strip_chars)
+        # Trailing strip characters stay buffered until more text follows (or are dropped)
+        self._cleaned = "" if final else self._cleaned[len(text):]
+        return text
+
+    def feed(self, text: str) -> str:
+        """Add raw text and return the part of the cleaned output that is now final."""
+        self._raw += text
+        cut = self._stable_raw_len()
+        self._cleaned += self.cleanup(self._raw[:cut])
+        self._raw = self._raw[cut:]
+        return self._emit(final=False)
+
+    def flush(self) -> str:
+        """Return whatever is still held back, once the stream is complete."""
+        self._cleaned += self.cleanup(self._raw)
+        self._raw = ""
+        return self._emit(final=True)
+
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Format one Server-Sent Events message."""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"